@@ -108,6 +108,19 @@ class ApiService {
     });
   }
 
+  // Several operations in one request, auth check and transaction; include: ['bills', 'stats']
+  async batch(operations, include = [], since = null) {
+    return this.makeRequest('/batch', {
+      method: 'POST',
+      body: { operations, include, since },
+    });
+  }
+
+  // Bills changed since a /changes or /batch "seq"; { resync: true, bills } when the full list is needed
+  async getChanges(since) {
+    return this.makeRequest(`/changes?since=${encodeURIComponent(since ?? '')}`);
+  }
+
   // User statistics
   async getUserStats() {
     return this.makeRequest('/user-stats');
@@ -1,4 +1,4 @@
-import React, { useEffect, useState } from "react";
+import React, { useEffect, useRef, useState } from "react";
 import api from "../../api";
 import "./dashboard.css";  
 import { FaUser, FaPhone, FaEnvelope, FaMoneyBillAlt, FaSignOutAlt, FaUsers, FaFileInvoice, FaRupeeSign  } from "react-icons/fa";
@@ -8,6 +8,13 @@ import ThemeToggle from "../theme/toggle.js";
 import { useNavigate } from "react-router-dom";
 
 
+// Apply a /changes delta to the bill list, keeping the server's newest-first order
+const mergeChanges = (current, { upserts, deletes }) => {
+    const replaced = new Set([...deletes, ...upserts.map((bill) => bill.id)]);
+    return [...upserts, ...current.filter((bill) => !replaced.has(bill.id))]
+        .sort((a, b) => new Date(b.date) - new Date(a.date) || b.id - a.id);
+};
+
 const Dashboard = () => {
     const [bills, setBills] = useState([]);
     const [formData, setFormData] = useState({ name: "", contact: "", email: "", amount: "" });
@@ -23,27 +30,44 @@ const Dashboard = () => {
     const [loadingUpdate, setLoadingUpdate] = useState(false);
     const [error, setError] = useState("");
     const [errorDelete, setErrorDelete] = useState("");
+    const changeSeq = useRef(null);
 
     useEffect(() => {
         const init = async () => {
-            await fetchUserInfo();
-            await fetchBills();
-            await fetchUserStats();
+            try {
+                const response = await api.batch([{ op: "check_auth" }], ["bills", "stats"]);
+                setUserEmail(response.results[0].body.user.email);
+                applyBatch(response);
+            } catch (error) {
+                console.error("Error loading dashboard:", error);
+            }
         };
         init();
     }, []);
 
-    const fetchUserInfo = async () => {
-        try {
-            const response = await api.checkAuth();
-            if (response.authenticated) {
-                setUserEmail(response.user.email);
-            }
-        } catch (error) {
-            console.error("Error fetching user info:", error);
+    // The first batch loads the full list; later ones carry only the bills changed since changeSeq
+    const applyBatch = (response) => {
+        if (response.changes) {
+            applyChanges(response.changes);
+        } else {
+            setBills(response.bills);
+            changeSeq.current = response.seq;
         }
+        setUserStats(response.stats);
     };
 
+    const applyChanges = (changes) => {
+        if (changes.resync) {
+            setBills(changes.bills);
+        } else if (changes.upserts.length || changes.deletes.length) {
+            setBills((current) => mergeChanges(current, changes));
+        }
+        changeSeq.current = changes.seq;
+    };
+
+    // Mutations send the held list's seq and get back only what they (and any other session) changed
+    const mutate = (operations) => api.batch(operations, ["changes", "stats"], changeSeq.current);
+
     const fetchUserStats = async () => {
         try {
             console.log("Fetching user stats...");
@@ -56,12 +80,13 @@ const Dashboard = () => {
         }
     };
 
+    // Refreshes download only the bills changed since the last response, or the full list on resync
     const fetchBills = async () => {
         try {
-            console.log("Fetching bills...");
-            const response = await api.getBills();
-            console.log("Bills fetched successfully:", response);
-            setBills(response);
+            console.log("Fetching bill changes...");
+            const response = await api.getChanges(changeSeq.current);
+            console.log("Bill changes fetched successfully:", response);
+            applyChanges(response);
         } catch (error) {
             console.error("Error fetching billing records:", error);
            
@@ -122,11 +147,10 @@ const Dashboard = () => {
         try {
             setLoadingAdd(true);
             console.log("Adding bill with data:", formData);
-            const response = await api.addBill(formData);
+            const response = await mutate([{ op: "add_bill", body: formData }]);
             console.log("Bill added successfully:", response);
             setLoadingAdd(false);
-            await fetchBills();
-            await fetchUserStats();
+            applyBatch(response);
             setFormData({ name: "", contact: "", email: "", amount: "" });
         } catch (error) {
             console.error("Error adding bill:", error);
@@ -146,16 +170,19 @@ const Dashboard = () => {
         try {
             setLoadingUpdate(true);
             console.log("Updating bill with data:", formData);
-            const response = await api.updateBill(editingBillId, {
-                name: formData.name,
-                contact: formData.contact,
-                email: formData.email,
-                amount: formData.amount
-            });
+            const response = await mutate([{
+                op: "update_bill",
+                bill_id: editingBillId,
+                body: {
+                    name: formData.name,
+                    contact: formData.contact,
+                    email: formData.email,
+                    amount: formData.amount
+                }
+            }]);
             console.log("Bill updated successfully:", response);
             setLoadingUpdate(false);
-            await fetchBills();
-            await fetchUserStats();
+            applyBatch(response);
             setFormData({ name: "", contact: "", email: "", amount: "" });
             setEditingBillId(null);
         } catch (error) {
@@ -171,10 +198,9 @@ const Dashboard = () => {
 
         try {
             console.log("Deleting bill:", billId);
-            const response = await api.deleteBill(billId);
+            const response = await mutate([{ op: "delete_bill", bill_id: billId }]);
             console.log("Bill deleted successfully:", response);
-            await fetchBills();
-            await fetchUserStats();
+            applyBatch(response);
         } catch (error) {
             console.error("Error deleting bill:", error);
             alert(`Failed to delete bill: ${error.message}`);
@@ -205,7 +231,7 @@ const Dashboard = () => {
       const res = await api.deleteAccount();
 
       if (res.success) {
-        alert("✅ Account deleted successfully.");
+        alert(`✅ ${res.message || "Account deleted successfully."}`);
         navigate("/"); 
       } else {
         setErrorDelete(res.error || "Failed to delete account.");
@@ -0,0 +1,33 @@
+"""WSGI entry point used by bench_serving_modes.py: the real app with the local token verifier installed.
+
+The signing key comes from BENCH_SIGNING_KEY (a PEM file) so the load generator can mint tokens this
+process accepts. BENCH_VERIFY_LATENCY_MS adds a sleep to every verification to stand in for the
+Firebase certificate fetch; set AUTH_TOKEN_CACHE=0 to pay it on every request.
+
+    BENCH_SIGNING_KEY=key.pem gunicorn --chdir server -k gevent benchmarks._bench_server:app
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from firebase_admin import auth as fb_auth  # noqa: E402
+
+from billing_app import app  # noqa: E402,F401
+from _local_auth import LocalTokenIssuer  # noqa: E402
+
+with open(os.environ["BENCH_SIGNING_KEY"], "rb") as f:
+    issuer = LocalTokenIssuer(private_key_pem=f.read())
+
+VERIFY_LATENCY = float(os.getenv("BENCH_VERIFY_LATENCY_MS", "0")) / 1000
+
+
+def verify_id_token(id_token, **kwargs):
+    if VERIFY_LATENCY:
+        time.sleep(VERIFY_LATENCY)  # yields under gevent, blocks the thread under gthread
+    return issuer.verify(id_token, **kwargs)
+
+
+fb_auth.verify_id_token = verify_id_token
@@ -0,0 +1,69 @@
+"""Locally minted Firebase-style ID tokens so benchmarks never talk to Firebase or Google's key servers."""
+import time
+
+import jwt
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from firebase_admin import auth as fb_auth
+
+
+class LocalTokenIssuer:
+    """Signs RS256 ID tokens with a throwaway key and verifies them the way Firebase Admin does."""
+
+    def __init__(self, project_id="billing-bench", key_size=2048, private_key_pem=None):
+        self.project_id = project_id
+        self.issuer = f"https://securetoken.google.com/{project_id}"
+        self.kid = "bench-key-1"
+        if private_key_pem is None:
+            self._private_key = rsa.generate_private_key(public_exponent=65537, key_size=key_size)
+        else:
+            # Lets a load generator and a separately started server share one signing key
+            self._private_key = serialization.load_pem_private_key(private_key_pem, password=None)
+        # Firebase Admin keeps the signing certs as PEM text and parses one per verification; mirror that
+        self.public_pem = self._private_key.public_key().public_bytes(
+            serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+
+    def private_key_pem(self):
+        return self._private_key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+        )
+
+    def mint(self, uid, email=None, ttl=3600):
+        now = int(time.time())
+        claims = {
+            "iss": self.issuer,
+            "aud": self.project_id,
+            "auth_time": now,
+            "user_id": uid,
+            "sub": uid,
+            "iat": now,
+            "exp": now + ttl,
+            "email": email or f"{uid}@bench.local",
+        }
+        return jwt.encode(claims, self._private_key, algorithm="RS256", headers={"kid": self.kid})
+
+    def verify(self, id_token, check_revoked=False, app=None, clock_skew_seconds=0):
+        """Drop-in replacement for firebase_admin.auth.verify_id_token."""
+        try:
+            header = jwt.get_unverified_header(id_token)
+            if header.get("kid") != self.kid:
+                raise jwt.InvalidTokenError(f"unknown kid {header.get('kid')!r}")
+            public_key = serialization.load_pem_public_key(self.public_pem)
+            claims = jwt.decode(
+                id_token,
+                public_key,
+                algorithms=["RS256"],
+                audience=self.project_id,
+                issuer=self.issuer,
+                leeway=clock_skew_seconds,
+            )
+        except jwt.PyJWTError as e:
+            raise fb_auth.InvalidIdTokenError(f"Invalid local token: {e}", cause=e)
+        claims["uid"] = claims["sub"]
+        return claims
+
+    def install(self):
+        """Route every verify_id_token call in this process through the local verifier."""
+        fb_auth.verify_id_token = self.verify
+        return self
@@ -0,0 +1,281 @@
+"""Drive the real Flask routes under concurrency and report latency, throughput and queries per request.
+
+Requests go through app.test_client() in-process, so the full stack runs: require_firebase_auth with
+locally minted tokens (see _local_auth.py), the connection pool, provisioning and the route SQL.
+Point the DB_* variables at a MySQL/MariaDB you can write to and name a throwaway database; it is
+created if missing. SCHEMA_MODE and the other app settings are read from the environment as usual.
+
+    BENCH_DB_NAME=billing_bench python benchmarks/bench_routes.py --tenants 50 --bills-per-tenant 200 \\
+        --concurrency 8 --output before.json
+    BENCH_DB_NAME=billing_bench python benchmarks/bench_routes.py --skip-seed --compare before.json
+
+Phases run in a fixed order (reads, then add/update, then delete) so every run does the same work.
+Queries per request come from the app's own cursor instrumentation via the Server-Timing header.
+--check-queries turns them into a regression check: the run exits non-zero when any request issued
+after its tenant's first request of the phase (once the identity caches and summary rows are warm)
+exceeds its route's budget in QUERY_BUDGETS. Run it before merging changes to route SQL; a small
+seed is enough, since the count does not depend on data volume:
+
+    BENCH_DB_NAME=billing_bench python benchmarks/bench_routes.py --tenants 5 --bills-per-tenant 20 \
+        --requests 100 --routes get_bills,user_stats,add_bill,update_bill,delete_bill --check-queries
+"""
+import argparse
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import mysql.connector
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BENCH_DB_NAME = os.environ.get("BENCH_DB_NAME")
+if not BENCH_DB_NAME:
+    sys.exit("Set BENCH_DB_NAME to a scratch database; this benchmark writes tenants, customers and bills.")
+
+
+def ensure_database():
+    conn = mysql.connector.connect(
+        host=os.getenv("DB_HOST"),
+        user=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASSWORD"),
+        port=os.getenv("DB_PORT"),
+    )
+    conn.cursor().execute(f"CREATE DATABASE IF NOT EXISTS `{BENCH_DB_NAME}`")
+    conn.close()
+
+
+ensure_database()
+os.environ["DB_NAME"] = BENCH_DB_NAME  # before import so the app's startup DDL lands in the scratch DB
+import billing_app  # noqa: E402
+from _local_auth import LocalTokenIssuer  # noqa: E402
+
+ROUTES = ("get_bills", "user_stats", "admin_view_all_data", "add_bill", "update_bill", "delete_bill")
+QUERIES_RE = re.compile(r'queries;desc="(\d+)"')
+
+# Statements per request once identity caches are warm, with synchronous (not write-behind) mutations.
+# The admin export is left out because it scales with the number of tenants. Mutations include the
+# bill_changes insert behind /changes and the users-row check that revalidates a cached identity.
+QUERY_BUDGETS = {"get_bills": 2, "user_stats": 1, "add_bill": 5, "update_bill": 5, "delete_bill": 6}
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.client = billing_app.app.test_client()
+        self._local = threading.local()
+        self.issuer = LocalTokenIssuer().install()
+        self.tenants = [f"bench-tenant-{n}" for n in range(args.tenants)]
+        self.headers = {uid: {"Authorization": f"Bearer {self.issuer.mint(uid)}"} for uid in self.tenants}
+        self.bill_ids = {}  # uid -> ids seen on /get_bills, consumed by update_bill/delete_bill
+
+    def seed(self):
+        rng = random.Random(1)
+        start = time.perf_counter()
+        for index, uid in enumerate(self.tenants, 1):
+            customers = max(1, self.args.bills_per_tenant // 5)
+            rows = [{
+                "name": f"Customer {c}",
+                "contact": f"555-{c:04d}",
+                "email": f"customer{c}@{uid}.bench",
+                "amount": round(rng.uniform(1, 500), 2),
+            } for c in (rng.randrange(customers) for _ in range(self.args.bills_per_tenant))]
+            response = self.client.post("/bills/bulk", headers=self.headers[uid], json=rows)
+            if response.status_code != 200:
+                sys.exit(f"Seeding {uid} failed: {response.status_code} {response.get_data(as_text=True)}")
+            if index % 50 == 0:
+                print(f"  seeded {index}/{len(self.tenants)} tenants", file=sys.stderr)
+        return time.perf_counter() - start
+
+    def load_bill_ids(self):
+        for uid in self.tenants:
+            response = self.client.get("/get_bills", headers=self.headers[uid])
+            self.bill_ids[uid] = [bill["id"] for bill in response.get_json()]
+
+    def request_plan(self, route, rng):
+        """(method, path, uid, json) tuples for one phase."""
+        count = self.args.admin_requests if route == "admin_view_all_data" else self.args.requests
+        plan = []
+        if route == "delete_bill":
+            pool = [(uid, bill_id) for uid, ids in self.bill_ids.items() for bill_id in ids]
+            rng.shuffle(pool)
+            return [("DELETE", f"/delete_bill/{bill_id}", uid, None) for uid, bill_id in pool[:count]]
+        for _ in range(count):
+            uid = rng.choice(self.tenants)
+            if route == "get_bills":
+                plan.append(("GET", "/get_bills", uid, None))
+            elif route == "user_stats":
+                plan.append(("GET", "/user-stats", uid, None))
+            elif route == "admin_view_all_data":
+                plan.append(("GET", "/admin/view-all-data", uid, None))
+            elif route == "add_bill":
+                c = rng.randrange(max(1, self.args.bills_per_tenant // 5) * 2)
+                plan.append(("POST", "/add_bill", uid, {
+                    "name": f"Customer {c}", "contact": f"555-{c:04d}",
+                    "email": f"customer{c}@{uid}.bench", "amount": round(rng.uniform(1, 500), 2),
+                }))
+            elif route == "update_bill" and self.bill_ids[uid]:
+                bill_id = rng.choice(self.bill_ids[uid])
+                plan.append(("PUT", f"/update_bill/{bill_id}", uid, {"amount": round(rng.uniform(1, 500), 2)}))
+        return plan
+
+    def run_phase(self, route):
+        rng = random.Random(ROUTES.index(route))
+        plan = self.request_plan(route, rng)
+        if not plan:
+            return None
+        latencies, queries, warm_queries, statuses = [], [], [], {}
+        served = set()  # tenants with a completed request this phase; later requests count as warm
+        lock = threading.Lock()
+
+        def call(item):
+            method, path, uid, body = item
+            client = getattr(self._local, "client", None)
+            if client is None:
+                client = self._local.client = billing_app.app.test_client()
+            with lock:
+                warm = uid in served
+            start = time.perf_counter()
+            response = client.open(path, method=method, headers=self.headers[uid], json=body)
+            response.get_data()  # drain streamed bodies inside the timing
+            elapsed = time.perf_counter() - start
+            match = QUERIES_RE.search(response.headers.get("Server-Timing", ""))
+            with lock:
+                latencies.append(elapsed)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+                if match:
+                    queries.append(int(match.group(1)))
+                    if warm:
+                        warm_queries.append(int(match.group(1)))
+                served.add(uid)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as pool:
+            list(pool.map(call, plan))
+        wall = time.perf_counter() - start
+        result = {
+            "requests": len(latencies),
+            "errors": sum(count for status, count in statuses.items() if status >= 400),
+            "statuses": {str(status): count for status, count in sorted(statuses.items())},
+            "throughput_rps": round(len(latencies) / wall, 1),
+            "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        }
+        if queries:
+            result["queries_per_request"] = {
+                "mean": round(sum(queries) / len(queries), 2),
+                "max": max(queries),
+                "warm_max": max(warm_queries) if warm_queries else None,
+            }
+        return result
+
+
+def check_query_budgets(report):
+    """Routes where a warm request issued more queries than QUERY_BUDGETS, as {route: (warm max, budget)}.
+
+    The mean would hide a regression that only some requests hit (one branch of a route, say).
+    """
+    over = {}
+    for route, budget in QUERY_BUDGETS.items():
+        if route in ("add_bill", "update_bill", "delete_bill") and billing_app.STATS_ROLLUPS:
+            budget += 1  # the daily rollup upsert
+        queries = (report["routes"].get(route) or {}).get("queries_per_request")
+        if queries and queries["warm_max"] is not None and queries["warm_max"] > budget:
+            over[route] = (queries["warm_max"], budget)
+    return over
+
+
+def compare(report, baseline):
+    """Ratios against an earlier report: < 1 is faster / fewer queries, > 1 is slower / more."""
+    deltas = {}
+    for route, current in report["routes"].items():
+        before = baseline.get("routes", {}).get(route)
+        if not current or not before:
+            continue
+        entry = {key: round(current[key] / before[key], 3)
+                 for key in ("p50_ms", "p95_ms", "p99_ms") if before.get(key)}
+        if before.get("throughput_rps"):
+            entry["throughput_rps"] = round(current["throughput_rps"] / before["throughput_rps"], 3)
+        if "queries_per_request" in current and "queries_per_request" in before:
+            entry["queries_per_request"] = round(
+                current["queries_per_request"]["mean"] - before["queries_per_request"]["mean"], 2)
+        deltas[route] = entry
+    return {"baseline_revision": baseline.get("revision"), "routes": deltas}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tenants", type=int, default=20)
+    parser.add_argument("--bills-per-tenant", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=1000, help="Requests per route phase.")
+    parser.add_argument("--admin-requests", type=int, default=20, help="The admin export reads every tenant.")
+    parser.add_argument("--routes", default=",".join(ROUTES), help=f"Comma-separated subset of {', '.join(ROUTES)}.")
+    parser.add_argument("--skip-seed", action="store_true", help="Reuse tenants from a previous run.")
+    parser.add_argument("--output", help="Also write the JSON report to this file.")
+    parser.add_argument("--compare", help="Earlier JSON report to compute ratios against.")
+    parser.add_argument("--check-queries", action="store_true",
+                        help="Exit with status 1 if a route issues more queries per request than QUERY_BUDGETS.")
+    args = parser.parse_args()
+    routes = [route.strip() for route in args.routes.split(",") if route.strip()]
+    unknown = set(routes) - set(ROUTES)
+    if unknown:
+        parser.error(f"unknown routes: {', '.join(sorted(unknown))}")
+
+    billing_app.SERVER_TIMING = True  # the header carries the per-request query count
+    bench = Bench(args)
+    report = {
+        "revision": git_revision(),
+        "schema_mode": billing_app.SCHEMA_MODE,
+        "tenants": args.tenants,
+        "bills_per_tenant": args.bills_per_tenant,
+        "concurrency": args.concurrency,
+        "pool_size": billing_app.DB_POOL.max_size,
+    }
+    if not args.skip_seed:
+        report["seed_seconds"] = round(bench.seed(), 2)
+    bench.load_bill_ids()
+    report["routes"] = {}
+    for route in ROUTES:
+        if route in routes:
+            print(f"  running {route}", file=sys.stderr)
+            report["routes"][route] = bench.run_phase(route)
+    report["pool"] = billing_app.DB_POOL.stats()
+    if args.compare:
+        with open(args.compare) as f:
+            report["comparison"] = compare(report, json.load(f))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+    if args.check_queries:
+        over = check_query_budgets(report)
+        for route, (worst, budget) in over.items():
+            print(f"  {route}: up to {worst} queries per request, budget {budget}", file=sys.stderr)
+        if over:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
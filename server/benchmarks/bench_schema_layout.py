@@ -0,0 +1,140 @@
+"""Compare the per_user and tenant schema layouts at N tenants against a scratch MySQL database.
+
+Point the DB_* variables at a MySQL/MariaDB you can write to and name a throwaway database; it is
+created if missing and the app's own DDL (create_user_tables / create_tenant_tables) is run against it.
+
+    BENCH_DB_NAME=billing_bench python benchmarks/bench_schema_layout.py --tenants 10000
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+import mysql.connector
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BENCH_DB_NAME = os.environ.get("BENCH_DB_NAME")
+if not BENCH_DB_NAME:
+    sys.exit("Set BENCH_DB_NAME to a scratch database; this benchmark creates tens of thousands of tables.")
+
+
+def ensure_database():
+    conn = mysql.connector.connect(
+        host=os.getenv("DB_HOST"),
+        user=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASSWORD"),
+        port=os.getenv("DB_PORT"),
+    )
+    conn.cursor().execute(f"CREATE DATABASE IF NOT EXISTS `{BENCH_DB_NAME}`")
+    conn.close()
+
+
+ensure_database()
+os.environ["DB_NAME"] = BENCH_DB_NAME  # before import so the app's startup DDL lands in the scratch DB
+import billing_app  # noqa: E402
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def summarize(samples):
+    return {
+        "p50_ms": round(percentile(samples, 50) * 1000, 3),
+        "p95_ms": round(percentile(samples, 95) * 1000, 3),
+        "p99_ms": round(percentile(samples, 99) * 1000, 3),
+    }
+
+
+def timed(cursor, sql, params=()):
+    start = time.perf_counter()
+    cursor.execute(sql, params)
+    cursor.fetchall()
+    return time.perf_counter() - start
+
+
+def seed(conn, mode, tenants, bills_per_tenant):
+    cursor = conn.cursor()
+    if mode == "tenant":
+        billing_app.create_tenant_tables(conn)
+    start = time.perf_counter()
+    for user_id in range(1, tenants + 1):
+        tables = billing_app.TenantTables(user_id, mode=mode)
+        if mode == "per_user":
+            billing_app.create_user_tables(user_id, conn=conn)
+        cursor.execute(
+            tables.insert_sql(tables.customers, "name", "contact", "email"),
+            tables.row(f"Customer {user_id}", "555-0100", f"c{user_id}@bench.local"),
+        )
+        customer_id = cursor.lastrowid
+        cursor.executemany(
+            tables.insert_sql(tables.bills, "customer_id", "amount"),
+            [tables.row(customer_id, round(random.uniform(1, 500), 2)) for _ in range(bills_per_tenant)],
+        )
+        if user_id % 500 == 0:
+            conn.commit()
+            print(f"  [{mode}] seeded {user_id}/{tenants} tenants", file=sys.stderr)
+    conn.commit()
+    return time.perf_counter() - start
+
+
+def measure(conn, mode, tenants, samples):
+    cursor = conn.cursor()
+    rng = random.Random(7)
+    probe, bills, stats = [], [], []
+    for _ in range(samples):
+        user_id = rng.randint(1, tenants)
+        tables = billing_app.TenantTables(user_id, mode=mode)
+        if mode == "per_user":
+            # What provision_user_with_conn pays on a cold identity cache
+            probe.append(timed(cursor, f"SHOW TABLES LIKE '{tables.customers}'"))
+        where, params = tables.scope("b")
+        bills.append(timed(cursor, f"""
+            SELECT b.id, c.name, c.contact, c.email, b.amount, b.date
+            FROM {tables.bills} b JOIN {tables.customers} c ON b.customer_id = c.id
+            WHERE {where}
+        """, params))
+        where, params = tables.scope()
+        stats.append(timed(cursor, f"SELECT COUNT(*), SUM(amount) FROM {tables.bills} WHERE {where}", params))
+    info = [timed(cursor, "SELECT COUNT(*) FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE()")
+            for _ in range(5)]
+    cursor.execute("SELECT COUNT(*) FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE()")
+    result = {
+        "table_count": cursor.fetchone()[0],
+        "get_bills": summarize(bills),
+        "user_stats": summarize(stats),
+        "information_schema_count": summarize(info),
+    }
+    if probe:
+        result["provision_probe"] = summarize(probe)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tenants", type=int, default=10000)
+    parser.add_argument("--bills-per-tenant", type=int, default=20)
+    parser.add_argument("--samples", type=int, default=2000)
+    parser.add_argument("--skip-seed", action="store_true", help="Reuse tables from a previous run.")
+    args = parser.parse_args()
+
+    report = {"tenants": args.tenants, "bills_per_tenant": args.bills_per_tenant}
+    conn = billing_app.create_connection()
+    try:
+        for mode in ("per_user", "tenant"):
+            entry = {}
+            if not args.skip_seed:
+                entry["seed_seconds"] = round(seed(conn, mode, args.tenants, args.bills_per_tenant), 2)
+            entry.update(measure(conn, mode, args.tenants, args.samples))
+            report[mode] = entry
+    finally:
+        conn.close()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
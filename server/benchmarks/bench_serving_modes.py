@@ -0,0 +1,262 @@
+"""How many concurrent dashboard sessions one gunicorn worker sustains: threaded (gthread) vs gevent.
+
+Each mode is started as a real single-worker gunicorn process serving benchmarks/_bench_server.py,
+which is billing_app with locally signed tokens. Every simulated session repeatedly loads the
+dashboard (GET /get_bills then GET /user-stats), waits --think-ms, and loads it again. A session
+level is "sustained" when p95 page-load latency stays under --slo-ms with no errors.
+
+Local MySQL answers in well under a millisecond, which hides the difference between the modes;
+--db-latency-ms puts a TCP proxy that delays every packet in front of it to model a remote database.
+
+    BENCH_DB_NAME=billing_bench python benchmarks/bench_serving_modes.py --sessions 10,50,100,200 \\
+        --db-latency-ms 20 --output serving.json
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import select
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import mysql.connector
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from _local_auth import LocalTokenIssuer  # noqa: E402
+
+BENCH_DB_NAME = os.environ.get("BENCH_DB_NAME")
+if not BENCH_DB_NAME:
+    sys.exit("Set BENCH_DB_NAME to a scratch database; this benchmark writes tenants, customers and bills.")
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def ensure_database():
+    conn = mysql.connector.connect(
+        host=os.getenv("DB_HOST"),
+        user=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASSWORD"),
+        port=os.getenv("DB_PORT"),
+    )
+    conn.cursor().execute(f"CREATE DATABASE IF NOT EXISTS `{BENCH_DB_NAME}`")
+    conn.close()
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class LatencyProxy:
+    """TCP forwarder that holds every chunk for `delay` seconds in each direction."""
+
+    def __init__(self, target_host, target_port, delay):
+        self.target = (target_host, target_port)
+        self.delay = delay
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            client, _ = self.listener.accept()
+            upstream = socket.create_connection(self.target)
+            threading.Thread(target=self._pipe, args=(client, upstream), daemon=True).start()
+
+    def _pipe(self, client, upstream):
+        peers = {client: upstream, upstream: client}
+        try:
+            while True:
+                readable, _, _ = select.select(list(peers), [], [])
+                for sock in readable:
+                    data = sock.recv(65536)
+                    if not data:
+                        return
+                    time.sleep(self.delay)
+                    peers[sock].sendall(data)
+        except OSError:
+            pass
+        finally:
+            client.close()
+            upstream.close()
+
+
+class Server:
+    """One single-worker gunicorn process in the given mode."""
+
+    def __init__(self, mode, args, env):
+        self.port = free_port()
+        command = [sys.executable, "-m", "gunicorn", "--chdir", SERVER_DIR, "--workers", "1",
+                   "--bind", f"127.0.0.1:{self.port}", "--log-level", "warning"]
+        env = dict(env)
+        if mode == "gevent":
+            command += ["--worker-class", "gevent", "--worker-connections", str(args.worker_connections)]
+            env["DB_POOL_SIZE"] = str(args.gevent_pool_size)
+        else:
+            command += ["--worker-class", "gthread", "--threads", str(args.threads)]
+            env["DB_POOL_SIZE"] = str(args.threads)
+        command.append("benchmarks._bench_server:app")
+        self.process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=sys.stderr)
+        deadline = time.monotonic() + 60
+        while time.monotonic() < deadline:
+            try:
+                conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=1)
+                conn.request("GET", "/ping")
+                if conn.getresponse().status == 200:
+                    return
+            except OSError:
+                time.sleep(0.2)
+        self.stop()
+        sys.exit(f"gunicorn ({mode}) did not come up on port {self.port}")
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait(timeout=30)
+
+
+def request(conn, method, path, token, body=None):
+    headers = {"Authorization": f"Bearer {token}"}
+    payload = None
+    if body is not None:
+        payload = json.dumps(body)
+        headers["Content-Type"] = "application/json"
+    conn.request(method, path, body=payload, headers=headers)
+    response = conn.getresponse()
+    response.read()
+    return response.status
+
+
+def seed(port, tokens, bills_per_tenant):
+    rng = random.Random(1)
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+    for uid, token in tokens.items():
+        rows = [{
+            "name": f"Customer {c}",
+            "contact": f"555-{c:04d}",
+            "email": f"customer{c}@{uid}.bench",
+            "amount": round(rng.uniform(1, 500), 2),
+        } for c in (rng.randrange(max(1, bills_per_tenant // 5)) for _ in range(bills_per_tenant))]
+        status = request(conn, "POST", "/bills/bulk", token, rows)
+        if status != 200:
+            sys.exit(f"Seeding {uid} failed with HTTP {status}")
+    conn.close()
+
+
+def run_level(port, tokens, sessions, duration, think):
+    """Run `sessions` dashboard loops for `duration` seconds; returns page-load stats."""
+    uids = list(tokens)
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+    stop_at = time.monotonic() + duration
+
+    def session(index):
+        token = tokens[uids[index % len(uids)]]
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=max(30.0, duration))
+        time.sleep(random.Random(index).uniform(0, think or 0.05))  # spread the first loads
+        while time.monotonic() < stop_at:
+            start = time.perf_counter()
+            try:
+                ok = all(request(conn, "GET", path, token) == 200 for path in ("/get_bills", "/user-stats"))
+            except (OSError, http.client.HTTPException):
+                ok = False
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=max(30.0, duration))
+            elapsed = time.perf_counter() - start
+            with lock:
+                if ok:
+                    latencies.append(elapsed)
+                else:
+                    errors[0] += 1
+            if think:
+                time.sleep(think)
+        conn.close()
+
+    threads = [threading.Thread(target=session, args=(i,), daemon=True) for i in range(sessions)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+    result = {"sessions": sessions, "page_loads": len(latencies), "errors": errors[0],
+              "page_loads_per_s": round(len(latencies) / wall, 1)}
+    if latencies:
+        result.update({
+            "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        })
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", default="10,25,50,100,200", help="Comma-separated session counts.")
+    parser.add_argument("--duration", type=float, default=20, help="Seconds per session level.")
+    parser.add_argument("--think-ms", type=float, default=1000, help="Pause between a session's page loads.")
+    parser.add_argument("--slo-ms", type=float, default=500, help="p95 page-load bound for a sustained level.")
+    parser.add_argument("--tenants", type=int, default=50)
+    parser.add_argument("--bills-per-tenant", type=int, default=100)
+    parser.add_argument("--threads", type=int, default=8, help="gthread threads (and pool size) per worker.")
+    parser.add_argument("--worker-connections", type=int, default=1000, help="gevent greenlets per worker.")
+    parser.add_argument("--gevent-pool-size", type=int, default=20, help="DB_POOL_SIZE for the gevent worker.")
+    parser.add_argument("--db-latency-ms", type=float, default=0, help="Delay added to each DB packet.")
+    parser.add_argument("--verify-latency-ms", type=float, default=0, help="Delay added to token verification.")
+    parser.add_argument("--modes", default="gthread,gevent")
+    parser.add_argument("--skip-seed", action="store_true")
+    parser.add_argument("--output", help="Also write the JSON report to this file.")
+    args = parser.parse_args()
+    levels = [int(level) for level in args.sessions.split(",")]
+
+    ensure_database()
+    issuer = LocalTokenIssuer()
+    key_file = tempfile.NamedTemporaryFile(suffix=".pem")
+    key_file.write(issuer.private_key_pem())
+    key_file.flush()
+    tokens = {f"bench-session-{n}": issuer.mint(f"bench-session-{n}", ttl=6 * 3600) for n in range(args.tenants)}
+
+    env = dict(os.environ, DB_NAME=BENCH_DB_NAME, BENCH_SIGNING_KEY=key_file.name,
+               BENCH_VERIFY_LATENCY_MS=str(args.verify_latency_ms), DB_POOL_TIMEOUT="30")
+    if args.db_latency_ms:
+        proxy = LatencyProxy(os.getenv("DB_HOST") or "127.0.0.1", int(os.getenv("DB_PORT") or 3306),
+                             args.db_latency_ms / 1000)
+        env.update(DB_HOST="127.0.0.1", DB_PORT=str(proxy.port))
+
+    report = {"levels": levels, "think_ms": args.think_ms, "slo_ms": args.slo_ms,
+              "db_latency_ms": args.db_latency_ms, "verify_latency_ms": args.verify_latency_ms, "modes": {}}
+    seeded = args.skip_seed
+    for mode in args.modes.split(","):
+        server = Server(mode, args, env)
+        try:
+            if not seeded:
+                seed(server.port, tokens, args.bills_per_tenant)
+                seeded = True
+            results = []
+            for sessions in levels:
+                print(f"  {mode}: {sessions} sessions", file=sys.stderr)
+                results.append(run_level(server.port, tokens, sessions, args.duration, args.think_ms / 1000))
+        finally:
+            server.stop()
+        sustained = [r["sessions"] for r in results if not r["errors"] and r.get("p95_ms", 1e9) <= args.slo_ms]
+        report["modes"][mode] = {"max_sustained_sessions": max(sustained, default=0), "results": results}
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""Cold-start cost of a worker process: eager startup vs LAZY_STARTUP=1.
+
+Every run is a fresh interpreter that imports billing_app, the way each gunicorn worker does without
+--preload, and then serves its first unauthenticated and first authenticated request in-process.
+Reported per mode (medians over --runs):
+
+    import_ms           importing billing_app (Firebase Admin setup and schema checks when eager)
+    first_request_ms    GET /ping, the first request after import
+    first_auth_ms       GET /get_bills with a locally signed token (pool connect + provisioning)
+    modules             modules loaded after import, which shows what lazy startup defers
+    max_rss_mb          peak resident memory of the process
+
+Lazy runs skip the schema checks, so the benchmark runs `flask migrate` once up front.
+
+    BENCH_DB_NAME=billing_bench python benchmarks/bench_startup.py --runs 10 --output startup.json
+"""
+import argparse
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+BENCH_DB_NAME = os.environ.get("BENCH_DB_NAME")
+if not BENCH_DB_NAME:
+    sys.exit("Set BENCH_DB_NAME to a scratch database; this benchmark creates tables and a tenant.")
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODES = {"eager": "0", "lazy": "1"}
+
+
+def ensure_database():
+    import mysql.connector
+
+    conn = mysql.connector.connect(
+        host=os.getenv("DB_HOST"),
+        user=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASSWORD"),
+        port=os.getenv("DB_PORT"),
+    )
+    conn.cursor().execute(f"CREATE DATABASE IF NOT EXISTS `{BENCH_DB_NAME}`")
+    conn.close()
+
+
+def child():
+    """Runs inside the measured process; prints one JSON line."""
+    sys.path.insert(0, SERVER_DIR)
+    start = time.perf_counter()
+    import billing_app
+    import_s = time.perf_counter() - start
+    modules = len(sys.modules)
+
+    client = billing_app.app.test_client()
+    start = time.perf_counter()
+    client.get("/ping")
+    first_request_s = time.perf_counter() - start
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from _local_auth import LocalTokenIssuer
+
+    issuer = LocalTokenIssuer().install()
+    headers = {"Authorization": f"Bearer {issuer.mint('bench-startup')}"}
+    start = time.perf_counter()
+    status = client.get("/get_bills", headers=headers).status_code
+    first_auth_s = time.perf_counter() - start
+    print(json.dumps({
+        "import_s": import_s,
+        "first_request_s": first_request_s,
+        "first_auth_s": first_auth_s,
+        "first_auth_status": status,
+        "modules": modules,
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }))
+
+
+def run_once(env):
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), "--child"], env=env, cwd=SERVER_DIR,
+                            capture_output=True, text=True)
+    wall = time.perf_counter() - started
+    if result.returncode != 0:
+        sys.exit(f"Child process failed:\n{result.stderr}")
+    sample = json.loads(result.stdout.strip().splitlines()[-1])
+    sample["process_s"] = wall
+    return sample
+
+
+def summarize(samples):
+    median = lambda key: statistics.median(sample[key] for sample in samples)  # noqa: E731
+    return {
+        "import_ms": round(median("import_s") * 1000, 1),
+        "first_request_ms": round(median("first_request_s") * 1000, 1),
+        "first_auth_ms": round(median("first_auth_s") * 1000, 1),
+        "process_ms": round(median("process_s") * 1000, 1),
+        "modules": int(median("modules")),
+        "max_rss_mb": round(median("max_rss_kb") / 1024, 1),
+        "first_auth_statuses": sorted({sample["first_auth_status"] for sample in samples}),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5, help="Fresh processes per mode.")
+    parser.add_argument("--modes", default=",".join(MODES))
+    parser.add_argument("--output", help="Also write the JSON report to this file.")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child()
+        return
+
+    ensure_database()
+    env = dict(os.environ, DB_NAME=BENCH_DB_NAME)
+    subprocess.run([sys.executable, "-m", "flask", "--app", "billing_app", "migrate"], env=env, cwd=SERVER_DIR,
+                   check=True, capture_output=True)
+    report = {"runs": args.runs, "modes": {}}
+    for mode in args.modes.split(","):
+        print(f"  {mode}", file=sys.stderr)
+        mode_env = dict(env, LAZY_STARTUP=MODES[mode])
+        report["modes"][mode] = summarize([run_once(mode_env) for _ in range(args.runs)])
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
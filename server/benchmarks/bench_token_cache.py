@@ -0,0 +1,71 @@
+"""Per-request cost of require_firebase_auth with and without the verified-token cache.
+
+Tokens are minted and verified locally (see _local_auth.py), so the numbers measure signature
+checking and key parsing only -- real Firebase verification also pays for key refreshes.
+
+    python benchmarks/bench_token_cache.py --users 50 --page-loads 2000
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import billing_app  # noqa: E402
+from _local_auth import LocalTokenIssuer  # noqa: E402
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def run(tokens, page_loads, requests_per_load, cache):
+    billing_app.TOKEN_CACHE = cache
+    view = billing_app.require_firebase_auth(lambda: "ok")
+    rng = random.Random(42)
+    samples = []
+    for _ in range(page_loads):
+        token = rng.choice(tokens)
+        headers = {"Authorization": f"Bearer {token}"}
+        # The dashboard sends /get_bills and /user-stats with the same token on every load
+        for _ in range(requests_per_load):
+            with billing_app.app.test_request_context("/get_bills", headers=headers):
+                start = time.perf_counter()
+                view()
+                samples.append((time.perf_counter() - start) * 1e6)
+    result = {
+        "cache": cache is not None,
+        "requests": len(samples),
+        "mean_us": round(sum(samples) / len(samples), 1),
+        "p50_us": round(percentile(samples, 50), 1),
+        "p95_us": round(percentile(samples, 95), 1),
+        "p99_us": round(percentile(samples, 99), 1),
+    }
+    if cache is not None:
+        result["cache_stats"] = cache.stats()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--page-loads", type=int, default=2000)
+    parser.add_argument("--requests-per-load", type=int, default=2)
+    args = parser.parse_args()
+
+    issuer = LocalTokenIssuer().install()
+    tokens = [issuer.mint(f"bench-user-{i}") for i in range(args.users)]
+    results = [
+        run(tokens, args.page_loads, args.requests_per_load, None),
+        run(tokens, args.page_loads, args.requests_per_load, billing_app.TokenCache()),
+    ]
+    results.append({"speedup_mean": round(results[0]["mean_us"] / results[1]["mean_us"], 2)})
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,36 @@
 
-from flask import Flask, jsonify, request, session, g
+from flask import Flask, jsonify, request, session, g, has_request_context, Response, stream_with_context
 from flask_cors import CORS
 import mysql.connector
-from mysql.connector import Error
+from mysql.connector import Error, errorcode
+import base64
+import binascii
 import hashlib
+import math
 import secrets
 import os
-from datetime import datetime, timedelta
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from decimal import Decimal, InvalidOperation
 from dotenv import load_dotenv
 from functools import wraps
+from contextlib import contextmanager
+import click
 from pathlib import Path
 import json
-
-# Firebase Admin
-import firebase_admin
-from firebase_admin import auth as fb_auth, credentials as fb_credentials
+import codecs
+import csv
+import io
+import re
+import sqlite3
+import heapq
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
 
 
 ENV_PATH = Path(__file__).with_name('.env')
@@ -28,86 +44,654 @@ app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=24)
 app.config['SESSION_COOKIE_SECURE'] = False  
 app.config['SESSION_COOKIE_HTTPONLY'] = True
 
-try:
-    if not firebase_admin._apps:
-        cred = None
-        cred_path = os.environ.get('FIREBASE_APPLICATION_CREDENTIALS')
-        cred_inline = os.environ.get('FIREBASE_CREDENTIALS_JSON')
-        project_id = os.environ.get('FIREBASE_PROJECT_ID') or os.environ.get('GOOGLE_CLOUD_PROJECT')
-        options = {'projectId': project_id} if project_id else None
-        
-        print(f"[Firebase Admin] Using project_id={project_id}")
-       
-        print(f"[Firebase Admin] Using FIREBASE_APPLICATION_CREDENTIALS={cred_path}")
-        print(f"[Firebase Admin] Inline JSON present={bool(cred_inline)}")
-        if cred_inline:
-            try:
-                cred_data = json.loads(cred_inline)
-                cred = fb_credentials.Certificate(cred_data)
+# --- Startup ---
+# Lazy: Firebase Admin is imported on the first token verification and no schema DDL runs at import;
+# run `flask --app billing_app migrate` once per deploy instead.
+LAZY_STARTUP = os.getenv("LAZY_STARTUP", "0").lower() in ("1", "true", "yes")
+print(f"[Startup] lazy={LAZY_STARTUP}")
+
+_fb_auth = None
+_firebase_lock = threading.Lock()
+
+
+def initialize_firebase(firebase_admin, fb_credentials):
+    try:
+        if not firebase_admin._apps:
+            cred = None
+            cred_path = os.environ.get('FIREBASE_APPLICATION_CREDENTIALS')
+            cred_inline = os.environ.get('FIREBASE_CREDENTIALS_JSON')
+            project_id = os.environ.get('FIREBASE_PROJECT_ID') or os.environ.get('GOOGLE_CLOUD_PROJECT')
+            options = {'projectId': project_id} if project_id else None
+
+            print(f"[Firebase Admin] Using project_id={project_id}")
+
+            print(f"[Firebase Admin] Using FIREBASE_APPLICATION_CREDENTIALS={cred_path}")
+            print(f"[Firebase Admin] Inline JSON present={bool(cred_inline)}")
+            if cred_inline:
+                try:
+                    cred_data = json.loads(cred_inline)
+                    cred = fb_credentials.Certificate(cred_data)
+                    firebase_admin.initialize_app(cred, options)
+                    print("✅ Firebase Admin initialized with inline JSON credentials")
+                except Exception as e:
+                    print(f"⚠️ Inline JSON credentials failed: {e}")
+                    raise
+            elif cred_path and os.path.exists(cred_path):
+                cred = fb_credentials.Certificate(cred_path)
                 firebase_admin.initialize_app(cred, options)
-                print("✅ Firebase Admin initialized with inline JSON credentials")
-            except Exception as e:
-                print(f"⚠️ Inline JSON credentials failed: {e}")
-                raise
-        elif cred_path and os.path.exists(cred_path):
-            cred = fb_credentials.Certificate(cred_path)
-            firebase_admin.initialize_app(cred, options)
-            print("✅ Firebase Admin initialized with service account certificate")
+                print("✅ Firebase Admin initialized with service account certificate")
+            else:
+                try:
+                    cred = fb_credentials.ApplicationDefault()
+                    firebase_admin.initialize_app(cred, options)
+                    print("✅ Firebase Admin initialized with Application Default Credentials")
+                except Exception:
+                    # Last resort: initialize without explicit credentials (may work on GCP)
+                    firebase_admin.initialize_app(options)
+                    print("✅ Firebase Admin initialized with options only (no explicit credentials)")
+    except Exception as e:
+        print(f"⚠️ Firebase Admin initialization failed: {e}")
+
+
+def firebase_auth():
+    """The firebase_admin.auth module, importing Firebase Admin and initializing its app on first use."""
+    global _fb_auth
+    if _fb_auth is None:
+        with _firebase_lock:
+            if _fb_auth is None:
+                import firebase_admin
+                from firebase_admin import auth, credentials
+                initialize_firebase(firebase_admin, credentials)
+                _fb_auth = auth
+    return _fb_auth
+
+
+if not LAZY_STARTUP:
+    firebase_auth()
+
+
+# --- Instrumentation ---
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1").lower() not in ("0", "false", "no")
+SERVER_TIMING = os.getenv("SERVER_TIMING", "0").lower() in ("1", "true", "yes")
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")  # when set, /metrics requires "Authorization: Bearer <token>"
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+SLOW_QUERY_SAMPLES = int(os.getenv("SLOW_QUERY_SAMPLES", "50"))
+print(f"[Metrics] enabled={METRICS_ENABLED} server_timing={SERVER_TIMING} slow_query_ms={SLOW_QUERY_MS}")
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # seconds
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 50, 100)
+
+
+class Histogram:
+    """Prometheus-style histogram; the owning Metrics instance serialises access."""
+
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.bounds):
+            if value <= bound:
+                break
         else:
-            try:
-                cred = fb_credentials.ApplicationDefault()
-                firebase_admin.initialize_app(cred, options)
-                print("✅ Firebase Admin initialized with Application Default Credentials")
-            except Exception:
-                # Last resort: initialize without explicit credentials (may work on GCP)
-                firebase_admin.initialize_app(options)
-                print("✅ Firebase Admin initialized with options only (no explicit credentials)")
-except Exception as e:
-    print(f"⚠️ Firebase Admin initialization failed: {e}")
+            index = len(self.bounds)
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels=""):
+        lines = []
+        cumulative = 0
+        sep = "," if labels else ""
+        for bound, count in zip(self.bounds + ("+Inf",), self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}{sep}le="{bound}"}} {cumulative}')
+        suffix = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{suffix} {self.sum:.6f}")
+        lines.append(f"{name}_count{suffix} {self.count}")
+        return lines
+
+
+class Metrics:
+    """Per-process request, phase and query metrics behind /metrics.
+
+    Each gunicorn worker keeps its own registry (reset after fork), so a scrape sees the worker
+    that served it; the per-request numbers also go out in Server-Timing when that is enabled.
+    """
+
+    def __init__(self):
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self.lock = threading.Lock()
+        self.requests = {}  # (route, method) -> Histogram of seconds
+        self.responses = {}  # (route, method, status) -> count
+        self.queries_per_request = {}  # route -> Histogram of query counts
+        self.phases = {}  # phase -> Histogram of seconds
+        self.query_time = Histogram(LATENCY_BUCKETS)
+        self.slow_queries = 0
+        self.slow_samples = deque(maxlen=SLOW_QUERY_SAMPLES)
+
+    def record_phase(self, phase, elapsed):
+        with self.lock:
+            histogram = self.phases.get(phase)
+            if histogram is None:
+                histogram = self.phases[phase] = Histogram(LATENCY_BUCKETS)
+            histogram.observe(elapsed)
+        if has_request_context() and "_timings" in g:
+            g._timings[phase] = g._timings.get(phase, 0.0) + elapsed
+
+    def record_query(self, operation, elapsed):
+        in_request = has_request_context() and "_timings" in g
+        if in_request:
+            g._query_count += 1
+            g._timings["query"] = g._timings.get("query", 0.0) + elapsed
+        slow = elapsed * 1000 >= SLOW_QUERY_MS
+        if slow:
+            sample = {
+                "sql": " ".join(str(operation).split())[:500],
+                "ms": round(elapsed * 1000, 3),
+                "route": request.url_rule.rule if in_request and request.url_rule else None,
+                "at": datetime.utcnow().isoformat() + "Z",
+            }
+        with self.lock:
+            self.query_time.observe(elapsed)
+            if slow:
+                self.slow_queries += 1
+                self.slow_samples.append(sample)
+
+    def record_request(self, route, method, status, elapsed, queries):
+        with self.lock:
+            histogram = self.requests.get((route, method))
+            if histogram is None:
+                histogram = self.requests[(route, method)] = Histogram(LATENCY_BUCKETS)
+            histogram.observe(elapsed)
+            key = (route, method, status)
+            self.responses[key] = self.responses.get(key, 0) + 1
+            histogram = self.queries_per_request.get(route)
+            if histogram is None:
+                histogram = self.queries_per_request[route] = Histogram(QUERY_COUNT_BUCKETS)
+            histogram.observe(queries)
+
+    def slow_query_samples(self):
+        with self.lock:
+            return list(self.slow_samples)
+
+    def render(self, extra=()):
+        """Prometheus text exposition format (version 0.0.4)."""
+        lines = []
+        with self.lock:
+            lines += ["# HELP billing_request_duration_seconds Request latency by route.",
+                      "# TYPE billing_request_duration_seconds histogram"]
+            for (route, method), histogram in sorted(self.requests.items()):
+                lines += histogram.render("billing_request_duration_seconds", f'route="{route}",method="{method}"')
+            lines += ["# HELP billing_requests_total Responses by route and status.",
+                      "# TYPE billing_requests_total counter"]
+            for (route, method, status), count in sorted(self.responses.items()):
+                lines.append(f'billing_requests_total{{route="{route}",method="{method}",status="{status}"}} {count}')
+            lines += ["# HELP billing_phase_duration_seconds Time spent in auth, db_checkout, provision and identity_check.",
+                      "# TYPE billing_phase_duration_seconds histogram"]
+            for phase, histogram in sorted(self.phases.items()):
+                lines += histogram.render("billing_phase_duration_seconds", f'phase="{phase}"')
+            lines += ["# HELP billing_db_queries_per_request Cursor executes per request by route.",
+                      "# TYPE billing_db_queries_per_request histogram"]
+            for route, histogram in sorted(self.queries_per_request.items()):
+                lines += histogram.render("billing_db_queries_per_request", f'route="{route}"')
+            lines += ["# HELP billing_db_query_duration_seconds Duration of each cursor execute.",
+                      "# TYPE billing_db_query_duration_seconds histogram"]
+            lines += self.query_time.render("billing_db_query_duration_seconds")
+            lines += [f"# HELP billing_db_slow_queries_total Queries slower than {SLOW_QUERY_MS}ms.",
+                      "# TYPE billing_db_slow_queries_total counter",
+                      f"billing_db_slow_queries_total {self.slow_queries}"]
+        lines += extra
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+
+
+@contextmanager
+def timed(phase):
+    """Record the duration of the enclosed block as `phase` (also added to the request's Server-Timing)."""
+    if not METRICS_ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        METRICS.record_phase(phase, time.perf_counter() - start)
+
+
+def instrumented(phase):
+    """Decorator form of timed()."""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            with timed(phase):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class InstrumentedCursor:
+    """Cursor proxy that times execute/executemany and counts them against the current request."""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def execute(self, operation, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self._cursor.execute(operation, *args, **kwargs)
+        finally:
+            METRICS.record_query(operation, time.perf_counter() - start)
+
+    def executemany(self, operation, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self._cursor.executemany(operation, *args, **kwargs)
+        finally:
+            METRICS.record_query(operation, time.perf_counter() - start)
 
 
 # --- Connection pooling helpers ---
-POOL_CREATED = False
-DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "1"))  # default to 1 to respect low connection caps
-print(f"[DB] Using pool_size={DB_POOL_SIZE}")
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))  # max connections per worker; keep workers * size under the server cap
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))  # seconds a checkout waits for a free connection
+DB_POOL_RECYCLE = float(os.getenv("DB_POOL_RECYCLE", "1800"))  # reopen connections older than this
+DB_POOL_PING_AFTER = float(os.getenv("DB_POOL_PING_AFTER", "30"))  # ping on borrow when idle longer than this
+DB_POOL_MAX_WAITERS = int(os.getenv("DB_POOL_MAX_WAITERS", "0"))  # checkouts allowed to queue; beyond it 503 at once (0 = no bound)
+# Server-side prepared statements kept per connection (0 = text protocol). The driver resets a statement
+# before every execute, so this trades MySQL's parse time for one extra round trip per statement.
+DB_PREPARED_STATEMENTS = int(os.getenv("DB_PREPARED_STATEMENTS", "0"))
+print(f"[DB] Using pool min={DB_POOL_MIN} max={DB_POOL_SIZE} timeout={DB_POOL_TIMEOUT}s max_waiters={DB_POOL_MAX_WAITERS}")
+print(f"[DB] prepared statements per connection={DB_PREPARED_STATEMENTS}")
 
-def create_connection():
-    global POOL_CREATED
-    try:
-        connect_args = dict(
-            host=os.getenv("DB_HOST"),
-            user=os.getenv("DB_USER"),
-            password=os.getenv("DB_PASSWORD"),
-            database=os.getenv("DB_NAME"),
-            port=os.getenv("DB_PORT"),
-            pool_name="app_pool",
-        )
-        if not POOL_CREATED:
-            connect_args["pool_size"] = DB_POOL_SIZE
-            connect_args["pool_reset_session"] = True
-        conn = mysql.connector.connect(**connect_args)
-        POOL_CREATED = True
-        if conn.is_connected():
-            return conn
-    except Error as e:
-        # Retry once without pool size in case pool already exists
-        try:
-            conn = mysql.connector.connect(
-                host=os.getenv("DB_HOST"),
-                user=os.getenv("DB_USER"),
-                password=os.getenv("DB_PASSWORD"),
-                database=os.getenv("DB_NAME"),
-                port=os.getenv("DB_PORT"),
-                pool_name="app_pool",
-            )
-            if conn.is_connected():
-                return conn
+# Upper bounds (ms) of the checkout wait-time histogram buckets
+POOL_WAIT_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class DatabaseUnavailable(Exception):
+    """No database connection could be handed out (MySQL unreachable or pool exhausted)."""
+
+
+class PoolTimeout(DatabaseUnavailable):
+    """Every pooled connection stayed busy for the whole checkout timeout."""
+
+
+class PoolSaturated(DatabaseUnavailable):
+    """Every connection is busy and DB_POOL_MAX_WAITERS checkouts are already queued."""
+
+
+def cooperative_io():
+    """True when gevent has patched sockets (gunicorn -k gevent): blocking I/O then yields to other requests."""
+    # Only whoever patched has imported gevent.monkey; importing it here would load gevent for every sync worker
+    monkey = sys.modules.get("gevent.monkey")
+    return monkey is not None and monkey.is_module_patched("socket")
+
+
+print(f"[Server] cooperative I/O (gevent)={cooperative_io()}")
+
+
+def os_thread_local():
+    """A threading.local keyed on the OS thread; gevent's patched one is per greenlet."""
+    monkey = sys.modules.get("gevent.monkey")
+    if monkey is not None and monkey.is_module_patched("threading"):
+        return monkey.get_original("threading", "local")()
+    return threading.local()
+
+
+def open_connection():
+    """Open a new physical MySQL connection (the pool's factory)."""
+    return mysql.connector.connect(
+        host=os.getenv("DB_HOST"),
+        user=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASSWORD"),
+        database=os.getenv("DB_NAME"),
+        port=os.getenv("DB_PORT"),
+        # The C extension does its socket I/O outside Python, which would block every greenlet in the worker
+        use_pure=cooperative_io(),
+    )
+
+
+class PooledConnection:
+    """A connection checked out of ConnectionPool; close() hands it back instead of disconnecting."""
+
+    def __init__(self, pool, raw, created_at):
+        self._pool = pool
+        self._raw = raw
+        self._created_at = created_at
+
+    def __getattr__(self, name):
+        if self._raw is None:
+            raise Error("Connection already returned to the pool")
+        return getattr(self._raw, name)
+
+    def cursor(self, *args, **kwargs):
+        cursor = self.__getattr__("cursor")(*args, **kwargs)
+        return InstrumentedCursor(cursor) if METRICS_ENABLED else cursor
+
+    def prepared(self, operation):
+        """(cursor, operation) with `operation` prepared on the physical connection, reused by later checkouts.
+
+        Execute the returned operation string: the driver only skips re-preparing when it is handed the
+        same object it prepared. The least recently used statement is closed past DB_PREPARED_STATEMENTS.
+        """
+        raw = self._raw
+        if raw is None:
+            raise Error("Connection already returned to the pool")
+        statements = getattr(raw, "_billing_statements", None)
+        if statements is None:
+            statements = raw._billing_statements = OrderedDict()
+        entry = statements.get(operation)
+        if entry is None:
+            entry = statements[operation] = (operation, raw.cursor(prepared=True))
+            while len(statements) > DB_PREPARED_STATEMENTS:
+                _, (_, evicted) = statements.popitem(last=False)
+                try:
+                    evicted.close()
+                except Exception:
+                    pass
+        else:
+            statements.move_to_end(operation)
+        operation, cursor = entry
+        return (InstrumentedCursor(cursor) if METRICS_ENABLED else cursor), operation
+
+    def close(self):
+        if self._raw is not None:
+            raw, self._raw = self._raw, None
+            self._pool.release(raw, self._created_at)
+
+    def discard(self):
+        """Disconnect instead of pooling, e.g. when an unbuffered result set was abandoned half-read."""
+        if self._raw is not None:
+            raw, self._raw = self._raw, None
+            self._pool.discard(raw)
+
+
+class ConnectionPool:
+    """Bounded per-process MySQL pool with blocking checkout, liveness checks and usage stats.
+
+    Connections are opened lazily on first use in each process; state inherited across fork() is
+    discarded so gunicorn workers never share sockets with the master.
+    """
+
+    def __init__(self, factory=open_connection, min_size=DB_POOL_MIN, max_size=DB_POOL_SIZE,
+                 timeout=DB_POOL_TIMEOUT, recycle=DB_POOL_RECYCLE, ping_after=DB_POOL_PING_AFTER,
+                 max_waiters=DB_POOL_MAX_WAITERS):
+        self.factory = factory
+        self.min_size = min(min_size, max_size)
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_waiters = max_waiters
+        self.recycle = recycle
+        self.ping_after = ping_after
+        # Sockets inherited from the parent; referenced forever so their __del__ never shuts them down
+        self._inherited = []
+        self._reset()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._cond = threading.Condition()
+        self._idle = []  # (raw, created_at, last_used), most recently used last
+        self._size = 0
+        self._in_use = 0
+        self._waiting = 0
+        self._warmed = False
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.recycled = 0
+        self.wait_buckets = [0] * (len(POOL_WAIT_BUCKETS_MS) + 1)
+        self.wait_sum = 0.0
+
+    def _after_fork(self):
+        self._inherited.extend(raw for raw, _, _ in self._idle)
+        self._reset()
+
+    def _open(self):
+        raw = self.factory()
+        if raw is None:
+            raise DatabaseUnavailable("Database connection failed")
+        return raw, time.monotonic()
+
+    def _close_quietly(self, raw):
+        try:
+            raw.close()
         except Exception:
             pass
+
+    def _warm(self):
+        self._warmed = True
+        opened = []
+        try:
+            for _ in range(self.min_size):
+                with self._cond:
+                    if self._size >= self.min_size:
+                        break
+                    self._size += 1
+                try:
+                    opened.append(self._open())
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                    raise
+        except Exception as e:
+            print(f"⚠️ Could not pre-open pool connections: {e}")
+        finally:
+            with self._cond:
+                now = time.monotonic()
+                self._idle.extend((raw, created_at, now) for raw, created_at in opened)
+                self._cond.notify_all()
+
+    def _record_wait(self, waited):
+        ms = waited * 1000
+        for index, bound in enumerate(POOL_WAIT_BUCKETS_MS):
+            if ms <= bound:
+                break
+        else:
+            index = len(POOL_WAIT_BUCKETS_MS)
+        self.wait_buckets[index] += 1
+        self.wait_sum += waited
+
+    def checkout(self, timeout=None):
+        """Borrow a live connection, waiting up to `timeout` seconds for one to be released."""
+        if self._pid != os.getpid():
+            self._after_fork()
+        if not self._warmed:
+            self._warm()
+        timeout = self.timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+        entry = None
+        with self._cond:
+            while True:
+                if self._idle:
+                    entry = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1  # reserve a slot, connect outside the lock
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    self.checkout_failures += 1
+                    self._record_wait(time.monotonic() - started)
+                    raise PoolTimeout(f"No database connection available within {timeout:g}s")
+                if self.max_waiters and self._waiting >= self.max_waiters:
+                    # Shed load instead of growing the queue: these requests would mostly time out anyway
+                    self.rejected += 1
+                    self.checkout_failures += 1
+                    raise PoolSaturated("Server busy: too many requests waiting for a database connection")
+                self._waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+            self._in_use += 1
+            self.checkouts += 1
+            self._record_wait(time.monotonic() - started)
+        try:
+            raw, created_at = self._validate(entry) if entry is not None else self._open()
+        except Exception as e:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self.checkout_failures += 1
+                self._cond.notify()
+            if isinstance(e, DatabaseUnavailable):
+                raise
+            raise DatabaseUnavailable(f"Database connection failed: {e}") from e
+        return PooledConnection(self, raw, created_at)
+
+    def _validate(self, entry):
+        raw, created_at, last_used = entry
+        now = time.monotonic()
+        if now - created_at > self.recycle:
+            self.recycled += 1
+            self._close_quietly(raw)
+            return self._open()
+        if now - last_used > self.ping_after:
+            try:
+                raw.ping(reconnect=False)
+            except Exception:
+                self.recycled += 1
+                self._close_quietly(raw)
+                return self._open()
+        return raw, created_at
+
+    def release(self, raw, created_at):
+        if self._pid != os.getpid():
+            self._inherited.append(raw)
+            return
+        broken = False
+        try:
+            # Never hand the next borrower someone else's open transaction
+            if raw.in_transaction:
+                raw.rollback()
+        except Exception:
+            broken = True
+        with self._cond:
+            self._in_use -= 1
+            if broken:
+                self._size -= 1
+            else:
+                self._idle.append((raw, created_at, time.monotonic()))
+            self._cond.notify()
+        if broken:
+            self._close_quietly(raw)
+
+    def discard(self, raw):
+        """Give up a checked-out connection's slot and close it rather than returning it to the idle list."""
+        if self._pid != os.getpid():
+            self._inherited.append(raw)
+            return
+        with self._cond:
+            self._in_use -= 1
+            self._size -= 1
+            self._cond.notify()
+        self._close_quietly(raw)
+
+    def dispose(self):
+        """Close idle connections (e.g. in a preloading master before workers fork)."""
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._warmed = False
+        for raw, _, _ in idle:
+            self._close_quietly(raw)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                "waiting": self._waiting,
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "checkouts": self.checkouts,
+                "checkout_failures": self.checkout_failures,
+                "timeouts": self.timeouts,
+                "rejected": self.rejected,
+                "recycled": self.recycled,
+                "wait_histogram_ms": dict(zip([str(b) for b in POOL_WAIT_BUCKETS_MS] + ["+Inf"], self.wait_buckets)),
+                "wait_seconds_sum": round(self.wait_sum, 6),
+            }
+
+
+DB_POOL = ConnectionPool()
+
+
+def execute_statement(conn, operation, params=()):
+    """Execute one statement and return its cursor, as a cached prepared statement when enabled.
+
+    Prepared cursors may hold an unread result set, so read SELECTs run this way with fetchall().
+    """
+    if DB_PREPARED_STATEMENTS > 0 and isinstance(conn, PooledConnection):
+        cursor, operation = conn.prepared(operation)
+    else:
+        cursor = conn.cursor()
+    cursor.execute(operation, params)
+    return cursor
+
+
+def create_connection():
+    """Check out a pooled connection; returns None (and logs) when none is available."""
+    try:
+        with timed("db_checkout"):
+            return DB_POOL.checkout()
+    except DatabaseUnavailable as e:
         print(f" Error while connecting to MySQL: {e}")
     return None
 
 
+@contextmanager
+def db_connection():
+    """Check out one pooled connection for the current request; nested uses within the request share it."""
+    if not has_request_context():
+        with timed("db_checkout"):
+            conn = DB_POOL.checkout()
+        try:
+            yield conn
+        finally:
+            conn.close()
+        return
+    conn = g.get("_db_conn")
+    if conn is not None:
+        yield conn
+        return
+    with timed("db_checkout"):
+        conn = DB_POOL.checkout()
+    g._db_conn = conn
+    try:
+        yield conn
+    finally:
+        g.pop("_db_conn", None)
+        conn.close()
+
+
+@app.errorhandler(DatabaseUnavailable)
+def database_unavailable(e):
+    response = jsonify({"error": str(e)})
+    response.headers["Retry-After"] = "1"
+    return response, 503
+
+
 def hash_password(password):
     """Hash a password using SHA-256"""
     return hashlib.sha256(password.encode()).hexdigest()
@@ -156,6 +740,9 @@ def create_users_table():
             conn.close()
     # Ensure firebase_uid column exists
     ensure_users_table_has_firebase_uid()
+    if SCHEMA_MODE == "tenant":
+        create_tenant_tables()
+    create_stats_tables()
 
 
 def create_user_tables(user_id, conn=None):
@@ -179,7 +766,12 @@ def create_user_tables(user_id, conn=None):
                     name VARCHAR(255) NOT NULL,
                     contact VARCHAR(255),
                     email VARCHAR(255),
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    customer_key VARCHAR(260) NULL,
+                    KEY idx_customers_name (name),
+                    KEY idx_customers_email (email),
+                    KEY idx_customers_contact (contact),
+                    UNIQUE KEY uq_customer_key (customer_key)
                 )
             """)
 
@@ -190,6 +782,7 @@ def create_user_tables(user_id, conn=None):
                     customer_id INT NOT NULL,
                     amount DECIMAL(10,2) NOT NULL,
                     date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    KEY idx_bills_date (date),
                     FOREIGN KEY (customer_id) REFERENCES {customers_table}(id) ON DELETE CASCADE
                 )
             """)
@@ -210,366 +803,3788 @@ def create_user_tables(user_id, conn=None):
         raise Exception("Database connection failed")
 
 
-# --- Users/table helpers (accept shared conn) ---
+# --- Schema layout ---
+# "per_user" keeps the original customers_{id}/bills_{id} pair per signup. "tenant" stores every
+# user's rows in one shared customers/bills pair keyed by user_id, so the table count stays constant.
+SCHEMA_MODE = os.getenv("SCHEMA_MODE", "per_user").lower()
+if SCHEMA_MODE not in ("per_user", "tenant"):
+    raise ValueError(f"SCHEMA_MODE must be 'per_user' or 'tenant', got {SCHEMA_MODE!r}")
+print(f"[DB] Using schema_mode={SCHEMA_MODE}")
 
-def get_or_create_sql_user(firebase_uid: str, email: str, conn=None) -> int:
-    """Return SQL users.id for given firebase_uid, creating row if needed, using shared conn when provided."""
+
+class TenantTables:
+    """Table names and row scoping for one user's customers/bills under a schema mode."""
+
+    def __init__(self, user_id, mode=None):
+        self.user_id = user_id
+        self.shared = (mode or SCHEMA_MODE) == "tenant"
+        if self.shared:
+            self.customers = "customers"
+            self.bills = "bills"
+            self.archive = "bills_archive"
+        else:
+            self.customers = f"customers_{user_id}"
+            self.bills = f"bills_{user_id}"
+            self.archive = f"bills_archive_{user_id}"
+
+    def scope(self, alias=None):
+        """Return (predicate, params) restricting rows to this user; a no-op for per-user tables.
+
+        TenantTables(None, mode="tenant") addresses the shared tables as a whole (maintenance jobs).
+        """
+        if not self.shared or self.user_id is None:
+            return "1=1", ()
+        column = f"{alias}.user_id" if alias else "user_id"
+        return f"{column} = %s", (self.user_id,)
+
+    def insert_sql(self, table, *columns):
+        """INSERT statement for `columns` of one of this user's tables; pair with row()."""
+        if self.shared:
+            columns = ("user_id",) + columns
+        return f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))})"
+
+    def row(self, *values):
+        return (self.user_id,) + values if self.shared else values
+
+
+def create_tenant_tables(conn=None):
+    """Create the shared customers/bills tables used when SCHEMA_MODE=tenant."""
     own_conn = False
     if conn is None:
         conn = create_connection()
         own_conn = True
     if not conn:
-        raise Exception("Database connection failed")
+        print("❌ Failed to connect to database to create tenant tables")
+        return
     try:
         cursor = conn.cursor()
-        cursor.execute("SELECT id FROM users WHERE firebase_uid = %s", (firebase_uid,))
-        row = cursor.fetchone()
-        if row:
-            return row[0]
-        placeholder = hash_password("firebase")
-        cursor.execute(
-            "INSERT INTO users (email, password_hash, firebase_uid) VALUES (%s, %s, %s)",
-            (email, placeholder, firebase_uid),
-        )
-        if own_conn:
-            conn.commit()
-        user_id = cursor.lastrowid
-        print(f"✅ Created SQL user {user_id} for Firebase uid {firebase_uid}")
-        return user_id
+        # legacy_id remembers the customers_{id}.id a row was migrated from so bills can be re-linked
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS customers (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                user_id INT NOT NULL,
+                name VARCHAR(255) NOT NULL,
+                contact VARCHAR(255),
+                email VARCHAR(255),
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                legacy_id INT NULL,
+                customer_key VARCHAR(260) NULL,
+                KEY idx_customers_user (user_id, id),
+                KEY idx_customers_legacy (user_id, legacy_id),
+                KEY idx_customers_name (user_id, name),
+                KEY idx_customers_email (user_id, email),
+                KEY idx_customers_contact (user_id, contact),
+                UNIQUE KEY uq_customer_key (user_id, customer_key)
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS bills (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                user_id INT NOT NULL,
+                customer_id INT NOT NULL,
+                amount DECIMAL(10,2) NOT NULL,
+                date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                KEY idx_bills_user_date (user_id, date),
+                KEY idx_bills_user_customer (user_id, customer_id),
+                FOREIGN KEY (customer_id) REFERENCES customers(id) ON DELETE CASCADE
+            )
+        """)
+        cursor.execute("""
+            SELECT COUNT(*) FROM information_schema.COLUMNS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'customers' AND COLUMN_NAME = 'customer_key'
+        """)
+        if cursor.fetchone()[0] == 0:
+            add_customer_key_column(cursor, TenantTables(None, mode="tenant"))
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS tenant_migration (
+                user_id INT PRIMARY KEY,
+                last_customer_id INT NOT NULL DEFAULT 0,
+                last_bill_id INT NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+            )
+        """)
+        conn.commit()
+        print("Tenant tables created/verified successfully")
+    except Exception as e:
+        print(f"Error creating tenant tables: {e}")
     finally:
-        if own_conn and conn:
+        if own_conn:
             conn.close()
 
 
-# Cache of provisioned user_ids to avoid repeated ensure work
-PROVISIONED_USERS = set()
+def legacy_tenant_ids(cursor):
+    """user_ids that still have a customers_{id}/bills_{id} pair, from one information_schema query."""
+    cursor.execute("""
+        SELECT TABLE_NAME FROM information_schema.TABLES
+        WHERE TABLE_SCHEMA = DATABASE()
+          AND (TABLE_NAME LIKE 'customers\\_%' OR TABLE_NAME LIKE 'bills\\_%')
+    """)
+    customers, bills = set(), set()
+    for (name,) in cursor.fetchall():
+        prefix, _, suffix = name.partition("_")
+        if suffix.isdigit():
+            (customers if prefix == "customers" else bills).add(int(suffix))
+    return sorted(customers & bills)
 
 
-def provision_user_with_conn(conn, firebase_uid: str, email: str) -> int:
-    """With an existing conn, map/create SQL user and ensure per-user tables; cache to avoid repeats."""
-    cursor = conn.cursor()
-    # Map/create user
-    cursor.execute("SELECT id FROM users WHERE firebase_uid = %s", (firebase_uid,))
-    row = cursor.fetchone()
-    if row:
-        user_id = row[0]
-    else:
-        placeholder = hash_password("firebase")
-        cursor.execute(
-            "INSERT INTO users (email, password_hash, firebase_uid) VALUES (%s, %s, %s)",
-            (email, placeholder, firebase_uid),
-        )
-        user_id = cursor.lastrowid
-        print(f"✅ Created SQL user {user_id} for Firebase uid {firebase_uid}")
-    # Ensure tables only once per process lifetime
-    if user_id not in PROVISIONED_USERS:
-        cursor.execute(f"SHOW TABLES LIKE 'customers_{user_id}'")
-        customers_exists = cursor.fetchone()
-        cursor.execute(f"SHOW TABLES LIKE 'bills_{user_id}'")
-        bills_exists = cursor.fetchone()
-        if not customers_exists or not bills_exists:
-            create_user_tables(user_id, conn=conn)
-        PROVISIONED_USERS.add(user_id)
-    return user_id
+def migrate_tenant(conn, user_id, batch_size=1000, pause=0.0):
+    """Copy one user's customers_{id}/bills_{id} rows into the shared tables in committed batches.
 
+    Progress is stored in tenant_migration in the same transaction as each batch, so the copy can be
+    interrupted and re-run; rows added to the legacy tables since the last run are picked up.
+    Returns (customers_copied, bills_copied).
+    """
+    legacy = TenantTables(user_id, mode="per_user")
+    cursor = conn.cursor()
+    cursor.execute("INSERT IGNORE INTO tenant_migration (user_id) VALUES (%s)", (user_id,))
+    cursor.execute("SELECT last_customer_id, last_bill_id FROM tenant_migration WHERE user_id = %s", (user_id,))
+    last_customer_id, last_bill_id = cursor.fetchone()
+    conn.commit()
 
-# --- Auth middleware uses ONE shared connection ---
+    # Bills' high-water mark first: any bill up to it was written after its customer, so the customers
+    # mark read next covers every customer those bills join to (a bill for a customer created mid-copy
+    # would otherwise miss the JOIN while last_bill_id moved past it)
+    max_ids = {}
+    for label, table in (("bills", legacy.bills), ("customers", legacy.customers)):
+        cursor.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}")
+        max_ids[label] = cursor.fetchone()[0]
+    conn.commit()
 
-def require_firebase_auth(f):
-    @wraps(f)
-    def wrapper(*args, **kwargs):
-        auth_header = request.headers.get('Authorization', '')
-        if not auth_header.startswith('Bearer '):
-            return jsonify({"error": "Missing Authorization Bearer token"}), 401
-        id_token = auth_header.split(' ', 1)[1].strip()
-        # Only wrap token verification in try/except so route errors are not misreported as auth errors
-        try:
-            decoded = fb_auth.verify_id_token(id_token)
-        except fb_auth.InvalidIdTokenError as e:
-            return jsonify({"error": f"Invalid token: {str(e)}"}), 401
-        except Exception as e:
-            return jsonify({"error": f"Auth processing error: {str(e)}"}), 500
+    copied = [0, 0]
+    steps = (
+        ("customers", legacy.customers, "last_customer_id", """
+            INSERT INTO customers (user_id, legacy_id, name, contact, email, created_at)
+            SELECT %s, id, name, contact, email, created_at FROM {table}
+            WHERE id > %s AND id <= %s ORDER BY id
+        """),
+        ("bills", legacy.bills, "last_bill_id", """
+            INSERT INTO bills (user_id, customer_id, amount, date)
+            SELECT %s, c.id, b.amount, b.date FROM {table} b
+            JOIN customers c ON c.user_id = %s AND c.legacy_id = b.customer_id
+            WHERE b.id > %s AND b.id <= %s ORDER BY b.id
+        """),
+    )
+    for index, (label, table, progress_column, statement) in enumerate(steps):
+        low = last_customer_id if label == "customers" else last_bill_id
+        max_id = max_ids[label]
+        # Batches are primary-key ranges so each INSERT ... SELECT touches at most batch_size source rows
+        while low < max_id:
+            high = min(low + batch_size, max_id)
+            params = (user_id, low, high) if label == "customers" else (user_id, user_id, low, high)
+            cursor.execute(statement.format(table=table), params)
+            copied[index] += cursor.rowcount
+            cursor.execute(
+                f"UPDATE tenant_migration SET {progress_column} = %s WHERE user_id = %s", (high, user_id)
+            )
+            conn.commit()
+            low = high
+            if pause:
+                time.sleep(pause)
+    return tuple(copied)
 
-        firebase_uid = decoded.get('uid')
-        email = decoded.get('email', '')
-        if not firebase_uid:
-            return jsonify({"error": "Invalid token"}), 401
-        # Only attach firebase identity here; DB work happens inside endpoints with one connection
-        g.firebase_uid = firebase_uid
-        g.user_email = email
-        return f(*args, **kwargs)
-    return wrapper
 
+def verify_tenant(conn, user_id):
+    """Compare bill count and amount sum between a user's legacy tables and the shared tables."""
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT COUNT(*), COALESCE(SUM(amount), 0) FROM bills_{user_id}")
+    legacy = cursor.fetchone()
+    cursor.execute("SELECT COUNT(*), COALESCE(SUM(amount), 0) FROM bills WHERE user_id = %s", (user_id,))
+    shared = cursor.fetchone()
+    return tuple(legacy) == tuple(shared), legacy, shared
 
-# Create users table on startup (and ensure firebase_uid column)
-create_users_table()
 
+@app.cli.command("migrate-tenant-schema")
+@click.option("--batch-size", default=1000, show_default=True, help="Source rows copied per transaction.")
+@click.option("--pause", default=0.0, show_default=True, help="Seconds to sleep between batches.")
+@click.option("--user-id", "user_ids", type=int, multiple=True, help="Only migrate these users.")
+@click.option("--verify/--no-verify", default=True, show_default=True, help="Compare counts/sums afterwards.")
+def migrate_tenant_schema_command(batch_size, pause, user_ids, verify):
+    """Copy per-user customers_{id}/bills_{id} tables into the shared tenant tables.
 
-@app.route("/check-auth", methods=["GET"])
-@require_firebase_auth
-def check_auth():
-    # Open one connection and provision user
+    Safe to run while the app serves traffic in per_user mode and safe to re-run: each pass only copies
+    rows added since the previous one. Edits or deletes of already-copied rows are not replayed, so run a
+    final pass (and check --verify) with writes paused right before switching SCHEMA_MODE=tenant.
+    """
     conn = create_connection()
     if not conn:
-        return jsonify({"error": "Database connection failed"}), 500
+        raise click.ClickException("Database connection failed")
     try:
-        user_id = provision_user_with_conn(conn, g.firebase_uid, g.user_email)
-        conn.commit()
-        return jsonify({
-            "authenticated": True,
-            "user": {"id": user_id, "email": g.user_email}
-        }), 200
-    except Exception as e:
-        conn.rollback()
-        return jsonify({"error": str(e)}), 500
+        create_tenant_tables(conn)
+        cursor = conn.cursor()
+        targets = list(user_ids) or legacy_tenant_ids(cursor)
+        click.echo(f"Migrating {len(targets)} tenant(s) in batches of {batch_size}")
+        mismatched = []
+        for user_id in targets:
+            customers_copied, bills_copied = migrate_tenant(conn, user_id, batch_size, pause)
+            click.echo(f"  user {user_id}: +{customers_copied} customers, +{bills_copied} bills")
+            if verify:
+                ok, legacy, shared = verify_tenant(conn, user_id)
+                if not ok:
+                    mismatched.append(user_id)
+                    click.echo(f"  ⚠️ user {user_id}: legacy (count, sum)={legacy} shared={shared}")
+        if mismatched:
+            raise click.ClickException(f"{len(mismatched)} tenant(s) differ after copy: {mismatched}")
+        click.echo("✅ Tenant schema migration complete")
     finally:
         conn.close()
 
 
-@app.route("/db", methods=["GET"])
-def db_check():
-    conn = create_connection()
-    if conn:
-        conn.close()
-        return jsonify({"status": "success", "message": "Connected to MySQL database successfully."})
-    else:
-        return jsonify({"status": "error", "message": "Failed to connect to MySQL database."}), 500
-
-
-@app.route("/get_bills", methods=["GET"])
-@require_firebase_auth
-def get_bills():
+@app.cli.command("add-bill-indexes")
+def add_bill_indexes_command():
+    """Add the (date) index used by /get_bills pagination to existing bills_{id} tables."""
     conn = create_connection()
-    if conn is None:
-        return jsonify({"status": "error", "message": "Failed to connect to database."}), 500
+    if not conn:
+        raise click.ClickException("Database connection failed")
     try:
-        user_id = provision_user_with_conn(conn, g.firebase_uid, g.user_email)
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute(f"""
-            SELECT b.id, c.name, c.contact, c.email, b.amount, b.date
-            FROM bills_{user_id} b
-            JOIN customers_{user_id} c ON b.customer_id = c.id
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT DISTINCT TABLE_NAME FROM information_schema.STATISTICS
+            WHERE TABLE_SCHEMA = DATABASE() AND INDEX_NAME = 'idx_bills_date'
         """)
-        bills = cursor.fetchall()
-        return jsonify(bills)
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        indexed = {name for (name,) in cursor.fetchall()}
+        missing = [user_id for user_id in legacy_tenant_ids(cursor) if f"bills_{user_id}" not in indexed]
+        click.echo(f"Adding idx_bills_date to {len(missing)} table(s)")
+        for user_id in missing:
+            cursor.execute(f"ALTER TABLE bills_{user_id} ADD INDEX idx_bills_date (date)")
+        click.echo("✅ Bill indexes up to date")
     finally:
         conn.close()
 
 
-@app.route("/add_bill", methods=["POST"])
-@require_firebase_auth
-def add_bill():
-    data = request.json
-    name, contact, email, amount = data["name"], data["contact"], data["email"], data["amount"]
+@app.cli.command("add-search-indexes")
+def add_search_indexes_command():
+    """Add the name/email/contact indexes used by /search to existing customers tables."""
     conn = create_connection()
     if not conn:
-        return jsonify({"error": "Database connection failed"}), 500
+        raise click.ClickException("Database connection failed")
     try:
-        user_id = provision_user_with_conn(conn, g.firebase_uid, g.user_email)
         cursor = conn.cursor()
-        cursor.execute(f"INSERT INTO customers_{user_id} (name, contact, email) VALUES (%s, %s, %s)", (name, contact, email))
-        customer_id = cursor.lastrowid
-        cursor.execute(f"INSERT INTO bills_{user_id} (customer_id, amount) VALUES (%s, %s)", (customer_id, amount))
-        conn.commit()
-        return jsonify({"message": "Bill added successfully"}), 201
-    except Exception as e:
-        conn.rollback()
-        return jsonify({"error": str(e)}), 500
-    finally:
+        cursor.execute("""
+            SELECT DISTINCT TABLE_NAME FROM information_schema.STATISTICS
+            WHERE TABLE_SCHEMA = DATABASE() AND INDEX_NAME = 'idx_customers_name'
+        """)
+        indexed = {name for (name,) in cursor.fetchall()}
+        targets = [TenantTables(user_id, mode="per_user") for user_id in legacy_tenant_ids(cursor)]
+        cursor.execute("SHOW TABLES LIKE 'customers'")
+        if cursor.fetchone():
+            targets.append(TenantTables(None, mode="tenant"))
+        missing = [tables for tables in targets if tables.customers not in indexed]
+        click.echo(f"Adding search indexes to {len(missing)} table(s)")
+        for tables in missing:
+            owner = "user_id, " if tables.shared else ""
+            cursor.execute(
+                f"ALTER TABLE {tables.customers} ADD INDEX idx_customers_name ({owner}name), "
+                f"ADD INDEX idx_customers_email ({owner}email), ADD INDEX idx_customers_contact ({owner}contact)"
+            )
+        click.echo("✅ Search indexes up to date")
+    finally:
+        conn.close()
+
+
+# --- Customer deduplication ---
+# Customers are identified by a normalized key (lowercased email, else the digits of the contact) with a
+# unique index, so add_bill reuses the existing row instead of creating one customer per bill.
+
+def customer_key(contact, email):
+    """Normalized dedupe key for a customer, or None when it has neither email nor contact."""
+    email = (email or "").strip().lower()
+    if email:
+        return f"e:{email}"
+    contact = (contact or "").strip()
+    digits = re.sub(r"\D", "", contact)
+    if digits:
+        return f"c:{digits}"
+    return f"c:{contact.lower()}" if contact else None
+
+
+def add_customer_key_column(cursor, tables):
+    """Add customer_key to a pre-dedupe customers table; the index stays non-unique until compact-customers runs."""
+    owner = "user_id, " if tables.shared else ""
+    cursor.execute(
+        f"ALTER TABLE {tables.customers} ADD COLUMN customer_key VARCHAR(260) NULL, "
+        f"ADD KEY idx_customer_key ({owner}customer_key)"
+    )
+
+
+def upsert_customer(conn, tables, name, contact, email):
+    """Insert a customer or refresh the one sharing its normalized key; returns (customer_id, created, changed).
+
+    changed is True when an existing customer's name/contact/email were overwritten.
+    """
+    key = customer_key(contact, email)
+    cursor = conn.cursor()
+    sql = tables.insert_sql(tables.customers, "name", "contact", "email", "customer_key")
+    if key is None:
+        cursor.execute(sql, tables.row(name, contact, email, None))
+        return cursor.lastrowid, True, False
+    # LAST_INSERT_ID(id) makes lastrowid report the existing row's id when the key already exists
+    cursor.execute(sql + """
+        ON DUPLICATE KEY UPDATE
+            id = LAST_INSERT_ID(id), name = VALUES(name), contact = VALUES(contact), email = VALUES(email)
+    """, tables.row(name, contact, email, key))
+    # Affected rows: 1 = inserted, 2 = existing row changed, 0 = existing row unchanged
+    return cursor.lastrowid, cursor.rowcount == 1, cursor.rowcount == 2
+
+
+def backfill_customer_keys(conn, tables, batch_size=1000, pause=0.0):
+    """Compute customer_key for rows that predate it, walking primary-key ranges; returns rows updated."""
+    cursor = conn.cursor()
+    where, params = tables.scope()
+    cursor.execute(f"SELECT COALESCE(MAX(id), 0) FROM {tables.customers} WHERE {where}", params)
+    max_id = cursor.fetchone()[0]
+    low, updated = 0, 0
+    while low < max_id:
+        high = low + batch_size
+        cursor.execute(
+            f"SELECT id, contact, email FROM {tables.customers} "
+            f"WHERE {where} AND id > %s AND id <= %s AND customer_key IS NULL",
+            params + (low, high),
+        )
+        keyed = [(customer_key(contact, email), customer_id) for customer_id, contact, email in cursor.fetchall()]
+        keyed = [(key, customer_id) for key, customer_id in keyed if key is not None]
+        if keyed:
+            cursor.executemany(f"UPDATE {tables.customers} SET customer_key = %s WHERE id = %s", keyed)
+            updated += len(keyed)
+        conn.commit()
+        low = high
+        if pause:
+            time.sleep(pause)
+    return updated
+
+
+def merge_duplicate_customers(conn, tables, batch_size=100, pause=0.0):
+    """Fold customers sharing a key into the oldest one, repointing their bills first; returns rows merged.
+
+    Each transaction handles at most batch_size duplicate groups so row locks are held briefly.
+    With TenantTables(None, mode="tenant") it sweeps every tenant in the shared table.
+    """
+    cursor = conn.cursor()
+    owner = "user_id, " if tables.shared else ""
+    where, params = tables.scope()
+    merged_total = 0
+    while True:
+        cursor.execute(f"""
+            SELECT {owner}customer_key, MIN(id) FROM {tables.customers}
+            WHERE {where} AND customer_key IS NOT NULL
+            GROUP BY {owner}customer_key HAVING COUNT(*) > 1
+            LIMIT %s
+        """, params + (batch_size,))
+        groups = cursor.fetchall()
+        if not groups:
+            return merged_total
+        merged_per_user = {}
+        for group in groups:
+            user_id, key, keep_id = group if tables.shared else (tables.user_id,) + tuple(group)
+            group_tables = TenantTables(user_id, mode="tenant" if tables.shared else "per_user")
+            scope, scope_params = group_tables.scope()
+            cursor.execute(f"""
+                UPDATE {group_tables.bills} SET customer_id = %s
+                WHERE {scope} AND customer_id IN (
+                    SELECT id FROM {group_tables.customers} WHERE {scope} AND customer_key = %s AND id <> %s
+                )
+            """, (keep_id,) + scope_params + scope_params + (key, keep_id))
+            cursor.execute(
+                f"DELETE FROM {group_tables.customers} WHERE {scope} AND customer_key = %s AND id <> %s",
+                scope_params + (key, keep_id),
+            )
+            merged_per_user[user_id] = merged_per_user.get(user_id, 0) + cursor.rowcount
+        for user_id, merged in merged_per_user.items():
+            user_tables = TenantTables(user_id, mode="tenant" if tables.shared else "per_user")
+            try:
+                apply_stats_delta(conn, user_tables, customers=-merged)
+            except AccountUnavailable:
+                pass  # queued for deletion; its summary goes with it
+            reset_change_feed(conn, user_tables)
+            merged_total += merged
+        conn.commit()
+        if pause:
+            time.sleep(pause)
+
+
+def ensure_unique_customer_key(conn, tables, batch_size=100):
+    """Swap the non-unique customer_key index for the unique one once duplicates are merged."""
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT INDEX_NAME FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME IN ('uq_customer_key', 'idx_customer_key')
+    """, (tables.customers,))
+    indexes = {name for (name,) in cursor.fetchall()}
+    if "uq_customer_key" in indexes:
+        return
+    owner = "user_id, " if tables.shared else ""
+    drop = ", DROP KEY idx_customer_key" if "idx_customer_key" in indexes else ""
+    for attempt in range(3):
+        try:
+            cursor.execute(f"ALTER TABLE {tables.customers} ADD UNIQUE KEY uq_customer_key ({owner}customer_key){drop}")
+            return
+        except mysql.connector.IntegrityError:
+            # New duplicates arrived between the merge and the ALTER; merge again and retry
+            merge_duplicate_customers(conn, tables, batch_size)
+    raise RuntimeError(f"Could not add unique customer_key index to {tables.customers}")
+
+
+@app.cli.command("compact-customers")
+@click.option("--batch-size", default=100, show_default=True, help="Duplicate groups merged per transaction.")
+@click.option("--pause", default=0.0, show_default=True, help="Seconds to sleep between batches.")
+@click.option("--user-id", "user_ids", type=int, multiple=True, help="Only compact these users (per_user mode).")
+def compact_customers_command(batch_size, pause, user_ids):
+    """Backfill customer keys, merge duplicate customers and enforce the unique customer_key index."""
+    conn = create_connection()
+    if not conn:
+        raise click.ClickException("Database connection failed")
+    try:
+        cursor = conn.cursor()
+        if SCHEMA_MODE == "tenant":
+            targets = [TenantTables(None, mode="tenant")]
+        else:
+            targets = [TenantTables(user_id) for user_id in (list(user_ids) or legacy_tenant_ids(cursor))]
+        total_merged = 0
+        for tables in targets:
+            cursor.execute("""
+                SELECT COUNT(*) FROM information_schema.COLUMNS
+                WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = 'customer_key'
+            """, (tables.customers,))
+            if cursor.fetchone()[0] == 0:
+                add_customer_key_column(cursor, tables)
+            backfilled = backfill_customer_keys(conn, tables, batch_size * 10, pause)
+            merged = merge_duplicate_customers(conn, tables, batch_size, pause)
+            ensure_unique_customer_key(conn, tables, batch_size)
+            total_merged += merged
+            click.echo(f"  {tables.customers}: keyed {backfilled}, merged {merged}")
+        click.echo(f"✅ Customer compaction complete ({total_merged} duplicate(s) merged)")
+    finally:
+        conn.close()
+
+
+# --- Per-user summary stats ---
+# user_stats holds running totals that mutations adjust in their own transaction, so /user-stats is a
+# primary-key lookup. With STATS_ROLLUPS=1, user_stats_daily also keeps per-day totals for trend charts.
+STATS_ROLLUPS = os.getenv("STATS_ROLLUPS", "0").lower() in ("1", "true", "yes", "on")
+
+
+def create_stats_tables(conn=None):
+    """Create the user_stats summary table (and the daily rollup, change log and bill archive state tables).
+
+    user_stats.version is bumped by every mutation of a user's data; read endpoints derive their ETag from it
+    and /changes uses it as the change sequence number.
+    """
+    own_conn = False
+    if conn is None:
+        conn = create_connection()
+        own_conn = True
+    if not conn:
+        print("❌ Failed to connect to database to create stats tables")
+        return
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS user_stats (
+                user_id INT PRIMARY KEY,
+                customer_count INT NOT NULL DEFAULT 0,
+                bill_count INT NOT NULL DEFAULT 0,
+                total_amount DECIMAL(14,2) NOT NULL DEFAULT 0,
+                version BIGINT NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+            )
+        """)
+        cursor.execute("""
+            SELECT COUNT(*) FROM information_schema.COLUMNS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'user_stats' AND COLUMN_NAME = 'version'
+        """)
+        if cursor.fetchone()[0] == 0:
+            cursor.execute("ALTER TABLE user_stats ADD COLUMN version BIGINT NOT NULL DEFAULT 0")
+            print("✅ Added version column to user_stats")
+        cursor.execute("""
+            SELECT COUNT(*) FROM information_schema.COLUMNS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'user_stats' AND COLUMN_NAME = 'changes_floor'
+        """)
+        if cursor.fetchone()[0] == 0:
+            cursor.execute("ALTER TABLE user_stats ADD COLUMN changes_floor BIGINT NOT NULL DEFAULT 0")
+            print("✅ Added changes_floor column to user_stats")
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS user_stats_daily (
+                user_id INT NOT NULL,
+                day DATE NOT NULL,
+                bill_count INT NOT NULL DEFAULT 0,
+                total_amount DECIMAL(14,2) NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, day)
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS bill_changes (
+                user_id INT NOT NULL,
+                seq BIGINT NOT NULL,
+                bill_id INT NOT NULL,
+                op CHAR(1) NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (user_id, seq, bill_id),
+                KEY idx_bill_changes_created (created_at)
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS bill_archive_state (
+                user_id INT PRIMARY KEY,
+                horizon DATETIME NOT NULL,
+                bill_count INT NOT NULL DEFAULT 0,
+                total_amount DECIMAL(14,2) NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+            )
+        """)
+        conn.commit()
+        print("Stats tables created/verified successfully")
+    except Exception as e:
+        print(f"Error creating stats tables: {e}")
+    finally:
+        if own_conn:
+            conn.close()
+
+
+class AccountUnavailable(Exception):
+    """The user id no longer belongs to an active account (unknown, or detached for deletion)."""
+
+
+def rebuild_user_stats(conn, tables):
+    """Recompute a user's summary (and daily rollups) from their customers/bills, in the caller's transaction.
+
+    Archived bills are counted from their totals in bill_archive_state rather than rescanned. Raises
+    AccountUnavailable instead of recreating the summary of an account that is gone or being deleted.
+    """
+    if not user_is_live(conn, tables.user_id):
+        if has_request_context() and g.get("firebase_uid"):
+            # This worker's cached identity is stale; the next request maps the uid afresh
+            IDENTITY_CACHE.invalidate(g.firebase_uid)
+        raise AccountUnavailable(f"Account {tables.user_id} has been deleted")
+    where, params = tables.scope()
+    state = archive_state(conn, tables)
+    archived_bills, archived_amount = (state[1], state[2]) if state else (0, 0)
+    cursor = conn.cursor()
+    cursor.execute(f"""
+        INSERT INTO user_stats (user_id, customer_count, bill_count, total_amount)
+        SELECT %s, (SELECT COUNT(*) FROM {tables.customers} WHERE {where}),
+            COUNT(*) + %s, COALESCE(SUM(amount), 0) + %s
+        FROM {tables.bills} WHERE {where}
+        ON DUPLICATE KEY UPDATE
+            customer_count = VALUES(customer_count),
+            bill_count = VALUES(bill_count),
+            total_amount = VALUES(total_amount),
+            version = version + 1
+    """, (tables.user_id,) + params + (archived_bills, archived_amount) + params)
+    if STATS_ROLLUPS:
+        history, history_params = bill_history_sql(tables, "date, amount", state is not None)
+        cursor.execute("DELETE FROM user_stats_daily WHERE user_id = %s", (tables.user_id,))
+        cursor.execute(f"""
+            INSERT INTO user_stats_daily (user_id, day, bill_count, total_amount)
+            SELECT %s, DATE(date), COUNT(*), SUM(amount) {history} GROUP BY DATE(date)
+        """, (tables.user_id,) + history_params)
+
+
+def apply_stats_delta(conn, tables, customers=0, bills=0, amount=0, day=None, daily=None):
+    """Adjust a user's running totals by a mutation's deltas.
+
+    `day` is the bill's date (today if None); bulk writes spanning several days pass `daily` instead,
+    a {date or None: (bill_delta, amount_delta)} mapping. Always bumps the user's data version, so call it
+    for mutations that leave the totals unchanged too.
+    """
+    cursor = execute_statement(conn, """
+        UPDATE user_stats
+        SET customer_count = customer_count + %s, bill_count = bill_count + %s, total_amount = total_amount + %s,
+            version = version + 1
+        WHERE user_id = %s
+    """, (customers, bills, amount, tables.user_id))
+    if cursor.rowcount == 0:
+        # No summary yet (first mutation since this feature shipped): the full rebuild already sees this change
+        rebuild_user_stats(conn, tables)
+        return
+    if STATS_ROLLUPS and (bills or amount):
+        if daily is None:
+            daily = {day: (bills, amount)}
+        cursor = conn.cursor()
+        cursor.executemany("""
+            INSERT INTO user_stats_daily (user_id, day, bill_count, total_amount)
+            VALUES (%s, COALESCE(%s, CURDATE()), %s, %s)
+            ON DUPLICATE KEY UPDATE
+                bill_count = bill_count + VALUES(bill_count),
+                total_amount = total_amount + VALUES(total_amount)
+        """, [(tables.user_id, bucket, count, total) for bucket, (count, total) in daily.items()])
+
+
+def user_data_version(conn, tables):
+    """The user's data version from user_stats, building the summary row first if it is missing."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT version FROM user_stats WHERE user_id = %s", (tables.user_id,))
+    row = cursor.fetchone()
+    if row is None:
+        rebuild_user_stats(conn, tables)
+        conn.commit()
+        cursor.execute("SELECT version FROM user_stats WHERE user_id = %s", (tables.user_id,))
+        row = cursor.fetchone()
+    return row[0]
+
+
+def log_bill_change(conn, tables, op, bill_id=None, customer_id=None):
+    """Record a bill change for /changes at the user's data version; call after apply_stats_delta.
+
+    op is "u" (added or changed) or "d" (deleted). Pass customer_id instead of bill_id to record every
+    bill of that customer, after an edit to the customer fields each bill shows.
+    """
+    if customer_id is None:
+        execute_statement(conn, """
+            INSERT INTO bill_changes (user_id, seq, bill_id, op)
+            SELECT user_id, version, %s, %s FROM user_stats WHERE user_id = %s
+        """, (bill_id, op, tables.user_id))
+        return
+    where, params = tables.scope("b")
+    execute_statement(conn, f"""
+        INSERT INTO bill_changes (user_id, seq, bill_id, op)
+        SELECT s.user_id, s.version, b.id, %s
+        FROM user_stats s JOIN {tables.bills} b ON b.customer_id = %s AND {where}
+        WHERE s.user_id = %s
+    """, (op, customer_id) + params + (tables.user_id,))
+
+
+def reset_change_feed(conn, tables):
+    """Send every client behind the current version to a resync; for bulk writes that are not itemized."""
+    execute_statement(conn, "UPDATE user_stats SET changes_floor = version WHERE user_id = %s", (tables.user_id,))
+
+
+@app.cli.command("reconcile-stats")
+@click.option("--user-id", "user_ids", type=int, multiple=True, help="Only rebuild these users.")
+def reconcile_stats_command(user_ids):
+    """Rebuild user_stats (and daily rollups when STATS_ROLLUPS=1) from the bills tables."""
+    conn = create_connection()
+    if not conn:
+        raise click.ClickException("Database connection failed")
+    try:
+        create_stats_tables(conn)
+        cursor = conn.cursor()
+        if not user_ids:
+            # Accounts queued for deletion are skipped; their summaries go with the rest of their rows
+            cursor.execute("SELECT id FROM users WHERE firebase_uid IS NOT NULL ORDER BY id")
+            user_ids = [row[0] for row in cursor.fetchall()]
+        if SCHEMA_MODE == "per_user":
+            present = set(legacy_tenant_ids(cursor))
+            user_ids = [user_id for user_id in user_ids if user_id in present]
+        rebuilt = 0
+        for user_id in user_ids:
+            try:
+                rebuild_user_stats(conn, TenantTables(user_id))
+            except AccountUnavailable as e:
+                conn.rollback()
+                click.echo(f"⚠️ Skipped user {user_id}: {e}")
+                continue
+            conn.commit()
+            rebuilt += 1
+        click.echo(f"✅ Rebuilt stats for {rebuilt} user(s)")
+    finally:
+        conn.close()
+
+
+# --- Bill archive ---
+# Bills dated before a horizon move, in throttled batches, from the hot bills table into a compressed
+# archive table that keeps a snapshot of the customer's details, so the hot table and its indexes only
+# hold recent history. bill_archive_state records each user's horizon and archived totals; user_stats keeps
+# counting archived bills, and /get_bills reads the archive only when a date range reaches behind the horizon.
+# Archived bills are read-only: update/delete of an archived id answers 404 like any missing bill.
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "365"))
+ARCHIVE_ROW_FORMAT = os.getenv("ARCHIVE_ROW_FORMAT", "COMPRESSED")
+
+
+def create_archive_table(cursor, tables):
+    """Create the archive table for `tables` (per user, or the shared one in tenant mode) if it is missing."""
+    owner = "user_id, " if tables.shared else ""
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {tables.archive} (
+            id INT PRIMARY KEY,
+            {"user_id INT NOT NULL," if tables.shared else ""}
+            customer_id INT NOT NULL,
+            customer_name VARCHAR(255) NOT NULL,
+            customer_contact VARCHAR(255),
+            customer_email VARCHAR(255),
+            amount DECIMAL(10,2) NOT NULL,
+            date TIMESTAMP NULL,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            KEY idx_archive_date ({owner}date),
+            KEY idx_archive_customer ({owner}customer_id)
+        ) ROW_FORMAT={ARCHIVE_ROW_FORMAT}
+    """)
+
+
+def archive_state(conn, tables):
+    """(horizon, bill_count, total_amount) of a user's archive, or None if nothing was archived."""
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT horizon, bill_count, total_amount FROM bill_archive_state WHERE user_id = %s", (tables.user_id,)
+    )
+    return cursor.fetchone()
+
+
+def bill_history_sql(tables, columns, archived):
+    """FROM/WHERE clause (and params) over a user's bills, with the archived ones merged in if `archived`."""
+    where, params = tables.scope()
+    if not archived:
+        return f"FROM {tables.bills} WHERE {where}", params
+    return f"""FROM (
+        SELECT {columns} FROM {tables.bills} WHERE {where}
+        UNION ALL SELECT {columns} FROM {tables.archive} WHERE {where}
+    ) AS history""", params + params
+
+
+def reads_archive(conn, tables, filters):
+    """Whether a /get_bills date range starts before the user's archive horizon (no range: hot bills only)."""
+    if "from" not in filters and "to" not in filters:
+        return False
+    state = archive_state(conn, tables)
+    if state is None:
+        return False
+    return "from" not in filters or filters["from"].replace(tzinfo=None) < state[0]
+
+
+def archive_bills(conn, tables, cutoff, batch_size=1000, pause=0.0):
+    """Move one user's bills dated before `cutoff` into their archive table in committed batches.
+
+    Each batch takes the oldest rows off the (date) index, copies them with their customer's details,
+    deletes them from the hot table and advances bill_archive_state in one transaction, so an interrupted
+    run loses nothing and can simply be re-run. user_stats totals stay as they are; the data version is
+    bumped and /changes clients are sent to a resync. Returns the number of bills moved.
+    """
+    where, params = tables.scope("b")
+    owner, owner_column = ("user_id, ", "b.user_id, ") if tables.shared else ("", "")
+    cursor = conn.cursor()
+    create_archive_table(cursor, tables)
+    moved = 0
+    while True:
+        cursor.execute(f"""
+            SELECT b.id, b.amount FROM {tables.bills} b
+            WHERE {where} AND b.date < %s
+            ORDER BY b.date, b.id LIMIT %s FOR UPDATE
+        """, params + (cutoff, batch_size))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        ids = tuple(bill_id for bill_id, _ in rows)
+        placeholders = ", ".join(["%s"] * len(ids))
+        cursor.execute(f"""
+            INSERT INTO {tables.archive}
+                (id, {owner}customer_id, customer_name, customer_contact, customer_email, amount, date)
+            SELECT b.id, {owner_column}b.customer_id, c.name, c.contact, c.email, b.amount, b.date
+            FROM {tables.bills} b JOIN {tables.customers} c ON c.id = b.customer_id
+            WHERE b.id IN ({placeholders})
+        """, ids)
+        cursor.execute(f"DELETE FROM {tables.bills} WHERE id IN ({placeholders})", ids)
+        cursor.execute("""
+            INSERT INTO bill_archive_state (user_id, horizon, bill_count, total_amount)
+            VALUES (%s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE
+                horizon = GREATEST(horizon, VALUES(horizon)),
+                bill_count = bill_count + VALUES(bill_count),
+                total_amount = total_amount + VALUES(total_amount)
+        """, (tables.user_id, cutoff, len(ids), sum(amount for _, amount in rows)))
+        apply_stats_delta(conn, tables)
+        reset_change_feed(conn, tables)
+        conn.commit()
+        moved += len(ids)
+        if pause:
+            time.sleep(pause)
+    return moved
+
+
+@app.cli.command("archive-bills")
+@click.option("--older-than-days", default=ARCHIVE_AFTER_DAYS, show_default=True,
+              help="Archive bills dated before midnight this many days ago.")
+@click.option("--batch-size", default=1000, show_default=True, help="Bills moved per transaction.")
+@click.option("--pause", default=0.0, show_default=True, help="Seconds to sleep between batches.")
+@click.option("--user-id", "user_ids", type=int, multiple=True, help="Only archive these users.")
+def archive_bills_command(older_than_days, batch_size, pause, user_ids):
+    """Move old bills out of the hot bills tables into the compressed archive tables.
+
+    Safe to run while the app serves traffic and to re-run, e.g. nightly from cron. Run it after
+    migrate-tenant-schema, not before: the tenant migration copies hot bills only.
+    """
+    conn = create_connection()
+    if not conn:
+        raise click.ClickException("Database connection failed")
+    try:
+        create_stats_tables(conn)
+        cursor = conn.cursor()
+        if not user_ids:
+            if SCHEMA_MODE == "tenant":
+                cursor.execute("SELECT id FROM users ORDER BY id")
+                user_ids = [row[0] for row in cursor.fetchall()]
+            else:
+                user_ids = legacy_tenant_ids(cursor)
+        cutoff = (datetime.now() - timedelta(days=older_than_days)).replace(hour=0, minute=0, second=0, microsecond=0)
+        total = 0
+        for user_id in user_ids:
+            moved = archive_bills(conn, TenantTables(user_id), cutoff, batch_size, pause)
+            if moved:
+                click.echo(f"  user {user_id}: archived {moved} bill(s)")
+            total += moved
+        click.echo(f"✅ Archived {total} bill(s) dated before {cutoff.date()}")
+    finally:
+        conn.close()
+
+
+# --- Users/table helpers (accept shared conn) ---
+
+def get_or_create_sql_user(firebase_uid: str, email: str, conn=None) -> int:
+    """Return SQL users.id for given firebase_uid, creating row if needed, using shared conn when provided."""
+    cached = IDENTITY_CACHE.get(firebase_uid)
+    if cached is not None:
+        return cached[0]
+    own_conn = False
+    if conn is None:
+        conn = create_connection()
+        own_conn = True
+    if not conn:
+        raise Exception("Database connection failed")
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id FROM users WHERE firebase_uid = %s", (firebase_uid,))
+        row = cursor.fetchone()
+        if row:
+            IDENTITY_CACHE.put(firebase_uid, row[0], provisioned=False)
+            return row[0]
+        placeholder = hash_password("firebase")
+        cursor.execute(
+            "INSERT INTO users (email, password_hash, firebase_uid) VALUES (%s, %s, %s)",
+            (email, placeholder, firebase_uid),
+        )
+        if own_conn:
+            conn.commit()
+        user_id = cursor.lastrowid
+        print(f"✅ Created SQL user {user_id} for Firebase uid {firebase_uid}")
+        return user_id
+    finally:
+        if own_conn and conn:
+            conn.close()
+
+
+# --- Identity cache (firebase_uid -> users.id) ---
+IDENTITY_CACHE_SIZE = int(os.getenv("IDENTITY_CACHE_SIZE", "10000"))
+IDENTITY_CACHE_TTL = float(os.getenv("IDENTITY_CACHE_TTL", "600"))
+# Optional SQLite file shared by every gunicorn worker on the host so workers don't warm up separately
+IDENTITY_CACHE_PATH = os.getenv("IDENTITY_CACHE_PATH")
+
+
+class SharedIdentityStore:
+    """SQLite-backed firebase_uid -> (user_id, provisioned) map shared between worker processes."""
+
+    def __init__(self, path, ttl=IDENTITY_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._local = os_thread_local()
+        self._puts = 0
+        self._conn().execute("""
+            CREATE TABLE IF NOT EXISTS identities (
+                firebase_uid TEXT PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                provisioned INTEGER NOT NULL,
+                stored_at REAL NOT NULL
+            )
+        """)
+
+    def _conn(self):
+        # One sqlite connection per OS thread (shared by its greenlets), reopened after fork
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, firebase_uid):
+        row = self._conn().execute(
+            "SELECT user_id, provisioned, stored_at FROM identities WHERE firebase_uid = ?", (firebase_uid,)
+        ).fetchone()
+        if row is None or row[2] + self.ttl <= time.time():
+            return None
+        return row[0], bool(row[1])
+
+    def put(self, firebase_uid, user_id, provisioned):
+        self._conn().execute(
+            "INSERT OR REPLACE INTO identities (firebase_uid, user_id, provisioned, stored_at) VALUES (?, ?, ?, ?)",
+            (firebase_uid, user_id, int(provisioned), time.time()),
+        )
+        self._puts += 1
+        if self._puts % 1000 == 0:
+            # get() already ignores expired rows; this only keeps the file from growing with every uid ever seen
+            self.purge_expired()
+
+    def delete(self, firebase_uid):
+        self._conn().execute("DELETE FROM identities WHERE firebase_uid = ?", (firebase_uid,))
+
+    def purge_expired(self):
+        self._conn().execute("DELETE FROM identities WHERE stored_at <= ?", (time.time() - self.ttl,))
+
+
+class IdentityCache:
+    """Bounded, TTL-evicting LRU of firebase_uid -> (user_id, provisioned) in front of an optional shared store."""
+
+    def __init__(self, maxsize=IDENTITY_CACHE_SIZE, ttl=IDENTITY_CACHE_TTL, shared=None, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.shared = shared
+        self.clock = clock
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # firebase_uid -> (expires_at, user_id, provisioned)
+        self._lock = threading.Lock()
+
+    def get(self, firebase_uid):
+        with self._lock:
+            entry = self._entries.get(firebase_uid)
+            if entry is not None:
+                if entry[0] > self.clock():
+                    self._entries.move_to_end(firebase_uid)
+                    self.hits += 1
+                    return entry[1], entry[2]
+                del self._entries[firebase_uid]
+        if self.shared is not None:
+            try:
+                found = self.shared.get(firebase_uid)
+            except sqlite3.Error as e:
+                print(f"⚠️ Shared identity cache read failed: {e}")
+                found = None
+            if found is not None:
+                self._store(firebase_uid, *found)
+                with self._lock:
+                    self.shared_hits += 1
+                return found
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, firebase_uid, user_id, provisioned=True):
+        self._store(firebase_uid, user_id, provisioned)
+        if self.shared is not None:
+            try:
+                self.shared.put(firebase_uid, user_id, provisioned)
+            except sqlite3.Error as e:
+                print(f"⚠️ Shared identity cache write failed: {e}")
+
+    def _store(self, firebase_uid, user_id, provisioned):
+        with self._lock:
+            self._entries[firebase_uid] = (self.clock() + self.ttl, user_id, provisioned)
+            self._entries.move_to_end(firebase_uid)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, firebase_uid):
+        with self._lock:
+            self._entries.pop(firebase_uid, None)
+        if self.shared is not None:
+            try:
+                self.shared.delete(firebase_uid)
+            except sqlite3.Error as e:
+                print(f"⚠️ Shared identity cache delete failed: {e}")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+                "shared": self.shared is not None,
+            }
+
+
+IDENTITY_CACHE = IdentityCache(
+    shared=SharedIdentityStore(IDENTITY_CACHE_PATH) if IDENTITY_CACHE_PATH else None,
+)
+print(f"[Auth] Identity cache size={IDENTITY_CACHE_SIZE} ttl={IDENTITY_CACHE_TTL}s shared={IDENTITY_CACHE_PATH}")
+
+
+@instrumented("identity_check")
+def user_is_live(conn, user_id, firebase_uid=None):
+    """Whether user_id is still the account of firebase_uid (of any uid if None), share-locking its users row.
+
+    Deleting an account detaches its uid with an UPDATE of the same row, so it waits for the caller's
+    writes to commit, and a caller arriving after it sees the account gone.
+    """
+    cursor = conn.cursor()
+    if firebase_uid is None:
+        cursor.execute("SELECT 1 FROM users WHERE id = %s AND firebase_uid IS NOT NULL LOCK IN SHARE MODE", (user_id,))
+    else:
+        cursor.execute(
+            "SELECT 1 FROM users WHERE id = %s AND firebase_uid = %s LOCK IN SHARE MODE", (user_id, firebase_uid)
+        )
+    return cursor.fetchone() is not None
+
+
+@instrumented("provision")
+def provision_user_with_conn(conn, firebase_uid: str, email: str, for_write=False) -> int:
+    """With an existing conn, map/create SQL user and ensure per-user tables; warm identity cache skips both.
+
+    Cached mappings may be stale in other workers (an account deleted through another process), so
+    for_write=True routes revalidate a cache hit with one primary-key lookup before writing under it.
+    """
+    cached = IDENTITY_CACHE.get(firebase_uid)
+    if cached is not None and cached[1]:
+        if not for_write or user_is_live(conn, cached[0], firebase_uid):
+            return cached[0]
+        IDENTITY_CACHE.invalidate(firebase_uid)
+        cached = None
+    cursor = conn.cursor()
+    if cached is not None:
+        user_id = cached[0]
+    else:
+        # Map/create user
+        lock = " LOCK IN SHARE MODE" if for_write else ""
+        cursor.execute(f"SELECT id FROM users WHERE firebase_uid = %s{lock}", (firebase_uid,))
+        row = cursor.fetchone()
+        if row:
+            user_id = row[0]
+        else:
+            placeholder = hash_password("firebase")
+            cursor.execute(
+                "INSERT INTO users (email, password_hash, firebase_uid) VALUES (%s, %s, %s)",
+                (email, placeholder, firebase_uid),
+            )
+            user_id = cursor.lastrowid
+            # Commit the mapping now so a later rollback in the route can't leave a cached id pointing nowhere
+            conn.commit()
+            print(f"✅ Created SQL user {user_id} for Firebase uid {firebase_uid}")
+    # The shared tenant tables are created once at startup; only per-user tables need probing.
+    # One information_schema lookup answers both "do the tables exist" and "is customers up to date".
+    if SCHEMA_MODE == "per_user":
+        tables = TenantTables(user_id)
+        cursor.execute("""
+            SELECT TABLE_NAME, COLUMN_NAME FROM information_schema.COLUMNS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME IN (%s, %s) AND COLUMN_NAME IN ('id', 'customer_key')
+        """, (tables.customers, tables.bills))
+        found = set(cursor.fetchall())
+        if (tables.customers, "id") not in found or (tables.bills, "id") not in found:
+            create_user_tables(user_id, conn=conn)
+        elif (tables.customers, "customer_key") not in found:
+            add_customer_key_column(cursor, tables)
+    IDENTITY_CACHE.put(firebase_uid, user_id, provisioned=True)
+    return user_id
+
+
+# --- Verified token cache ---
+# verify_id_token checks the RS256 signature (and may refresh Google's public keys) on every call.
+# The dashboard fires several requests with the same ID token, so keep decoded claims until `exp`.
+AUTH_TOKEN_CACHE_ENABLED = os.getenv("AUTH_TOKEN_CACHE", "1").lower() not in ("0", "false", "no", "off")
+AUTH_TOKEN_CACHE_SIZE = int(os.getenv("AUTH_TOKEN_CACHE_SIZE", "4096"))
+
+
+class TokenCache:
+    """Thread-safe LRU of decoded ID tokens keyed by SHA-256 digest; entries expire at the token's exp claim."""
+
+    def __init__(self, maxsize=AUTH_TOKEN_CACHE_SIZE, clock=time.time):
+        self.maxsize = maxsize
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # digest -> (expires_at, decoded claims)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(id_token):
+        return hashlib.sha256(id_token.encode()).digest()
+
+    def get(self, id_token):
+        key = self._key(id_token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, decoded = entry
+            if expires_at <= self.clock():
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return decoded
+
+    def put(self, id_token, decoded):
+        try:
+            expires_at = float(decoded.get("exp"))
+        except (TypeError, ValueError):
+            return  # never cache a token we cannot expire
+        if expires_at <= self.clock() or self.maxsize <= 0:
+            return
+        key = self._key(id_token)
+        with self._lock:
+            self._entries[key] = (expires_at, decoded)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate_uid(self, firebase_uid):
+        """Drop every cached token belonging to firebase_uid (e.g. after account deletion)."""
+        with self._lock:
+            stale = [k for k, (_, decoded) in self._entries.items() if decoded.get("uid") == firebase_uid]
+            for k in stale:
+                del self._entries[k]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+TOKEN_CACHE = TokenCache() if AUTH_TOKEN_CACHE_ENABLED else None
+print(f"[Auth] Token cache enabled={AUTH_TOKEN_CACHE_ENABLED} size={AUTH_TOKEN_CACHE_SIZE}")
+
+
+class InvalidToken(Exception):
+    """The ID token was rejected by Firebase (bad signature, expired, wrong project...)."""
+
+
+def verify_id_token(id_token):
+    """Verify a Firebase ID token, reusing the decoded claims of a recently verified identical token."""
+    if TOKEN_CACHE is not None:
+        decoded = TOKEN_CACHE.get(id_token)
+        if decoded is not None:
+            return decoded
+    fb_auth = firebase_auth()
+    try:
+        decoded = fb_auth.verify_id_token(id_token)
+    except fb_auth.InvalidIdTokenError as e:
+        raise InvalidToken(str(e)) from e
+    if TOKEN_CACHE is not None:
+        TOKEN_CACHE.put(id_token, decoded)
+    return decoded
+
+
+# --- Per-user rate limiting ---
+RATE_LIMIT_RPS = float(os.getenv("RATE_LIMIT_RPS", "0"))  # sustained requests/s per firebase_uid; 0 disables
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "20"))
+RATE_LIMIT_SIZE = int(os.getenv("RATE_LIMIT_SIZE", "100000"))  # buckets kept in memory per worker
+# Optional SQLite file (put it on tmpfs, e.g. /dev/shm) so every worker on the host draws from one bucket
+RATE_LIMIT_PATH = os.getenv("RATE_LIMIT_PATH")
+# Tokens per request by endpoint (default 1): whole-account reads and imports cost more
+RATE_LIMIT_COSTS = {"view_all_users_data": 10, "bulk_add_bills": 5, "get_report": 2, "run_batch": 5}
+print(f"[RateLimit] rps={RATE_LIMIT_RPS} burst={RATE_LIMIT_BURST} shared={RATE_LIMIT_PATH}")
+
+
+def take_tokens(tokens, updated, now, rate, burst, cost):
+    """Refill a bucket to `now` and try to take `cost`; returns (tokens left, seconds to wait or 0)."""
+    tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+    cost = min(cost, burst)
+    if tokens >= cost:
+        return tokens - cost, 0.0
+    return tokens, (cost - tokens) / rate
+
+
+class SharedBucketStore:
+    """SQLite-backed token buckets shared between worker processes; each take is one IMMEDIATE transaction."""
+
+    def __init__(self, path, rate, burst):
+        self.path = path
+        self.rate = rate
+        self.burst = burst
+        self._local = os_thread_local()
+        self._takes = 0
+        self._conn().execute("""
+            CREATE TABLE IF NOT EXISTS buckets (
+                bucket_key TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated REAL NOT NULL
+            )
+        """)
+
+    def _conn(self):
+        # One sqlite connection per OS thread (shared by its greenlets), reopened after fork
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=1, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")  # buckets are disposable; never wait on fsync
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def take(self, key, cost):
+        conn = self._conn()
+        now = time.time()  # wall clock: monotonic clocks are not comparable across processes
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated FROM buckets WHERE bucket_key = ?", (key,)).fetchone()
+            tokens, wait = take_tokens(*(row or (self.burst, now)), now, self.rate, self.burst, cost)
+            conn.execute("INSERT OR REPLACE INTO buckets (bucket_key, tokens, updated) VALUES (?, ?, ?)",
+                         (key, tokens, now))
+            self._takes += 1
+            if self._takes % 1000 == 0:
+                # A bucket idle for burst / rate seconds is full again, so its row carries no state
+                conn.execute("DELETE FROM buckets WHERE updated < ?", (now - self.burst / self.rate,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+
+class RateLimiter:
+    """Per-key token buckets (`rate` tokens/s up to `burst`) in process memory or a shared store."""
+
+    def __init__(self, rate=RATE_LIMIT_RPS, burst=RATE_LIMIT_BURST, maxsize=RATE_LIMIT_SIZE, shared=None,
+                 clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self.shared = shared
+        self.clock = clock
+        self.allowed = 0
+        self.limited = 0
+        self._buckets = OrderedDict()  # key -> (tokens, updated), least recently used first
+        self._lock = threading.Lock()
+
+    def acquire(self, key, cost=1):
+        """Take `cost` tokens from key's bucket; returns 0 when allowed, else the seconds until it would be."""
+        wait = None
+        if self.shared is not None:
+            try:
+                wait = self.shared.take(key, cost)
+            except sqlite3.Error as e:
+                print(f"⚠️ Shared rate limit store failed, using local buckets: {e}")
+        with self._lock:
+            if wait is None:
+                now = self.clock()
+                tokens, updated = self._buckets.pop(key, (self.burst, now))
+                tokens, wait = take_tokens(tokens, updated, now, self.rate, self.burst, cost)
+                self._buckets[key] = (tokens, now)
+                while len(self._buckets) > self.maxsize:
+                    self._buckets.popitem(last=False)
+            if wait:
+                self.limited += 1
+            else:
+                self.allowed += 1
+        return wait
+
+    def stats(self):
+        with self._lock:
+            return {
+                "rate": self.rate,
+                "burst": self.burst,
+                "buckets": len(self._buckets),
+                "allowed": self.allowed,
+                "limited": self.limited,
+                "shared": self.shared is not None,
+            }
+
+
+RATE_LIMITER = None
+if RATE_LIMIT_RPS > 0:
+    RATE_LIMITER = RateLimiter(
+        shared=SharedBucketStore(RATE_LIMIT_PATH, RATE_LIMIT_RPS, RATE_LIMIT_BURST) if RATE_LIMIT_PATH else None,
+    )
+
+
+def rate_limited_response(retry_after):
+    response = jsonify({"error": "Too many requests, slow down"})
+    response.headers["Retry-After"] = str(max(1, math.ceil(retry_after)))
+    return response, 429
+
+
+# --- Auth middleware uses ONE shared connection ---
+
+def require_firebase_auth(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        auth_header = request.headers.get('Authorization', '')
+        if not auth_header.startswith('Bearer '):
+            return jsonify({"error": "Missing Authorization Bearer token"}), 401
+        id_token = auth_header.split(' ', 1)[1].strip()
+        # Only wrap token verification in try/except so route errors are not misreported as auth errors
+        try:
+            with timed("auth"):
+                decoded = verify_id_token(id_token)
+        except InvalidToken as e:
+            return jsonify({"error": f"Invalid token: {str(e)}"}), 401
+        except Exception as e:
+            return jsonify({"error": f"Auth processing error: {str(e)}"}), 500
+
+        firebase_uid = decoded.get('uid')
+        email = decoded.get('email', '')
+        if not firebase_uid:
+            return jsonify({"error": "Invalid token"}), 401
+        if RATE_LIMITER is not None:
+            retry_after = RATE_LIMITER.acquire(firebase_uid, RATE_LIMIT_COSTS.get(request.endpoint, 1))
+            if retry_after:
+                return rate_limited_response(retry_after)
+        # Only attach firebase identity here; DB work happens inside endpoints with one connection
+        g.firebase_uid = firebase_uid
+        g.user_email = email
+        return f(*args, **kwargs)
+    return wrapper
+
+
+@app.before_request
+def start_request_metrics():
+    if METRICS_ENABLED:
+        g._request_start = time.perf_counter()
+        g._timings = {}
+        g._query_count = 0
+
+
+@app.after_request
+def record_request_metrics(response):
+    # Streamed bodies are produced after this hook, so their latency covers the first byte only
+    start = g.pop("_request_start", None)
+    if start is None:
+        return response
+    elapsed = time.perf_counter() - start
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    METRICS.record_request(route, request.method, response.status_code, elapsed, g._query_count)
+    if SERVER_TIMING:
+        parts = [f"{phase};dur={seconds * 1000:.2f}" for phase, seconds in g._timings.items()]
+        parts.append(f'queries;desc="{g._query_count}"')
+        parts.append(f"total;dur={elapsed * 1000:.2f}")
+        response.headers["Server-Timing"] = ", ".join(parts)
+    return response
+
+
+@app.route("/check-auth", methods=["GET"])
+@require_firebase_auth
+def check_auth():
+    # Open one connection and provision user
+    with db_connection() as conn:
+        try:
+            user_id = provision_user_with_conn(conn, g.firebase_uid, g.user_email)
+            conn.commit()
+            return jsonify({
+                "authenticated": True,
+                "user": {"id": user_id, "email": g.user_email}
+            }), 200
+        except Exception as e:
+            conn.rollback()
+            return jsonify({"error": str(e)}), 500
+
+
+@app.route("/db", methods=["GET"])
+def db_check():
+    conn = create_connection()
+    if conn:
+        conn.close()
+        return jsonify({"status": "success", "message": "Connected to MySQL database successfully.",
+                        "pool": DB_POOL.stats(), "identity_cache": IDENTITY_CACHE.stats()})
+    else:
+        return jsonify({"status": "error", "message": "Failed to connect to MySQL database.",
+                        "pool": DB_POOL.stats(), "identity_cache": IDENTITY_CACHE.stats()}), 500
+
+
+# --- Conditional GET and response cache ---
+RESPONSE_CACHE_BYTES = int(os.getenv("RESPONSE_CACHE_BYTES", "0"))  # 0 disables the in-process body cache
+RESPONSE_CACHE_MAX_ENTRY = int(os.getenv("RESPONSE_CACHE_MAX_ENTRY", str(1024 * 1024)))  # larger bodies are not cached
+print(f"[Cache] response cache bytes={RESPONSE_CACHE_BYTES} max_entry={RESPONSE_CACHE_MAX_ENTRY}")
+
+
+class ResponseCache:
+    """LRU of serialized JSON bodies keyed by (user_id, path, query string), bounded by total bytes.
+
+    Each entry remembers the user_stats.version it was rendered at and only serves requests that
+    read the same version, so a mutation in any worker invalidates it without coordination.
+    """
+
+    def __init__(self, max_bytes=RESPONSE_CACHE_BYTES, max_entry_bytes=RESPONSE_CACHE_MAX_ENTRY):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = min(max_entry_bytes, max_bytes)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (version, body)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    @staticmethod
+    def _size(value):
+        return len(value)
+
+    def put(self, key, version, body):
+        size = self._size(body)
+        if size > self.max_entry_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= self._size(old[1])
+            self._entries[key] = (version, body)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.bytes -= self._size(evicted)
+                self.evictions += 1
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == user_id]:
+                self.bytes -= self._size(self._entries.pop(key)[1])
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+RESPONSE_CACHE = ResponseCache() if RESPONSE_CACHE_BYTES > 0 else None
+
+
+def data_etag(user_id, version):
+    # The schema mode is part of the tag because migrating layouts renumbers customers and bills
+    return f"{SCHEMA_MODE}.{user_id}.{version}"
+
+
+def not_modified(etag):
+    """304 response when the request's If-None-Match already has etag, else None."""
+    if request.if_none_match.contains_weak(etag):
+        return with_etag(Response(status=304), etag)
+    return None
+
+
+def with_etag(response, etag):
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+# --- /get_bills pagination and filtering ---
+GET_BILLS_MAX_LIMIT = int(os.getenv("GET_BILLS_MAX_LIMIT", "500"))
+GET_BILLS_STREAM_CHUNK = int(os.getenv("GET_BILLS_STREAM_CHUNK", "500"))
+
+
+def encode_bills_cursor(row):
+    """Opaque keyset cursor pointing just past `row` in (date DESC, id DESC) order."""
+    raw = json.dumps([row["date"].isoformat() if row["date"] else None, row["id"]])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_bills_cursor(value):
+    try:
+        padded = value + "=" * (-len(value) % 4)
+        date_text, bill_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return datetime.fromisoformat(date_text), int(bill_id)
+    except (ValueError, TypeError, binascii.Error):
+        raise ValueError("Invalid cursor")
+
+
+def parse_bill_filters(args):
+    """Validate /get_bills query parameters; raises ValueError with a client-facing message."""
+    filters = {}
+    if args.get("from"):
+        filters["from"] = datetime.fromisoformat(args["from"])
+    if args.get("to"):
+        to = datetime.fromisoformat(args["to"])
+        # A bare date means "through the end of that day"
+        filters["to"] = to + timedelta(days=1) if len(args["to"]) == 10 else to
+    for name in ("min_amount", "max_amount"):
+        if args.get(name):
+            try:
+                filters[name] = Decimal(args[name])
+            except InvalidOperation:
+                raise ValueError(f"Invalid {name}")
+    if args.get("customer_id"):
+        filters["customer_id"] = int(args["customer_id"])
+    if args.get("cursor"):
+        filters["after"] = decode_bills_cursor(args["cursor"])
+    if args.get("limit"):
+        limit = int(args["limit"])
+        if limit < 1:
+            raise ValueError("limit must be positive")
+        filters["limit"] = min(limit, GET_BILLS_MAX_LIMIT)
+    return filters
+
+
+def build_bills_query(tables, filters, limit=None, archive=False):
+    """SELECT over one user's bills honoring filters, newest first, resuming after filters['after'].
+
+    With archive=True the archived bills are merged in; each table then contributes at most `limit` rows
+    from its own (date) index range before the combined sort.
+    """
+    where, params = tables.scope("b")
+    clauses, params = [where], list(params)
+    if "from" in filters:
+        clauses.append("b.date >= %s")
+        params.append(filters["from"])
+    if "to" in filters:
+        clauses.append("b.date < %s")
+        params.append(filters["to"])
+    if "min_amount" in filters:
+        clauses.append("b.amount >= %s")
+        params.append(filters["min_amount"])
+    if "max_amount" in filters:
+        clauses.append("b.amount <= %s")
+        params.append(filters["max_amount"])
+    if "customer_id" in filters:
+        clauses.append("b.customer_id = %s")
+        params.append(filters["customer_id"])
+    if "after" in filters:
+        # Expanded row comparison so MySQL can range-scan the (date, id) index
+        after_date, after_id = filters["after"]
+        clauses.append("(b.date < %s OR (b.date = %s AND b.id < %s))")
+        params.extend([after_date, after_date, after_id])
+    if archive:
+        page = "" if limit is None else "ORDER BY b.date DESC, b.id DESC LIMIT %s"
+        sql = f"""
+            SELECT * FROM (
+                SELECT b.id, c.name, c.contact, c.email, b.amount, b.date
+                FROM {tables.bills} b
+                JOIN {tables.customers} c ON b.customer_id = c.id
+                WHERE {' AND '.join(clauses)} {page}
+            ) AS hot
+            UNION ALL
+            SELECT * FROM (
+                SELECT b.id, b.customer_name, b.customer_contact, b.customer_email, b.amount, b.date
+                FROM {tables.archive} b
+                WHERE {' AND '.join(clauses)} {page}
+            ) AS archived
+            ORDER BY date DESC, id DESC
+        """
+        params = params + [limit] + params + [limit] if limit is not None else params + params
+    else:
+        sql = f"""
+            SELECT b.id, c.name, c.contact, c.email, b.amount, b.date
+            FROM {tables.bills} b
+            JOIN {tables.customers} c ON b.customer_id = c.id
+            WHERE {' AND '.join(clauses)}
+            ORDER BY b.date DESC, b.id DESC
+        """
+    if limit is not None:
+        sql += " LIMIT %s"
+        params.append(limit)
+    return sql, tuple(params)
+
+
+def fetch_bills_page(conn, tables, filters):
+    """The /get_bills body: a plain list, or {"bills", "next_cursor"} when filters has limit or after."""
+    paged = "limit" in filters or "after" in filters
+    limit = filters.get("limit", GET_BILLS_MAX_LIMIT) if paged else None
+    archive = reads_archive(conn, tables, filters)
+    sql, params = build_bills_query(tables, filters, None if limit is None else limit + 1, archive)
+    cursor = conn.cursor(dictionary=True)
+    cursor.execute(sql, params)
+    bills = cursor.fetchall()
+    if not paged:
+        return bills
+    next_cursor = encode_bills_cursor(bills[limit - 1]) if len(bills) > limit else None
+    return {"bills": bills[:limit], "next_cursor": next_cursor}
+
+
+def stream_bills(sql, params, fmt):
+    """Yield bills as NDJSON lines or one chunked JSON array, fetching from an unbuffered cursor."""
+    with db_connection() as conn:
+        cursor = conn.cursor(dictionary=True, buffered=False)
+        exhausted = False
+        try:
+            cursor.execute(sql, params)
+            first = True
+            if fmt == "json":
+                yield "["
+            while True:
+                rows = cursor.fetchmany(GET_BILLS_STREAM_CHUNK)
+                if not rows:
+                    exhausted = True
+                    break
+                if fmt == "json":
+                    chunk = ",".join(app.json.dumps(row) for row in rows)
+                    yield chunk if first else "," + chunk
+                else:
+                    yield "".join(app.json.dumps(row) + "\n" for row in rows)
+                first = False
+            if fmt == "json":
+                yield "]"
+        finally:
+            if exhausted:
+                cursor.close()
+            else:
+                # The client went away (or a chunk failed) with rows still unread on the connection: closing
+                # the cursor would raise "Unread result found", and reading the rest could take as long as
+                # the whole stream, so drop the connection rather than pool it with a result pending.
+                conn.discard()
+
+
+@app.route("/get_bills", methods=["GET"])
+@require_firebase_auth
+def get_bills():
+    """List bills newest first.
+
+    Optional query params: limit + cursor for keyset pages ({"bills", "next_cursor"} response), from/to
+    dates, min_amount/max_amount, customer_id, and stream=ndjson|json to stream every matching row.
+    Without limit/cursor/stream the full list is returned as a plain array, as before. Archived bills
+    are included only when from/to reaches back past the user's archive horizon.
+    Non-streamed responses carry an ETag from the user's data version; If-None-Match hits return 304
+    without querying the bills tables, and RESPONSE_CACHE_BYTES enables an in-process body cache.
+    """
+    try:
+        filters = parse_bill_filters(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    stream = request.args.get("stream")
+    if stream and stream not in ("ndjson", "json"):
+        return jsonify({"error": "stream must be 'ndjson' or 'json'"}), 400
+    with db_connection() as conn:
+        try:
+            user_id = provision_user_with_conn(conn, g.firebase_uid, g.user_email)
+            settle_pending_writes(user_id)
+            tables = TenantTables(user_id)
+            if stream:
+                archive = reads_archive(conn, tables, filters)
+                sql, params = build_bills_query(tables, filters, filters.get("limit"), archive)
+            else:
+                etag = data_etag(user_id, user_data_version(conn, tables))
+                response = not_modified(etag)
+                if response is not None:
+                    return response
+                cache_key = (user_id, request.path, request.query_string)
+                body = RESPONSE_CACHE.get(cache_key, etag) if RESPONSE_CACHE is not None else None
+                if body is not None:
+                    return with_etag(Response(body, mimetype=app.json.mimetype), etag)
+                bills = fetch_bills_page(conn, tables, filters)
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+    if stream:
+        mimetype = "application/x-ndjson" if stream == "ndjson" else "application/json"
+        return Response(stream_with_context(stream_bills(sql, params, stream)), mimetype=mimetype)
+    response = jsonify(bills)
+    if RESPONSE_CACHE is not None:
+        RESPONSE_CACHE.put(cache_key, etag, response.get_data())
+    return with_etag(response, etag)
+
+
+# --- Bill mutations (shared by the routes and the write-behind flusher) ---
+
+def insert_bill(conn, tables, name, contact, email, amount):
+    """Add one bill, reusing the customer with the same normalized key; updates the summary stats."""
+    customer_id, created, changed = upsert_customer(conn, tables, name, contact, email)
+    cursor = execute_statement(conn, tables.insert_sql(tables.bills, "customer_id", "amount"),
+                               tables.row(customer_id, amount))
+    bill_id = cursor.lastrowid
+    apply_stats_delta(conn, tables, customers=int(created), bills=1, amount=Decimal(str(amount)))
+    if changed:
+        # The refreshed customer fields show on every bill of theirs, the new one included
+        log_bill_change(conn, tables, "u", customer_id=customer_id)
+    else:
+        log_bill_change(conn, tables, "u", bill_id)
+
+
+def modify_bill(conn, tables, bill_id, amount, name=None, contact=None, email=None):
+    """Set a bill's amount and refresh its customer's non-empty fields; returns False if the bill is missing.
+
+    One locking read fetches the old values for the stats delta, then a single UPDATE (joined to the
+    customer when customer fields change) writes both rows.
+    """
+    bill_where, bill_params = tables.scope("b")
+    rows = execute_statement(conn, f"""
+        SELECT b.customer_id, b.amount, b.date, c.contact, c.email
+        FROM {tables.bills} b JOIN {tables.customers} c ON c.id = b.customer_id
+        WHERE b.id = %s AND {bill_where} FOR UPDATE
+    """, (bill_id,) + bill_params).fetchall()
+    if not rows:
+        return False
+    customer_id, old_amount, bill_date, old_contact, old_email = rows[0]
+    update_fields = []
+    update_values = []
+    if name:
+        update_fields.append("c.name = %s")
+        update_values.append(name)
+    if contact:
+        update_fields.append("c.contact = %s")
+        update_values.append(contact)
+    if email:
+        update_fields.append("c.email = %s")
+        update_values.append(email)
+    if contact or email:
+        update_fields.append("c.customer_key = %s")
+        update_values.append(customer_key(contact or old_contact, email or old_email))
+    if update_fields:
+        execute_statement(conn, f"""
+            UPDATE {tables.bills} b JOIN {tables.customers} c ON c.id = b.customer_id
+            SET b.amount = %s, {', '.join(update_fields)}
+            WHERE b.id = %s AND {bill_where}
+        """, (amount, *update_values, bill_id) + bill_params)
+    else:
+        where, scope_params = tables.scope()
+        execute_statement(conn, f"UPDATE {tables.bills} SET amount = %s WHERE id = %s AND {where}",
+                          (amount, bill_id) + scope_params)
+    apply_stats_delta(conn, tables, amount=Decimal(str(amount)) - old_amount, day=bill_date.date())
+    # Customer fields show on all of the customer's bills, so those changed too
+    if update_fields:
+        log_bill_change(conn, tables, "u", customer_id=customer_id)
+    else:
+        log_bill_change(conn, tables, "u", bill_id)
+    return True
+
+
+def remove_bill(conn, tables, bill_id):
+    """Delete a bill (and its customer once they have no bills left); returns False if the bill is missing."""
+    where, scope_params = tables.scope()
+    customer_where, customer_params = tables.scope("c")
+    rows = execute_statement(
+        conn,
+        f"SELECT customer_id, amount, date FROM {tables.bills} WHERE id = %s AND {where} FOR UPDATE",
+        (bill_id,) + scope_params,
+    ).fetchall()
+    if not rows:
+        return False
+    customer_id, old_amount, bill_date = rows[0]
+    execute_statement(conn, f"DELETE FROM {tables.bills} WHERE id = %s AND {where}", (bill_id,) + scope_params)
+    # Anti-join: the customer only goes if no bill references them any more (a locking read, unlike COUNT)
+    orphaned = execute_statement(conn, f"""
+        DELETE c FROM {tables.customers} c LEFT JOIN {tables.bills} b ON b.customer_id = c.id
+        WHERE c.id = %s AND {customer_where} AND b.id IS NULL
+    """, (customer_id,) + customer_params).rowcount
+    apply_stats_delta(conn, tables, customers=-orphaned, bills=-1, amount=-old_amount, day=bill_date.date())
+    log_bill_change(conn, tables, "d", bill_id)
+    return True
+
+
+def apply_bill_mutation(conn, tables, op, payload):
+    """Replay one journaled mutation (see WriteJournal.append) inside the caller's transaction."""
+    if op == "add":
+        insert_bill(conn, tables, payload["name"], payload["contact"], payload["email"], Decimal(payload["amount"]))
+    elif op == "update":
+        modify_bill(conn, tables, payload["bill_id"], Decimal(payload["amount"]),
+                    payload.get("name"), payload.get("contact"), payload.get("email"))
+    elif op == "delete":
+        remove_bill(conn, tables, payload["bill_id"])
+    else:
+        raise ValueError(f"Unknown journal operation {op!r}")
+
+
+# --- Write-behind journal ---
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "0").lower() in ("1", "true", "yes")  # all workers must share one host
+WRITE_BEHIND_PATH = os.getenv("WRITE_BEHIND_PATH", str(Path(__file__).with_name("write_behind.sqlite3")))
+WRITE_BEHIND_BATCH = int(os.getenv("WRITE_BEHIND_BATCH", "500"))  # journal records applied per flush
+WRITE_BEHIND_INTERVAL = float(os.getenv("WRITE_BEHIND_INTERVAL_MS", "50")) / 1000  # pause between flushes
+print(f"[WriteBehind] enabled={WRITE_BEHIND} batch={WRITE_BEHIND_BATCH} interval={WRITE_BEHIND_INTERVAL * 1000:.0f}ms")
+
+# Errors that reject one journaled record; anything else (connection loss, lock timeouts) retries the batch
+RECORD_ERRORS = (mysql.connector.IntegrityError, mysql.connector.DataError, KeyError, ValueError, InvalidOperation)
+
+
+def create_write_behind_table(conn=None):
+    """Create the per-(journal, user) watermark that makes journal replay idempotent."""
+    own_conn = False
+    if conn is None:
+        conn = create_connection()
+        own_conn = True
+    if not conn:
+        print("❌ Failed to connect to database to create write-behind table")
+        return
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS write_behind_applied (
+                journal_id VARCHAR(32) NOT NULL,
+                user_id INT NOT NULL,
+                seq BIGINT NOT NULL DEFAULT 0,
+                PRIMARY KEY (journal_id, user_id)
+            )
+        """)
+        conn.commit()
+        print("Write-behind table created/verified successfully")
+    except Exception as e:
+        print(f"Error creating write-behind table: {e}")
+    finally:
+        if own_conn:
+            conn.close()
+
+
+class WriteJournal:
+    """Host-local durable journal of acknowledged bill mutations, applied to MySQL in per-tenant batches.
+
+    append() commits the record to a WAL-mode SQLite file with synchronous=FULL before the request is
+    acknowledged. Every worker on the host shares the file: a background flusher in each worker applies
+    the oldest records, one MySQL transaction per tenant, and reads call flush(user_id) first so callers
+    see their own writes. Records left over from a crash or restart are simply applied by the next flush.
+    The watermark in write_behind_applied is advanced in the same transaction as the records it covers,
+    so a record applied just before a crash is skipped rather than applied twice.
+    """
+
+    def __init__(self, path, batch_size=WRITE_BEHIND_BATCH, interval=WRITE_BEHIND_INTERVAL):
+        self.path = path
+        self.batch_size = batch_size
+        self.interval = interval
+        self._local = os_thread_local()
+        self._thread = None
+        self._thread_pid = None
+        self._start_lock = threading.Lock()
+        self.applied = 0
+        self.rejected = 0
+        self.flush_errors = 0
+        db = self._conn()
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS journal (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                op TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        db.execute("CREATE INDEX IF NOT EXISTS journal_user ON journal (user_id, seq)")
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS rejected (
+                seq INTEGER PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                op TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                error TEXT NOT NULL,
+                rejected_at REAL NOT NULL
+            )
+        """)
+        db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        # Identifies this journal file in the MySQL watermark, so a recreated file never inherits old seqs
+        db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('journal_id', ?)", (secrets.token_hex(8),))
+        self.journal_id = db.execute("SELECT value FROM meta WHERE key = 'journal_id'").fetchone()[0]
+
+    def _conn(self):
+        # One sqlite connection per OS thread (shared by its greenlets), reopened after fork
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=FULL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def append(self, user_id, op, payload):
+        """Durably record a mutation; once this returns the write survives a crash of this process."""
+        self._conn().execute(
+            "INSERT INTO journal (user_id, op, payload, created_at) VALUES (?, ?, ?, ?)",
+            (user_id, op, json.dumps(payload), time.time()),
+        )
+        self.ensure_running()
+
+    def pending(self, user_id):
+        return self._conn().execute("SELECT 1 FROM journal WHERE user_id = ? LIMIT 1", (user_id,)).fetchone() is not None
+
+    def flush(self, user_id=None):
+        """Apply pending records for one user (all of them) or for everyone (up to batch_size); returns the count."""
+        db = self._conn()
+        if user_id is None:
+            rows = db.execute(
+                "SELECT seq, user_id, op, payload FROM journal ORDER BY seq LIMIT ?", (self.batch_size,)
+            ).fetchall()
+        else:
+            rows = db.execute(
+                "SELECT seq, user_id, op, payload FROM journal WHERE user_id = ? ORDER BY seq", (user_id,)
+            ).fetchall()
+        if not rows:
+            return 0
+        by_user = {}
+        for seq, owner, op, payload in rows:
+            by_user.setdefault(owner, []).append((seq, op, payload))
+        with db_connection() as conn:
+            for owner, records in by_user.items():
+                try:
+                    rejected = self._apply_user(conn, owner, records)
+                except Exception:
+                    conn.rollback()
+                    raise
+                self._forget(owner, records, rejected)
+        return len(rows)
+
+    def _apply_user(self, conn, user_id, records):
+        """Apply one user's records in a single transaction; returns {seq: error} for rejected records."""
+        tables = TenantTables(user_id)
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO write_behind_applied (journal_id, user_id, seq) VALUES (%s, %s, 0)
+            ON DUPLICATE KEY UPDATE seq = seq
+        """, (self.journal_id, user_id))
+        cursor.execute(
+            "SELECT seq FROM write_behind_applied WHERE journal_id = %s AND user_id = %s FOR UPDATE",
+            (self.journal_id, user_id),
+        )
+        watermark = cursor.fetchone()[0]
+        rejected = {}
+        # Writes journaled just before the account was queued for deletion must not land behind the job
+        live = user_is_live(conn, user_id)
+        for seq, op, payload in records:
+            if seq <= watermark:
+                continue  # committed by an earlier flush that died before trimming the journal
+            if not live:
+                rejected[seq] = "Account has been deleted"
+                continue
+            cursor.execute("SAVEPOINT journal_record")
+            try:
+                apply_bill_mutation(conn, tables, op, json.loads(payload))
+            except RECORD_ERRORS as e:
+                cursor.execute("ROLLBACK TO SAVEPOINT journal_record")
+                rejected[seq] = str(e)
+        # A concurrent flush of the same user may already have moved the watermark past this batch
+        cursor.execute(
+            "UPDATE write_behind_applied SET seq = GREATEST(seq, %s) WHERE journal_id = %s AND user_id = %s",
+            (records[-1][0], self.journal_id, user_id),
+        )
+        conn.commit()
+        return rejected
+
+    def _forget(self, user_id, records, rejected):
+        db = self._conn()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            for seq, op, payload in records:
+                if seq in rejected:
+                    print(f"⚠️ Write-behind rejected {op} for user {user_id} (seq {seq}): {rejected[seq]}")
+                    db.execute(
+                        "INSERT OR REPLACE INTO rejected (seq, user_id, op, payload, error, rejected_at) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        (seq, user_id, op, payload, rejected[seq], time.time()),
+                    )
+            db.executemany("DELETE FROM journal WHERE seq = ?", [(seq,) for seq, _, _ in records])
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        self.applied += len(records) - len(rejected)
+        self.rejected += len(rejected)
+
+    def discard_user(self, user_id):
+        """Drop a deleted account's pending records."""
+        self._conn().execute("DELETE FROM journal WHERE user_id = ?", (user_id,))
+
+    def ensure_running(self):
+        """Start this process's flusher thread (again after fork)."""
+        if self._thread_pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread_pid == os.getpid() and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+            self._thread_pid = os.getpid()
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                while self.flush() >= self.batch_size:
+                    pass  # backlog: keep draining without pausing
+            except Exception as e:
+                self.flush_errors += 1
+                print(f"⚠️ Write-behind flush failed, will retry: {e}")
+                time.sleep(min(5.0, self.interval * 20))
+
+    def stats(self):
+        db = self._conn()
+        return {
+            "pending": db.execute("SELECT COUNT(*) FROM journal").fetchone()[0],
+            "rejected_total": db.execute("SELECT COUNT(*) FROM rejected").fetchone()[0],
+            "applied": self.applied,
+            "rejected": self.rejected,
+            "flush_errors": self.flush_errors,
+        }
+
+
+WRITE_JOURNAL = WriteJournal(WRITE_BEHIND_PATH) if WRITE_BEHIND else None
+
+
+def settle_pending_writes(user_id):
+    """Apply the caller's journaled writes before a read so it sees them (no-op unless WRITE_BEHIND)."""
+    if WRITE_JOURNAL is not None and WRITE_JOURNAL.pending(user_id):
+        WRITE_JOURNAL.flush(user_id)
+
+
+@app.before_request
+def start_write_behind_flusher():
+    if WRITE_JOURNAL is not None:
+        WRITE_JOURNAL.ensure_running()
+
+
+@app.cli.command("flush-writes")
+def flush_writes_command():
+    """Apply every pending write-behind record now (e.g. before turning WRITE_BEHIND off)."""
+    if WRITE_JOURNAL is None:
+        raise click.ClickException("WRITE_BEHIND is not enabled")
+    total = 0
+    while True:
+        applied = WRITE_JOURNAL.flush()
+        if not applied:
+            break
+        total += applied
+    stats = WRITE_JOURNAL.stats()
+    click.echo(f"✅ Flushed {total} journal record(s); {stats['rejected_total']} rejected record(s) on file")
+
+
+@app.route("/add_bill", methods=["POST"])
+@require_firebase_auth
+def add_bill():
+    data = request.json
+    name, contact, email, amount = data["name"], data["contact"], data["email"], data["amount"]
+    with db_connection() as conn:
+        try:
+            user_id = provision_user_with_conn(conn, g.firebase_uid, g.user_email, for_write=True)
+            tables = TenantTables(user_id)
+            if WRITE_JOURNAL is not None:
+                try:
+                    amount = str(Decimal(str(amount)))
+                except InvalidOperation:
+                    return jsonify({"error": "Invalid amount"}), 400
+                conn.commit()
+                WRITE_JOURNAL.append(user_id, "add", {"name": name, "contact": contact, "email": email, "amount": amount})
+                return jsonify({"message": "Bill added successfully"}), 201
+            insert_bill(conn, tables, name, contact, email, amount)
+            conn.commit()
+            return jsonify({"message": "Bill added successfully"}), 201
+        except Exception as e:
+            conn.rollback()
+            return jsonify({"error": str(e)}), 500
+
+
+@app.route("/update_bill/<int:bill_id>", methods=["PUT"])
+@require_firebase_auth
+def update_bill(bill_id):
+    data = request.json
+    amount = data.get("amount")
+    name = data.get("name")
+    contact = data.get("contact")
+    email = data.get("email")
+    with db_connection() as conn:
+        try:
+            user_id = provision_user_with_conn(conn, g.firebase_uid, g.user_email, for_write=True)
+            tables = TenantTables(user_id)
+            if WRITE_JOURNAL is not None:
+                # Conflicts (409 in the synchronous path) surface later as rejected journal records
+                try:
+                    amount = str(Decimal(str(amount)))
+                except InvalidOperation:
+                    return jsonify({"error": "Invalid amount"}), 400
+                conn.commit()
+                WRITE_JOURNAL.append(user_id, "update", {
+                    "bill_id": bill_id, "amount": amount, "name": name, "contact": contact, "email": email,
+                })
+                return jsonify({"message": "Bill updated successfully"}), 200
+            if not modify_bill(conn, tables, bill_id, amount, name, contact, email):
+                return jsonify({"message": "Bill not found"}), 404
+            conn.commit()
+            return jsonify({"message": "Bill updated successfully"}), 200
+        except mysql.connector.IntegrityError as e:
+            conn.rollback()
+            if e.errno == errorcode.ER_DUP_ENTRY:
+                return jsonify({"error": "Another customer already uses this email/contact"}), 409
+            return jsonify({"error": str(e)}), 500
+        except Exception as e:
+            conn.rollback()
+            return jsonify({"error": str(e)}), 500
+
+
+@app.route("/delete_bill/<int:bill_id>", methods=["DELETE"])
+@require_firebase_auth
+def delete_bill(bill_id):
+    with db_connection() as conn:
+        try:
+            user_id = provision_user_with_conn(conn, g.firebase_uid, g.user_email, for_write=True)
+            tables = TenantTables(user_id)
+            if WRITE_JOURNAL is not None:
+                where, scope_params = tables.scope()
+                cursor = conn.cursor()
+                cursor.execute(f"SELECT 1 FROM {tables.bills} WHERE id = %s AND {where}", (bill_id,) + scope_params)
+                found = cursor.fetchone()
+                conn.commit()
+                if not found:
+                    return jsonify({"message": "Bill not found"}), 404
+                WRITE_JOURNAL.append(user_id, "delete", {"bill_id": bill_id})
+                return jsonify({"message": "Bill deleted successfully"}), 200
+            if not remove_bill(conn, tables, bill_id):
+                return jsonify({"message": "Bill not found"}), 404
+            conn.commit()
+            return jsonify({"message": "Bill deleted successfully"}), 200
+        except Exception as e:
+            conn.rollback()
+            return jsonify({"error": str(e)}), 500
+
+
+# --- Batch API ---
+BATCH_MAX_OPERATIONS = int(os.getenv("BATCH_MAX_OPERATIONS", "50"))
+BATCH_OPERATIONS = ("check_auth", "get_bills", "user_stats", "add_bill", "update_bill", "delete_bill")
+
+
+class BatchError(Exception):
+    """A /batch sub-operation failed with a client error; the whole batch is rolled back."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def read_user_stats(conn, tables):
+    """The /user-stats body, building the summary row inside the caller's transaction if it is missing."""
+    cursor = conn.cursor(dictionary=True)
+    query = "SELECT customer_count, bill_count, total_amount FROM user_stats WHERE user_id = %s"
+    cursor.execute(query, (tables.user_id,))
+    stats = cursor.fetchone()
+    if stats is None:
+        rebuild_user_stats(conn, tables)
+        cursor.execute(query, (tables.user_id,))
+        stats = cursor.fetchone()
+    return {
+        "customer_count": stats["customer_count"],
+        "bill_count": stats["bill_count"],
+        "total_amount": float(stats["total_amount"]),
+    }
+
+
+def batch_amount(body):
+    try:
+        return Decimal(str(body["amount"]))
+    except (KeyError, InvalidOperation):
+        raise BatchError(400, "Invalid amount")
+
+
+def run_batch_operation(conn, tables, operation):
+    """Run one /batch sub-operation in the batch transaction; returns (status, body) or raises BatchError."""
+    op = operation.get("op")
+    if op not in BATCH_OPERATIONS:
+        raise BatchError(400, f"Unknown operation {op!r}")
+    body = operation.get("body") or {}
+    if op == "check_auth":
+        return 200, {"authenticated": True, "user": {"id": tables.user_id, "email": g.user_email}}
+    if op == "get_bills":
+        try:
+            filters = parse_bill_filters({k: str(v) for k, v in (operation.get("params") or {}).items()})
+        except ValueError as e:
+            raise BatchError(400, str(e))
+        return 200, fetch_bills_page(conn, tables, filters)
+    if op == "user_stats":
+        return 200, read_user_stats(conn, tables)
+    if op == "add_bill":
+        missing = [field for field in ("name", "contact", "email") if field not in body]
+        if missing:
+            raise BatchError(400, f"Missing {', '.join(missing)}")
+        insert_bill(conn, tables, body["name"], body["contact"], body["email"], batch_amount(body))
+        return 201, {"message": "Bill added successfully"}
+    bill_id = operation.get("bill_id")
+    if isinstance(bill_id, bool) or not isinstance(bill_id, int):
+        raise BatchError(400, "bill_id must be an integer")
+    if op == "update_bill":
+        amount = batch_amount(body)
+        if not modify_bill(conn, tables, bill_id, amount, body.get("name"), body.get("contact"), body.get("email")):
+            raise BatchError(404, "Bill not found")
+        return 200, {"message": "Bill updated successfully"}
+    if not remove_bill(conn, tables, bill_id):
+        raise BatchError(404, "Bill not found")
+    return 200, {"message": "Bill deleted successfully"}
+
+
+@app.route("/batch", methods=["POST"])
+@require_firebase_auth
+def run_batch():
+    """Run several operations with one auth check, one connection and one transaction.
+
+    Body: {"operations": [{"op": "add_bill", "body": {...}}, {"op": "update_bill", "bill_id": 7, "body": {...}},
+    {"op": "delete_bill", "bill_id": 7}, {"op": "get_bills", "params": {...}}, {"op": "user_stats"},
+    {"op": "check_auth"}], "include": ["bills", "changes", "stats"], "since": "tenant.41"}
+    Operations run in order and see each other's writes; the first failure rolls back the whole batch
+    and is reported with its index. "include" appends the full bill list (with its /changes "seq"), the
+    /changes body for a client holding the list as of "since" (so it gets back only the bills changed),
+    and the stats with their change over the batch, so a dashboard interaction needs a single request.
+    """
+    data = request.get_json(silent=True) or {}
+    operations = data.get("operations", [])
+    include = data.get("include", [])
+    if not isinstance(operations, list) or not all(isinstance(op, dict) for op in operations):
+        return jsonify({"error": "operations must be a list of objects"}), 400
+    if len(operations) > BATCH_MAX_OPERATIONS:
+        return jsonify({"error": f"At most {BATCH_MAX_OPERATIONS} operations per batch"}), 400
+    if not isinstance(include, list) or set(include) - {"bills", "changes", "stats"}:
+        return jsonify({"error": "include may only contain 'bills', 'changes' and 'stats'"}), 400
+    try:
+        since = parse_feed_position(data.get("since"))
+    except ValueError:
+        return jsonify({"error": "since must be a seq from a previous response"}), 400
+    with db_connection() as conn:
+        try:
+            writes = any(operation.get("op") in ("add_bill", "update_bill", "delete_bill") for operation in operations)
+            user_id = provision_user_with_conn(conn, g.firebase_uid, g.user_email, for_write=writes)
+            # Journaled writes land first, so the batch applies on top of them
+            settle_pending_writes(user_id)
+            tables = TenantTables(user_id)
+            before = read_user_stats(conn, tables) if "stats" in include else None
+            results = []
+            for index, operation in enumerate(operations):
+                try:
+                    status, body = run_batch_operation(conn, tables, operation)
+                except BatchError as e:
+                    conn.rollback()
+                    return jsonify({"error": str(e), "failed_operation": index}), e.status
+                except mysql.connector.Error as e:
+                    conn.rollback()
+                    if isinstance(e, mysql.connector.IntegrityError) and e.errno == errorcode.ER_DUP_ENTRY:
+                        return jsonify({"error": "Another customer already uses this email/contact",
+                                        "failed_operation": index}), 409
+                    # Values the column rejects (too long, out of range, NULL) are the client's to fix
+                    client_error = isinstance(e, (mysql.connector.DataError, mysql.connector.IntegrityError))
+                    return jsonify({"error": str(e), "failed_operation": index}), 400 if client_error else 500
+                results.append({"status": status, "body": body})
+            response = {"results": results}
+            if "bills" in include:
+                response["bills"] = fetch_bills_page(conn, tables, {})
+                response["seq"] = feed_position(change_feed_position(conn, tables)[0])
+            if "changes" in include:
+                response["changes"] = bill_changes_since(conn, tables, since)
+            if "stats" in include:
+                after = read_user_stats(conn, tables)
+                response["stats"] = after
+                response["stats_delta"] = {
+                    "customer_count": after["customer_count"] - before["customer_count"],
+                    "bill_count": after["bill_count"] - before["bill_count"],
+                    "total_amount": round(after["total_amount"] - before["total_amount"], 2),
+                }
+            conn.commit()
+            return jsonify(response), 200
+        except Exception as e:
+            conn.rollback()
+            return jsonify({"error": str(e)}), 500
+
+
+# --- Change feed ---
+# add/update/delete record the bills they touch in bill_changes under the user's data version, which the
+# user_stats row lock already serializes, so sequence numbers follow commit order. Bulk writes (imports,
+# archiving, customer merges) are not itemized; they raise user_stats.changes_floor instead, as does
+# compaction of old entries, and a client behind the floor is told to resync.
+CHANGES_MAX = int(os.getenv("CHANGES_MAX", "500"))  # changed bills per response before a resync is cheaper
+CHANGES_RETENTION_DAYS = int(os.getenv("CHANGES_RETENTION_DAYS", "7"))
+
+
+def feed_position(seq):
+    """The "seq" clients hold; like data_etag it names the schema mode, since migrating layouts renumbers bills."""
+    return f"{SCHEMA_MODE}.{seq}"
+
+
+def parse_feed_position(value):
+    """A client's since as a sequence number, or None (full resync) if absent or from another schema mode.
+
+    Raises ValueError for anything that is not a "seq" handed out by this feed.
+    """
+    if value is None or value == "":
+        return None
+    mode, _, seq = str(value).rpartition(".")
+    if mode not in ("per_user", "tenant"):
+        raise ValueError("since must be a seq from a previous response")
+    seq = int(seq)
+    return seq if mode == SCHEMA_MODE else None
+
+
+def change_feed_position(conn, tables):
+    """(version, changes_floor) for a user, building the summary row first if it is missing."""
+    cursor = conn.cursor()
+    query = "SELECT version, changes_floor FROM user_stats WHERE user_id = %s"
+    cursor.execute(query, (tables.user_id,))
+    row = cursor.fetchone()
+    if row is None:
+        rebuild_user_stats(conn, tables)
+        conn.commit()
+        cursor.execute(query, (tables.user_id,))
+        row = cursor.fetchone()
+    return row
+
+
+def fetch_bills_by_id(conn, tables, bill_ids):
+    """Current rows of the given bills that still exist, in /get_bills order and shape."""
+    where, params = tables.scope("b")
+    placeholders = ", ".join(["%s"] * len(bill_ids))
+    cursor = conn.cursor(dictionary=True)
+    cursor.execute(f"""
+        SELECT b.id, c.name, c.contact, c.email, b.amount, b.date
+        FROM {tables.bills} b
+        JOIN {tables.customers} c ON b.customer_id = c.id
+        WHERE {where} AND b.id IN ({placeholders})
+        ORDER BY b.date DESC, b.id DESC
+    """, params + tuple(bill_ids))
+    return cursor.fetchall()
+
+
+def bill_changes_since(conn, tables, since):
+    """The /changes body for a client at sequence number `since` (None for a client with no copy yet)."""
+    seq, floor = change_feed_position(conn, tables)
+    if since == seq:
+        return {"seq": feed_position(seq), "upserts": [], "deletes": []}
+    bill_ids = None
+    if since is not None and floor <= since < seq:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT DISTINCT bill_id FROM bill_changes
+            WHERE user_id = %s AND seq > %s AND seq <= %s
+            LIMIT %s
+        """, (tables.user_id, since, seq, CHANGES_MAX + 1))
+        bill_ids = [row[0] for row in cursor.fetchall()]
+    if bill_ids is None or len(bill_ids) > CHANGES_MAX:
+        return {"resync": True, "seq": feed_position(seq), "bills": fetch_bills_page(conn, tables, {})}
+    upserts = fetch_bills_by_id(conn, tables, bill_ids) if bill_ids else []
+    present = {bill["id"] for bill in upserts}
+    return {
+        "seq": feed_position(seq),
+        "upserts": upserts,
+        "deletes": [bill_id for bill_id in bill_ids if bill_id not in present],
+    }
+
+
+@app.route("/changes", methods=["GET"])
+@require_firebase_auth
+def get_changes():
+    """Bills changed since a sequence number, for clients that keep a copy of the /get_bills list.
+
+    ?since=<seq> from the previous response (or a /batch with include=bills or changes) answers
+    {"seq", "upserts": [bills, current rows], "deletes": [bill ids]}. Without since, behind the compacted
+    log, with more than CHANGES_MAX changed bills, or with a seq from before a SCHEMA_MODE switch, it
+    answers {"resync": true, "seq", "bills": [...]}, the full list, so a client never has to stitch a
+    partial history together. seq is opaque to clients ("tenant.41").
+    """
+    try:
+        since = parse_feed_position(request.args.get("since"))
+    except ValueError:
+        return jsonify({"error": "since must be a seq from a previous response"}), 400
+    with db_connection() as conn:
+        try:
+            user_id = provision_user_with_conn(conn, g.firebase_uid, g.user_email)
+            settle_pending_writes(user_id)
+            return jsonify(bill_changes_since(conn, TenantTables(user_id), since))
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+
+
+def compact_bill_changes(conn, cutoff, batch_size=5000, pause=0.0):
+    """Delete change log entries recorded before `cutoff` in committed batches; returns the count.
+
+    Each user's floor is raised to their newest removed seq before anything is deleted, so a client
+    whose position falls inside the removed range gets a resync rather than an incomplete delta.
+    """
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT user_id, MAX(seq) FROM bill_changes WHERE created_at < %s GROUP BY user_id", (cutoff,)
+    )
+    horizons = cursor.fetchall()
+    removed = 0
+    for user_id, horizon in horizons:
+        cursor.execute(
+            "UPDATE user_stats SET changes_floor = GREATEST(changes_floor, %s) WHERE user_id = %s", (horizon, user_id)
+        )
+        conn.commit()
+        while True:
+            cursor.execute(
+                "DELETE FROM bill_changes WHERE user_id = %s AND seq <= %s LIMIT %s", (user_id, horizon, batch_size)
+            )
+            deleted = cursor.rowcount
+            conn.commit()
+            removed += deleted
+            if deleted < batch_size:
+                break
+            if pause:
+                time.sleep(pause)
+    return removed
+
+
+@app.cli.command("compact-changes")
+@click.option("--keep-days", default=CHANGES_RETENTION_DAYS, show_default=True,
+              help="Keep change log entries from the last this many days.")
+@click.option("--batch-size", default=5000, show_default=True, help="Entries deleted per transaction.")
+@click.option("--pause", default=0.0, show_default=True, help="Seconds to sleep between batches.")
+def compact_changes_command(keep_days, batch_size, pause):
+    """Remove old /changes log entries; clients older than what remains resync with the full bill list."""
+    conn = create_connection()
+    if not conn:
+        raise click.ClickException("Database connection failed")
+    try:
+        create_stats_tables(conn)
+        removed = compact_bill_changes(conn, datetime.now() - timedelta(days=keep_days), batch_size, pause)
+        click.echo(f"✅ Removed {removed} change log entr{'y' if removed == 1 else 'ies'}")
+    finally:
         conn.close()
 
 
-@app.route("/update_bill/<int:bill_id>", methods=["PUT"])
-@require_firebase_auth
-def update_bill(bill_id):
-    data = request.json
-    amount = data.get("amount")
-    name = data.get("name")
-    contact = data.get("contact")
-    email = data.get("email")
-    conn = create_connection()
-    if conn is None:
-        return jsonify({"error": "Failed to connect to database"}), 500
-    try:
-        user_id = provision_user_with_conn(conn, g.firebase_uid, g.user_email)
-        cursor = conn.cursor()
-        cursor.execute(f"UPDATE bills_{user_id} SET amount = %s WHERE id = %s", (amount, bill_id))
-        cursor.execute(f"SELECT customer_id FROM bills_{user_id} WHERE id = %s", (bill_id,))
-        result = cursor.fetchone()
-        if result:
-            customer_id = result[0]
-            update_fields = []
-            update_values = []
-            if name:
-                update_fields.append("name = %s")
-                update_values.append(name)
-            if contact:
-                update_fields.append("contact = %s")
-                update_values.append(contact)
-            if email:
-                update_fields.append("email = %s")
-                update_values.append(email)
-            if update_fields:
-                query = f"UPDATE customers_{user_id} SET {', '.join(update_fields)} WHERE id = %s"
-                update_values.append(customer_id)
-                cursor.execute(query, tuple(update_values))
-        conn.commit()
-        return jsonify({"message": "Bill updated successfully"}), 200
-    except Exception as e:
-        conn.rollback()
-        return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
+# --- Bulk bill import ---
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", "1000"))
+BULK_MAX_CHUNK_SIZE = 10000
+BULK_MAX_ERRORS = 1000  # per-row error reports returned to the client; the count is always exact
+BULK_MAX_AMOUNT = Decimal("99999999.99")  # DECIMAL(10,2)
+
+_JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+def iter_json_array(stream, read_size=65536):
+    """Yield the elements of a top-level JSON array read incrementally from a binary stream."""
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8-sig")()
+    buffer, pos, eof = "", 0, False
+    expect = "open"  # open -> first (item or "]") -> separator -> item -> separator ... -> done
+
+    def read_more():
+        nonlocal buffer, pos, eof
+        chunk = stream.read(read_size)
+        eof = not chunk
+        buffer = buffer[pos:] + utf8.decode(chunk, final=eof)
+        pos = 0
+
+    while True:
+        pos = _JSON_WHITESPACE.match(buffer, pos).end()
+        if pos == len(buffer):
+            if eof:
+                break
+            read_more()
+            continue
+        char = buffer[pos]
+        if expect == "open":
+            if char != "[":
+                raise ValueError("Expected a JSON array")
+            pos += 1
+            expect = "first"
+        elif expect == "separator" or (expect == "first" and char == "]"):
+            if char == "]":
+                pos += 1
+                expect = "done"
+            elif char == "," and expect == "separator":
+                pos += 1
+                expect = "item"
+            else:
+                raise ValueError("Expected ',' or ']' in JSON array")
+        elif expect == "done":
+            raise ValueError("Unexpected data after JSON array")
+        else:
+            try:
+                value, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise ValueError("Invalid or truncated JSON array")
+                read_more()
+                continue
+            if end == len(buffer) and not eof:
+                read_more()  # a number at the end of the buffer may continue in the next chunk
+                continue
+            yield value
+            pos = end
+            expect = "separator"
+    if expect != "done":
+        raise ValueError("Truncated JSON array")
+
+
+def iter_bulk_rows(req):
+    """Rows of a bulk import: a JSON array body, a text/csv body, or a multipart 'file' upload."""
+    if req.files.get("file"):
+        upload = req.files["file"]
+        if (upload.filename or "").lower().endswith(".json") or upload.mimetype == "application/json":
+            return iter_json_array(upload.stream)
+        return csv.DictReader(io.TextIOWrapper(upload.stream, encoding="utf-8-sig", newline=""))
+    if req.mimetype == "text/csv":
+        return csv.DictReader(io.TextIOWrapper(req.stream, encoding="utf-8-sig", newline=""))
+    return iter_json_array(req.stream)
+
+
+def parse_bulk_row(raw):
+    """Validate one imported row; returns ((name, contact, email), amount, date) or raises ValueError."""
+    if not isinstance(raw, dict):
+        raise ValueError("Row must be an object")
+
+    def text(field):
+        value = raw.get(field)
+        if value is None:
+            return None
+        value = str(value).strip()
+        if len(value) > 255:
+            raise ValueError(f"{field} is longer than 255 characters")
+        return value or None
+
+    name = text("name")
+    if not name:
+        raise ValueError("name is required")
+    try:
+        amount = Decimal(str(raw.get("amount", "")).strip())
+    except InvalidOperation:
+        raise ValueError("amount must be a number")
+    if not amount.is_finite() or abs(amount) > BULK_MAX_AMOUNT:
+        raise ValueError("amount is out of range")
+    bill_date = raw.get("date")
+    if bill_date:
+        bill_date = datetime.fromisoformat(str(bill_date).strip())
+    return (name, text("contact"), text("email")), amount, bill_date or None
+
+
+def import_bill_chunk(conn, tables, chunk, known_customers):
+    """Insert one chunk of parsed rows with multi-row INSERTs in the caller's transaction.
+
+    Customers are matched on their normalized key (existing rows are reused, not overwritten); rows with
+    neither email nor contact are deduplicated within the import by (name, contact, email).
+    known_customers maps identity -> id from earlier chunks. Returns (identities resolved by this chunk,
+    number of customers created).
+    """
+    cursor = conn.cursor()
+    where, params = tables.scope()
+    identities = [customer_key(details[1], details[2]) or details for details, _, _ in chunk]
+    pending = {}
+    for identity, (details, _, _) in zip(identities, chunk):
+        if identity not in known_customers:
+            pending.setdefault(identity, details)
+    resolved, created = {}, 0
+
+    def resolve_keys(keys):
+        cursor.execute(
+            f"SELECT customer_key, id FROM {tables.customers} "
+            f"WHERE {where} AND customer_key IN ({', '.join(['%s'] * len(keys))})",
+            params + tuple(keys),
+        )
+        resolved.update(cursor.fetchall())
+
+    keyed = [identity for identity in pending if isinstance(identity, str)]
+    if keyed:
+        resolve_keys(keyed)
+        missing = [key for key in keyed if key not in resolved]
+        if missing:
+            cursor.executemany(
+                tables.insert_sql(tables.customers, "name", "contact", "email", "customer_key")
+                + " ON DUPLICATE KEY UPDATE id = id",
+                [tables.row(*pending[key], key) for key in missing],
+            )
+            created += len(missing)
+            resolve_keys(missing)
+    keyless = [identity for identity in pending if not isinstance(identity, str)]
+    if keyless:
+        cursor.executemany(
+            tables.insert_sql(tables.customers, "name", "contact", "email"), [tables.row(*details) for details in keyless]
+        )
+        # A multi-row INSERT reports the first generated id; match the rest by value rather than assuming
+        # the ids are consecutive, which interleaved auto-increment locking does not guarantee.
+        cursor.execute(
+            f"SELECT id, name, contact, email FROM {tables.customers} "
+            f"WHERE {where} AND id >= %s AND customer_key IS NULL ORDER BY id",
+            params + (cursor.lastrowid,),
+        )
+        wanted = set(keyless)
+        for customer_id, name, contact, email in cursor.fetchall():
+            details = (name, contact, email)
+            if details in wanted and details not in resolved:
+                resolved[details] = customer_id
+        created += len(keyless)
+    if len(resolved) != len(pending):
+        raise RuntimeError("Could not resolve ids of imported customers")
+    ids = {**known_customers, **resolved} if resolved else known_customers
+    columns = ("user_id, " if tables.shared else "") + "customer_id, amount, date"
+    placeholders = ("%s, " if tables.shared else "") + "%s, %s, COALESCE(%s, CURRENT_TIMESTAMP)"
+    cursor.executemany(
+        f"INSERT INTO {tables.bills} ({columns}) VALUES ({placeholders})",
+        [tables.row(ids[identity], amount, bill_date) for identity, (_, amount, bill_date) in zip(identities, chunk)],
+    )
+    daily = {}
+    for _, amount, bill_date in chunk:
+        bucket = bill_date.date() if bill_date else None
+        count, total = daily.get(bucket, (0, 0))
+        daily[bucket] = (count + 1, total + amount)
+    apply_stats_delta(
+        conn, tables, customers=created, bills=len(chunk),
+        amount=sum(amount for _, amount, _ in chunk), daily=daily,
+    )
+    reset_change_feed(conn, tables)
+    return resolved, created
+
+
+@app.route("/bills/bulk", methods=["POST"])
+@require_firebase_auth
+def bulk_add_bills():
+    """Import bills from a JSON array, a text/csv body or a multipart CSV/JSON 'file' upload.
+
+    Each row has name, contact, email, amount and an optional ISO date. Rows are parsed as they stream
+    in and written chunk_size at a time (one commit per chunk); customers are matched on their
+    normalized email/contact key, so repeated and already-known customers are not duplicated.
+    Invalid rows are skipped and reported with their 0-based index.
+    """
+    try:
+        chunk_size = min(max(int(request.args.get("chunk_size", BULK_CHUNK_SIZE)), 1), BULK_MAX_CHUNK_SIZE)
+    except ValueError:
+        return jsonify({"error": "chunk_size must be an integer"}), 400
+    report = {"inserted": 0, "customers_created": 0, "failed": 0, "chunks": 0, "errors": []}
+
+    def fail(indexes, message):
+        report["failed"] += len(indexes)
+        for index in indexes:
+            if len(report["errors"]) < BULK_MAX_ERRORS:
+                report["errors"].append({"row": index, "error": message})
+
+    with db_connection() as conn:
+        try:
+            user_id = provision_user_with_conn(conn, g.firebase_uid, g.user_email, for_write=True)
+            conn.commit()
+            settle_pending_writes(user_id)  # keep this tenant's journaled writes ahead of the import
+        except Exception as e:
+            conn.rollback()
+            return jsonify({"error": str(e)}), 500
+        tables = TenantTables(user_id)
+        known_customers = {}
+        chunk, indexes = [], []
+
+        def flush():
+            try:
+                # Each chunk is its own transaction, so recheck the account the import started under
+                if not user_is_live(conn, user_id, g.firebase_uid):
+                    raise AccountUnavailable("Account has been deleted")
+                resolved, created = import_bill_chunk(conn, tables, chunk, known_customers)
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                fail(indexes, f"Chunk failed: {e}")
+            else:
+                known_customers.update(resolved)
+                report["inserted"] += len(chunk)
+                report["customers_created"] += created
+            report["chunks"] += 1
+            chunk.clear()
+            indexes.clear()
+
+        index = -1
+        try:
+            for index, raw in enumerate(iter_bulk_rows(request)):
+                try:
+                    chunk.append(parse_bulk_row(raw))
+                    indexes.append(index)
+                except ValueError as e:
+                    fail([index], str(e))
+                if len(chunk) >= chunk_size:
+                    flush()
+        except (ValueError, csv.Error, UnicodeDecodeError) as e:
+            # Malformed framing: keep what was already committed and report where parsing stopped
+            report["aborted"] = f"Stopped after row {index}: {e}"
+        if chunk:
+            flush()
+    status = 400 if report.get("aborted") and not report["inserted"] else 200
+    return jsonify(report), status
 
 
-@app.route("/delete_bill/<int:bill_id>", methods=["DELETE"])
-@require_firebase_auth
-def delete_bill(bill_id):
-    conn = create_connection()
-    if not conn:
-        return jsonify({"error": "Database connection failed"}), 500
+# --- Admin export ---
+ADMIN_EXPORT_WORKERS = int(os.getenv("ADMIN_EXPORT_WORKERS", "4"))  # users fetched concurrently; capped below DB_POOL_SIZE
+ADMIN_EXPORT_PAGE_SIZE = int(os.getenv("ADMIN_EXPORT_PAGE_SIZE", "100"))  # users read per page
+ADMIN_EXPORT_CHUNK = int(os.getenv("ADMIN_EXPORT_CHUNK", "5000"))  # rows fetched per user per round trip
+EXPORT_COLUMNS = ("user_id", "user_email", "customer_id", "customer_name", "customer_contact",
+                  "customer_email", "bill_id", "amount", "bill_date")
+
+
+def users_with_tables(cursor, user_ids):
+    """Subset of user_ids that have both customers_{id} and bills_{id}, from one information_schema query."""
+    if not user_ids:
+        return set()
+    names = [f"{prefix}_{uid}" for uid in user_ids for prefix in ("customers", "bills")]
+    placeholders = ", ".join(["%s"] * len(names))
+    cursor.execute(f"""
+        SELECT TABLE_NAME FROM information_schema.TABLES
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME IN ({placeholders})
+    """, names)
+    found = {row["TABLE_NAME"] for row in cursor.fetchall()}
+    return {uid for uid in user_ids if f"customers_{uid}" in found and f"bills_{uid}" in found}
+
+
+def fetch_export_chunk(user, after=None):
+    """Up to ADMIN_EXPORT_CHUNK of one user's customer/bill rows, ordered by customer id then bill id.
+
+    after is the (customer_id, bill_id) of the last row already returned. Runs on its own pooled
+    connection when called from an export worker thread.
+    """
+    tables = TenantTables(user["id"])
+    where, params = tables.scope("c")
+    join = "b.user_id = c.user_id AND b.customer_id = c.id" if tables.shared else "b.customer_id = c.id"
+    keyset = ""
+    if after is not None:
+        customer_id, bill_id = after
+        if bill_id is None:
+            keyset, params = " AND c.id > %s", params + (customer_id,)
+        else:
+            keyset = " AND (c.id > %s OR (c.id = %s AND b.id > %s))"
+            params = params + (customer_id, customer_id, bill_id)
+    with db_connection() as conn:
+        cursor = conn.cursor(dictionary=True)
+        try:
+            cursor.execute(f"""
+                SELECT
+                    %s AS user_id,
+                    %s AS user_email,
+                    c.id AS customer_id,
+                    c.name AS customer_name,
+                    c.contact AS customer_contact,
+                    c.email AS customer_email,
+                    b.id AS bill_id,
+                    b.amount,
+                    b.date AS bill_date
+                FROM {tables.customers} c
+                LEFT JOIN {tables.bills} b ON {join}
+                WHERE {where}{keyset}
+                ORDER BY c.id, b.id
+                LIMIT %s
+            """, (user["id"], user["email"]) + params + (ADMIN_EXPORT_CHUNK,))
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+
+def iter_export_chunks(from_user=0):
+    """Yield lists of export rows in user_id order, starting at from_user.
+
+    Users are paged from the users table; each page's legacy tables are checked with one
+    information_schema query, and up to ADMIN_EXPORT_WORKERS users are fetched ahead on a thread
+    pool while earlier ones are streamed out, so memory stays bounded by workers * chunk size.
+    The caller must not hold a pooled connection: the workers leave one free for the page queries, and
+    with a single-connection pool users are fetched inline instead.
+    """
+    workers = min(ADMIN_EXPORT_WORKERS, DB_POOL.max_size - 1)
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="admin-export") if workers > 0 else None
+    pending = deque()
+
+    def drain():
+        user, future = pending.popleft()
+        rows = future.result() if future is not None else fetch_export_chunk(user)
+        while rows:
+            yield rows
+            if len(rows) < ADMIN_EXPORT_CHUNK:
+                break
+            last = rows[-1]
+            rows = fetch_export_chunk(user, (last["customer_id"], last["bill_id"]))
+
     try:
-        user_id = provision_user_with_conn(conn, g.firebase_uid, g.user_email)
-        cursor = conn.cursor()
-        cursor.execute(f"SELECT customer_id FROM bills_{user_id} WHERE id = %s", (bill_id,))
-        result = cursor.fetchone()
-        if not result:
-            return jsonify({"message": "Bill not found"}), 404
-        customer_id = result[0]
-        cursor.execute(f"DELETE FROM bills_{user_id} WHERE id = %s", (bill_id,))
-        cursor.execute(f"SELECT COUNT(*) FROM bills_{user_id} WHERE customer_id = %s", (customer_id,))
-        bill_count = cursor.fetchone()[0]
-        if bill_count == 0:
-            cursor.execute(f"DELETE FROM customers_{user_id} WHERE id = %s", (customer_id,))
-        conn.commit()
-        return jsonify({"message": "Bill deleted successfully"}), 200
-    except Exception as e:
-        conn.rollback()
-        return jsonify({"error": str(e)}), 500
+        next_id = from_user
+        while True:
+            with db_connection() as conn:
+                cursor = conn.cursor(dictionary=True)
+                try:
+                    cursor.execute("SELECT id, email FROM users WHERE id >= %s ORDER BY id LIMIT %s",
+                                   (next_id, ADMIN_EXPORT_PAGE_SIZE))
+                    users = cursor.fetchall()
+                    if users and SCHEMA_MODE != "tenant":
+                        present = users_with_tables(cursor, [user["id"] for user in users])
+                        page = [user for user in users if user["id"] in present]
+                    else:
+                        page = users
+                finally:
+                    cursor.close()
+            if not users:
+                break
+            next_id = users[-1]["id"] + 1
+            for user in page:
+                pending.append((user, pool.submit(fetch_export_chunk, user) if pool is not None else None))
+                while len(pending) > workers:
+                    yield from drain()
+        while pending:
+            yield from drain()
     finally:
-        conn.close()
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+
+def export_csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, (datetime, date)):
+        return value.isoformat(sep=" ") if isinstance(value, datetime) else value.isoformat()
+    return value
+
+
+def stream_export(fmt, from_user):
+    """Encode export chunks as NDJSON lines or CSV rows."""
+    if fmt == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_COLUMNS)
+        for rows in iter_export_chunks(from_user):
+            for row in rows:
+                writer.writerow([export_csv_value(row[column]) for column in EXPORT_COLUMNS])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+    else:
+        for rows in iter_export_chunks(from_user):
+            yield "".join(app.json.dumps(row) + "\n" for row in rows)
 
 
 @app.route("/admin/view-all-data", methods=["GET"])
 @require_firebase_auth
 def view_all_users_data():
-    """Admin endpoint to view all users' billing data. NOTE: Secure with admin checks in production."""
-    conn = create_connection()
-    if not conn:
-        return jsonify({"error": "Database connection failed"}), 500
+    """Admin endpoint to view all users' billing data. NOTE: Secure with admin checks in production.
+
+    format=ndjson|csv streams every row with constant memory instead of building one JSON body.
+    Rows come out in user_id order; an interrupted export resumes with from_user=<last user_id
+    received>, which re-sends that user's rows in full.
+    """
+    fmt = request.args.get("format")
+    if fmt and fmt not in ("ndjson", "csv"):
+        return jsonify({"error": "format must be 'ndjson' or 'csv'"}), 400
     try:
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT id, email FROM users ORDER BY id")
-        users = cursor.fetchall()
-        all_data = []
-        for user in users:
-            uid = user['id']
-            user_email = user['email']
-            cursor.execute(f"SHOW TABLES LIKE 'customers_{uid}'")
-            customers_table_exists = cursor.fetchone()
-            cursor.execute(f"SHOW TABLES LIKE 'bills_{uid}'")
-            bills_table_exists = cursor.fetchone()
-            if customers_table_exists and bills_table_exists:
-                cursor.execute(f"""
-                    SELECT 
-                        {uid} as user_id,
-                        '{user_email}' as user_email,
-                        c.id AS customer_id,
-                        c.name AS customer_name,
-                        c.contact AS customer_contact,
-                        c.email AS customer_email,
-                        b.id AS bill_id,
-                        b.amount,
-                        b.date AS bill_date
-                    FROM customers_{uid} c
-                    LEFT JOIN bills_{uid} b ON c.id = b.customer_id
-                    ORDER BY c.id, b.date DESC
-                """)
-                all_data.extend(cursor.fetchall())
+        from_user = int(request.args.get("from_user", 0))
+    except ValueError:
+        return jsonify({"error": "from_user must be an integer"}), 400
+    if WRITE_JOURNAL is not None:
+        # The export spans every tenant, so apply everything acknowledged so far
+        with db_connection():
+            while WRITE_JOURNAL.flush():
+                pass
+    if fmt == "csv":
+        response = Response(stream_with_context(stream_export(fmt, from_user)), mimetype="text/csv")
+        response.headers["Content-Disposition"] = "attachment; filename=billing-export.csv"
+        return response
+    if fmt == "ndjson":
+        return Response(stream_with_context(stream_export(fmt, from_user)), mimetype="application/x-ndjson")
+    try:
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT COUNT(*) FROM users")
+            total_users = cursor.fetchone()[0]
+            cursor.close()
+        # Outside the block: the export workers need the pool, including the connection just returned
+        all_data = [row for rows in iter_export_chunks(from_user) for row in rows]
         return jsonify({
-            "total_users": len(users),
+            "total_users": total_users,
             "total_records": len(all_data),
             "data": all_data
         })
     except Exception as e:
         return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
 
 
 @app.route("/user-stats", methods=["GET"])
 @require_firebase_auth
 def get_user_stats():
-    conn = create_connection()
-    if conn is None:
-        return jsonify({"error": "Failed to connect to database"}), 500
+    with db_connection() as conn:
+        try:
+            user_id = provision_user_with_conn(conn, g.firebase_uid, g.user_email)
+            settle_pending_writes(user_id)
+            cursor = conn.cursor(dictionary=True)
+            query = "SELECT customer_count, bill_count, total_amount, version FROM user_stats WHERE user_id = %s"
+            cursor.execute(query, (user_id,))
+            stats = cursor.fetchone()
+            if stats is None:
+                rebuild_user_stats(conn, TenantTables(user_id))
+                conn.commit()
+                cursor.execute(query, (user_id,))
+                stats = cursor.fetchone()
+            etag = data_etag(user_id, stats["version"])
+            response = not_modified(etag)
+            if response is not None:
+                return response
+            return with_etag(jsonify({
+                "customer_count": stats["customer_count"],
+                "bill_count": stats["bill_count"],
+                "total_amount": float(stats["total_amount"])
+            }), etag)
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+
+
+@app.route("/user-stats/trend", methods=["GET"])
+@require_firebase_auth
+def get_user_stats_trend():
+    """Bill count and revenue per day or month from the rollup table (?period=day|month&from=&to=)."""
+    if not STATS_ROLLUPS:
+        return jsonify({"error": "Trend rollups are disabled (set STATS_ROLLUPS=1)"}), 404
+    period = request.args.get("period", "day")
+    if period not in ("day", "month"):
+        return jsonify({"error": "period must be 'day' or 'month'"}), 400
     try:
-        user_id = provision_user_with_conn(conn, g.firebase_uid, g.user_email)
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute(f"SELECT COUNT(*) as customer_count FROM customers_{user_id}")
-        customer_count = cursor.fetchone()['customer_count']
-        cursor.execute(f"SELECT COUNT(*) as bill_count FROM bills_{user_id}")
-        bill_count = cursor.fetchone()['bill_count']
-        cursor.execute(f"SELECT SUM(amount) as total_amount FROM bills_{user_id}")
-        total_amount_result = cursor.fetchone()['total_amount']
-        total_amount = float(total_amount_result) if total_amount_result else 0
-        return jsonify({
-            "customer_count": customer_count,
-            "bill_count": bill_count,
-            "total_amount": total_amount
+        first_day = date.fromisoformat(request.args["from"]) if request.args.get("from") else date.min
+        last_day = date.fromisoformat(request.args["to"]) if request.args.get("to") else date.max
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    bucket = "day" if period == "day" else "DATE_FORMAT(day, '%Y-%m-01')"
+    with db_connection() as conn:
+        try:
+            user_id = provision_user_with_conn(conn, g.firebase_uid, g.user_email)
+            settle_pending_writes(user_id)
+            cursor = conn.cursor(dictionary=True)
+            cursor.execute(f"""
+                SELECT {bucket} AS bucket, SUM(bill_count) AS bill_count, SUM(total_amount) AS total_amount
+                FROM user_stats_daily
+                WHERE user_id = %s AND day BETWEEN %s AND %s
+                GROUP BY bucket ORDER BY bucket
+            """, (user_id, first_day, last_day))
+            series = [
+                {"period": str(row["bucket"])[:10 if period == "day" else 7],
+                 "bill_count": int(row["bill_count"]),
+                 "total_amount": float(row["total_amount"])}
+                for row in cursor.fetchall()
+            ]
+            return jsonify({"period": period, "series": series})
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+
+
+# --- Revenue reports ---
+REPORT_CACHE_BYTES = int(os.getenv("REPORT_CACHE_BYTES", str(64 * 1024 * 1024)))  # 0 reloads columns on every report
+REPORT_MAX_TOP = 100
+EPOCH = date(1970, 1, 1)
+MYSQL_EPOCH_DAYS = 719528  # TO_DAYS('1970-01-01')
+print(f"[Reports] column cache bytes={REPORT_CACHE_BYTES}")
+
+
+class BillColumns:
+    """One tenant's bills as parallel typed arrays ordered by date.
+
+    cents is the amount in integer cents, days the bill date as days since 1970-01-01 and customers
+    the customer id, so a date range is a contiguous slice found by bisection.
+
+    Reports read layouts derived from these once per cached copy instead of passing over every bill:
+    running totals of cents (a range's total is two lookups), the amounts sorted (percentiles of the
+    full history), and the bills regrouped by customer with their own running totals (per-customer
+    totals over a date range are two bisections per customer). The last two are built on first use.
+    """
+
+    def __init__(self):
+        self.cents = array("q")
+        self.days = array("i")
+        self.customers = array("q")
+        self.prefix = array("q", [0])
+        self._ordered = None
+        self._by_customer = None  # (customer ids, run starts + end, days, running cents) in customer order
+
+    @property
+    def nbytes(self):
+        # Room for the lazily built layouts is counted up front, so the cached size never changes later
+        bills = len(self.cents)
+        base = bills * (8 + 4 + 8) + (bills + 1) * 8  # cents, days, customers, running totals
+        return base + bills * 8 + bills * (8 + 8 + 4 + 8) + 16  # sorted amounts, the by-customer layout
+
+    def total(self, lo, hi):
+        return self.prefix[hi] - self.prefix[lo]
+
+    def sorted_cents(self, lo, hi):
+        """Amounts of bills lo..hi in ascending order; the full history's is kept once computed."""
+        if lo > 0 or hi < len(self.cents):
+            return sorted(self.cents[lo:hi])
+        if self._ordered is None:
+            self._ordered = array("q", sorted(self.cents))
+        return self._ordered
+
+    def _customer_layout(self):
+        if self._by_customer is None:
+            # sorted() is stable, so each customer's bills keep their date order
+            order = sorted(range(len(self.customers)), key=self.customers.__getitem__)
+            grouped = array("q", map(self.customers.__getitem__, order))
+            ids, starts = array("q"), array("q")
+            start = 0
+            while start < len(grouped):
+                ids.append(grouped[start])
+                starts.append(start)
+                start = bisect_right(grouped, grouped[start], start)
+            starts.append(len(grouped))
+            self._by_customer = (
+                ids, starts, array("i", map(self.days.__getitem__, order)),
+                array("q", accumulate(map(self.cents.__getitem__, order), initial=0)),
+            )
+        return self._by_customer
+
+    def customer_totals(self, lo, hi):
+        """Yield (customer_id, bill_count, cents) for each customer with bills in lo..hi."""
+        if lo >= hi:
+            return
+        ids, starts, days, prefix = self._customer_layout()
+        first, last = self.days[lo], self.days[hi - 1]
+        for customer_id, start, end in zip(ids, starts, starts[1:]):
+            a = bisect_left(days, first, start, end)
+            b = bisect_right(days, last, a, end)
+            if b > a:
+                yield customer_id, b - a, prefix[b] - prefix[a]
+
+    @classmethod
+    def load(cls, conn, tables, chunk=5000):
+        columns = cls()
+        history, params = bill_history_sql(tables, "id, customer_id, amount, date",
+                                           archive_state(conn, tables) is not None)
+        cursor = conn.cursor(buffered=False)
+        exhausted = False
+        try:
+            cursor.execute(f"""
+                SELECT CAST(ROUND(amount * 100) AS SIGNED), TO_DAYS(date) - {MYSQL_EPOCH_DAYS}, customer_id
+                {history} ORDER BY date, id
+            """, params)
+            while True:
+                rows = cursor.fetchmany(chunk)
+                if not rows:
+                    exhausted = True
+                    break
+                cents, days, customers = zip(*rows)
+                columns.cents.extend(cents)
+                columns.days.extend(days)
+                columns.customers.extend(customers)
+        finally:
+            if exhausted:
+                cursor.close()
+            else:
+                conn.discard()  # rows left unread; see stream_bills
+        columns.prefix = array("q", accumulate(columns.cents, initial=0))
+        return columns
+
+    def day_range(self, first=None, last=None):
+        """(lo, hi) slice bounds of the bills dated first..last inclusive."""
+        lo = 0 if first is None else bisect_left(self.days, (first - EPOCH).days)
+        hi = len(self.days) if last is None else bisect_right(self.days, (last - EPOCH).days)
+        return lo, max(lo, hi)
+
+    def day_runs(self, lo, hi):
+        """Yield (day, bill_count, cents) per distinct date, summing each run of equal days in one call."""
+        while lo < hi:
+            end = bisect_right(self.days, self.days[lo], lo, hi)
+            yield self.days[lo], end - lo, self.total(lo, end)
+            lo = end
+
+
+class ColumnCache(ResponseCache):
+    """ResponseCache of BillColumns per user, sized by array bytes and valid for one data version."""
+
+    @staticmethod
+    def _size(value):
+        return value.nbytes
+
+
+REPORT_CACHE = ColumnCache(REPORT_CACHE_BYTES, REPORT_CACHE_BYTES) if REPORT_CACHE_BYTES > 0 else None
+
+
+def money(cents):
+    return round(cents / 100, 2)
+
+
+def percentile_of(ordered, pct):
+    """Linearly interpolated percentile of an ascending sequence."""
+    position = (len(ordered) - 1) * pct / 100
+    low = int(position)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+
+def report_summary(columns, lo, hi):
+    if lo >= hi:
+        return {"bill_count": 0, "customer_count": 0, "total_amount": 0.0, "average_amount": None,
+                "min_amount": None, "median_amount": None, "max_amount": None}
+    total = columns.total(lo, hi)
+    ordered = columns.sorted_cents(lo, hi)
+    return {
+        "bill_count": hi - lo,
+        "customer_count": len(set(columns.customers[lo:hi])),
+        "total_amount": money(total),
+        "average_amount": money(total / (hi - lo)),
+        "min_amount": money(ordered[0]),
+        "median_amount": money(percentile_of(ordered, 50)),
+        "max_amount": money(ordered[-1]),
+    }
+
+
+def bucket_label(day, bucket):
+    value = EPOCH + timedelta(days=day)
+    if bucket == "month":
+        return value.strftime("%Y-%m")
+    if bucket == "week":
+        value -= timedelta(days=value.weekday())  # ISO weeks start on Monday
+    return value.isoformat()
+
+
+def report_revenue(columns, lo, hi, bucket):
+    series = []
+    for day, count, cents in columns.day_runs(lo, hi):
+        label = bucket_label(day, bucket)
+        if series and series[-1]["period"] == label:
+            series[-1]["bill_count"] += count
+            series[-1]["cents"] += cents
+        else:
+            series.append({"period": label, "bill_count": count, "cents": cents})
+    for point in series:
+        point["total_amount"] = money(point.pop("cents"))
+    return {"bucket": bucket, "series": series}
+
+
+def report_top_customers(conn, tables, columns, lo, hi, limit):
+    top = heapq.nlargest(limit, columns.customer_totals(lo, hi), key=lambda item: item[2])
+    names = {}
+    if top:
+        where, params = tables.scope()
+        placeholders = ", ".join(["%s"] * len(top))
+        cursor = conn.cursor()
+        cursor.execute(
+            f"SELECT id, name FROM {tables.customers} WHERE {where} AND id IN ({placeholders})",
+            params + tuple(customer_id for customer_id, _, _ in top),
+        )
+        names = dict(cursor.fetchall())
+    return {"customers": [
+        {"customer_id": customer_id, "name": names.get(customer_id), "bill_count": count,
+         "total_amount": money(cents), "average_amount": money(cents / count)}
+        for customer_id, count, cents in top
+    ]}
+
+
+def report_percentiles(columns, lo, hi, percentiles):
+    ordered = columns.sorted_cents(lo, hi)
+    return {"bill_count": len(ordered), "percentiles": {
+        f"p{pct:g}": money(percentile_of(ordered, pct)) if ordered else None for pct in percentiles
+    }}
+
+
+@app.route("/reports/<name>", methods=["GET"])
+@require_firebase_auth
+def get_report(name):
+    """Revenue analytics over the caller's bills, computed from a cached columnar copy of them.
+
+    summary; revenue?bucket=day|week|month; top-customers?limit=N; percentiles?p=50,90,99.
+    Every report takes optional from/to ISO dates and carries the same data-version ETag as /get_bills.
+    """
+    if name not in ("summary", "revenue", "top-customers", "percentiles"):
+        return jsonify({"error": f"Unknown report '{name}'"}), 404
+    args = request.args
+    try:
+        first_day = date.fromisoformat(args["from"]) if args.get("from") else None
+        last_day = date.fromisoformat(args["to"]) if args.get("to") else None
+        bucket = args.get("bucket", "month")
+        if bucket not in ("day", "week", "month"):
+            raise ValueError("bucket must be 'day', 'week' or 'month'")
+        limit = min(max(int(args.get("limit", 10)), 1), REPORT_MAX_TOP)
+        percentiles = [float(value) for value in args.get("p", "50,90,95,99").split(",")]
+        if any(not 0 <= pct <= 100 for pct in percentiles):
+            raise ValueError("percentiles must be between 0 and 100")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    with db_connection() as conn:
+        try:
+            user_id = provision_user_with_conn(conn, g.firebase_uid, g.user_email)
+            settle_pending_writes(user_id)
+            tables = TenantTables(user_id)
+            etag = data_etag(user_id, user_data_version(conn, tables))
+            response = not_modified(etag)
+            if response is not None:
+                return response
+            columns = REPORT_CACHE.get((user_id,), etag) if REPORT_CACHE is not None else None
+            if columns is None:
+                columns = BillColumns.load(conn, tables)
+                if REPORT_CACHE is not None:
+                    REPORT_CACHE.put((user_id,), etag, columns)
+            lo, hi = columns.day_range(first_day, last_day)
+            if name == "summary":
+                result = report_summary(columns, lo, hi)
+            elif name == "revenue":
+                result = report_revenue(columns, lo, hi, bucket)
+            elif name == "top-customers":
+                result = report_top_customers(conn, tables, columns, lo, hi, limit)
+            else:
+                result = report_percentiles(columns, lo, hi, percentiles)
+            result.update({"report": name, "from": args.get("from"), "to": args.get("to")})
+            return with_etag(jsonify(result), etag)
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+
+
+# --- Customer search ---
+# Prefix search over the (owner, name/email/contact) indexes: each rank is one index range scan capped at
+# the page size, so cost follows the page, not the tenant. Ranks: exact name, name prefix, email prefix,
+# contact prefix; a customer is listed under the first rank it matches.
+SEARCH_MAX_LIMIT = 100
+SEARCH_RANKS = ("name", "name", "email", "contact")
+
+
+def like_prefix(text):
+    """LIKE pattern matching values that start with `text` literally."""
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+def encode_search_cursor(row):
+    """Opaque keyset cursor pointing just past `row` in (rank, matched value, id) order."""
+    raw = json.dumps([row["search_rank"], row["sort_key"], row["id"]])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_search_cursor(value):
+    try:
+        padded = value + "=" * (-len(value) % 4)
+        rank, sort_key, customer_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if rank not in range(len(SEARCH_RANKS)):
+            raise ValueError
+        return rank, str(sort_key), int(customer_id)
+    except (ValueError, TypeError, binascii.Error):
+        raise ValueError("Invalid cursor")
+
+
+def build_search_query(tables, text, limit, after=None):
+    """One UNION ALL with a LIMITed index range scan per rank, resuming after a decoded cursor."""
+    where, scope_params = tables.scope("c")
+    pattern = like_prefix(text)
+    predicates = (
+        ("c.name = %s", [text]),
+        ("c.name LIKE %s AND c.name <> %s", [pattern, text]),
+        ("c.email LIKE %s AND c.name NOT LIKE %s", [pattern, pattern]),
+        ("c.contact LIKE %s AND c.name NOT LIKE %s AND COALESCE(c.email, '') NOT LIKE %s", [pattern] * 3),
+    )
+    branches, params = [], []
+    for rank, (column, (predicate, values)) in enumerate(zip(SEARCH_RANKS, predicates)):
+        if after is not None and rank < after[0]:
+            continue
+        clause = f"{where} AND {predicate}"
+        values = list(scope_params) + values
+        if after is not None and rank == after[0]:
+            clause += f" AND (c.{column} > %s OR (c.{column} = %s AND c.id > %s))"
+            values += [after[1], after[1], after[2]]
+        branches.append(f"""
+            SELECT * FROM (
+                SELECT {rank} AS search_rank, c.{column} AS sort_key, c.id, c.name, c.contact, c.email
+                FROM {tables.customers} c WHERE {clause}
+                ORDER BY c.{column}, c.id LIMIT %s
+            ) AS rank{rank}
+        """)
+        params += values + [limit]
+    sql = " UNION ALL ".join(branches) + " ORDER BY search_rank, sort_key, id LIMIT %s"
+    return sql, tuple(params + [limit])
+
+
+@app.route("/search", methods=["GET"])
+@require_firebase_auth
+def search_customers():
+    """Find the caller's customers by name, email or contact prefix (?q=), with their bill totals.
+
+    Paginated like /get_bills: ?limit= (default 20) and the returned next_cursor. List a customer's
+    bills with /get_bills?customer_id=.
+    """
+    text = request.args.get("q", "").strip()
+    if not text:
+        return jsonify({"error": "q is required"}), 400
+    try:
+        limit = min(max(int(request.args.get("limit", 20)), 1), SEARCH_MAX_LIMIT)
+        after = decode_search_cursor(request.args["cursor"]) if request.args.get("cursor") else None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    with db_connection() as conn:
+        try:
+            user_id = provision_user_with_conn(conn, g.firebase_uid, g.user_email)
+            settle_pending_writes(user_id)
+            tables = TenantTables(user_id)
+            etag = data_etag(user_id, user_data_version(conn, tables))
+            response = not_modified(etag)
+            if response is not None:
+                return response
+            cursor = conn.cursor(dictionary=True)
+            cursor.execute(*build_search_query(tables, text, limit + 1, after))
+            rows = cursor.fetchall()
+            totals = {}
+            if rows[:limit]:
+                where, scope_params = tables.scope("b")
+                ids = [row["id"] for row in rows[:limit]]
+                cursor.execute(f"""
+                    SELECT b.customer_id, COUNT(*) AS bill_count, SUM(b.amount) AS total_amount,
+                           MAX(b.date) AS last_bill_date
+                    FROM {tables.bills} b
+                    WHERE {where} AND b.customer_id IN ({', '.join(['%s'] * len(ids))})
+                    GROUP BY b.customer_id
+                """, scope_params + tuple(ids))
+                totals = {row["customer_id"]: row for row in cursor.fetchall()}
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+    results = []
+    for row in rows[:limit]:
+        total = totals.get(row["id"], {})
+        results.append({
+            "customer_id": row["id"],
+            "name": row["name"],
+            "contact": row["contact"],
+            "email": row["email"],
+            "matched": SEARCH_RANKS[row["search_rank"]],
+            "exact": row["search_rank"] == 0,
+            "bill_count": total.get("bill_count", 0),
+            "total_amount": float(total.get("total_amount") or 0),
+            "last_bill_date": total.get("last_bill_date"),
         })
+    next_cursor = encode_search_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return with_etag(jsonify({"results": results, "next_cursor": next_cursor}), etag)
+
+
+# --- Account deletion jobs ---
+# DELETE /delete-account detaches the users row from its Firebase uid and queues a job in account_deletions.
+# A few threads in every worker claim due jobs and run their steps: delete the Firebase user, remove the
+# data in throttled chunks of committed DELETEs, drop the then-empty per-user tables (so the metadata lock
+# is brief) and finally the users row. The current step and progress live on the job row and every step is
+# safe to repeat, so a job whose worker died is reclaimed once its lease lapses and resumes where it stopped.
+DELETION_WORKERS = int(os.getenv("DELETION_WORKERS", "1"))  # job threads per process; 0 leaves jobs to the CLI
+DELETION_CHUNK = int(os.getenv("DELETION_CHUNK", "1000"))  # rows deleted per transaction
+DELETION_PAUSE = float(os.getenv("DELETION_PAUSE_MS", "50")) / 1000  # sleep between chunks
+DELETION_LEASE = int(os.getenv("DELETION_LEASE_SECONDS", "300"))  # a running job idle this long is reclaimed
+DELETION_MAX_ATTEMPTS = int(os.getenv("DELETION_MAX_ATTEMPTS", "5"))
+DELETION_POLL = float(os.getenv("DELETION_POLL_SECONDS", "30"))  # idle workers look for due jobs this often
+print(f"[AccountDeletion] workers={DELETION_WORKERS} chunk={DELETION_CHUNK} pause={DELETION_PAUSE * 1000:.0f}ms")
+
+
+def create_account_deletions_table(conn=None):
+    """Create the account_deletions job table."""
+    own_conn = False
+    if conn is None:
+        conn = create_connection()
+        own_conn = True
+    if not conn:
+        print("❌ Failed to connect to database to create account deletions table")
+        return
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS account_deletions (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                user_id INT NOT NULL,
+                firebase_uid VARCHAR(128) NOT NULL,
+                status VARCHAR(16) NOT NULL DEFAULT 'queued',
+                step VARCHAR(16) NOT NULL DEFAULT 'firebase',
+                rows_deleted BIGINT NOT NULL DEFAULT 0,
+                attempts INT NOT NULL DEFAULT 0,
+                last_error TEXT NULL,
+                retry_at TIMESTAMP NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                finished_at TIMESTAMP NULL,
+                UNIQUE KEY uq_deletion_user (user_id),
+                KEY idx_deletion_uid (firebase_uid),
+                KEY idx_deletion_status (status, id)
+            )
+        """)
+        conn.commit()
+        print("Account deletions table created/verified successfully")
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        print(f"Error creating account deletions table: {e}")
     finally:
-        conn.close()
+        if own_conn:
+            conn.close()
+
+
+def deletion_job_body(job):
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "step": job["step"],
+        "rows_deleted": job["rows_deleted"],
+        "attempts": job["attempts"],
+        "error": job["last_error"],
+        "created_at": job["created_at"],
+        "finished_at": job["finished_at"],
+    }
+
+
+class AccountDeletions:
+    """account_deletions jobs and this process's worker threads.
+
+    Steps run in order: "firebase" (delete the Firebase user), "data" (chunked deletes, then DROP of the
+    emptied per-user tables), "user" (the users row and per-user summaries), then the job is "done".
+    A failed attempt is retried with backoff until DELETION_MAX_ATTEMPTS, then marked "failed" for
+    `flask run-deletions --retry-failed`.
+    """
+
+    def __init__(self, workers=DELETION_WORKERS, chunk=DELETION_CHUNK, pause=DELETION_PAUSE):
+        self.workers = workers
+        self.chunk = chunk
+        self.pause = pause
+        self._wake = threading.Event()
+        self._threads = []
+        self._threads_pid = None
+        self._start_lock = threading.Lock()
+        self.completed = 0
+        self.failed = 0
+        self.errors = 0
+
+    def enqueue(self, conn, user_id, firebase_uid):
+        """Queue (or find) the deletion job for user_id and detach the account from its uid; commits."""
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT IGNORE INTO account_deletions (user_id, firebase_uid) VALUES (%s, %s)", (user_id, firebase_uid)
+        )
+        # The uid and email are free at once: a sign-in while the job runs maps to a new account. Workers
+        # still caching the old id revalidate it (user_is_live) before writing, and this UPDATE waits on
+        # their share lock of the row, so no write lands behind the job.
+        cursor.execute(
+            "UPDATE users SET firebase_uid = NULL, email = %s WHERE id = %s", (f"deleted-{user_id}", user_id)
+        )
+        conn.commit()
+        self._wake.set()
+        self.ensure_running()
+
+    def requeue_failed(self, conn, job_id=None):
+        """Give failed jobs (one, or all) a fresh set of attempts; returns how many were requeued."""
+        where, params = ("AND id = %s", (job_id,)) if job_id is not None else ("", ())
+        cursor = conn.cursor()
+        cursor.execute(
+            f"UPDATE account_deletions SET status = 'queued', attempts = 0, retry_at = NULL "
+            f"WHERE status = 'failed' {where}", params,
+        )
+        conn.commit()
+        if cursor.rowcount:
+            self._wake.set()
+            self.ensure_running()
+        return cursor.rowcount
+
+    def find(self, conn, firebase_uid):
+        """The newest deletion job for a Firebase uid, or None."""
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute(
+            "SELECT * FROM account_deletions WHERE firebase_uid = %s ORDER BY id DESC LIMIT 1", (firebase_uid,)
+        )
+        return cursor.fetchone()
+
+    def run_next(self):
+        """Claim and run one due job; returns False when there is none."""
+        job = self._claim()
+        if job is None:
+            return False
+        try:
+            self._run_job(job)
+        except Exception as e:
+            self._record_failure(job, e)
+        return True
+
+    def _claim(self):
+        with db_connection() as conn:
+            cursor = conn.cursor(dictionary=True)
+            cursor.execute("""
+                SELECT * FROM account_deletions
+                WHERE (status = 'queued' AND (retry_at IS NULL OR retry_at <= NOW()))
+                   OR (status = 'running' AND updated_at < DATE_SUB(NOW(), INTERVAL %s SECOND))
+                ORDER BY id LIMIT 1 FOR UPDATE SKIP LOCKED
+            """, (DELETION_LEASE,))
+            job = cursor.fetchone()
+            if job is not None:
+                cursor.execute(
+                    "UPDATE account_deletions SET status = 'running', attempts = attempts + 1 WHERE id = %s",
+                    (job["id"],),
+                )
+            conn.commit()
+            return job
+
+    def _advance(self, conn, job, step, status="running"):
+        finished = ", finished_at = NOW()" if status == "done" else ""
+        cursor = conn.cursor()
+        cursor.execute(
+            f"UPDATE account_deletions SET step = %s, status = %s, last_error = NULL{finished} WHERE id = %s",
+            (step, status, job["id"]),
+        )
+        conn.commit()
+        job["step"] = step
+
+    def _run_job(self, job):
+        user_id = job["user_id"]
+        if TOKEN_CACHE is not None:
+            TOKEN_CACHE.invalidate_uid(job["firebase_uid"])
+        IDENTITY_CACHE.invalidate(job["firebase_uid"])
+        if job["step"] == "firebase":
+            fb_auth = firebase_auth()
+            try:
+                fb_auth.delete_user(job["firebase_uid"])
+            except fb_auth.UserNotFoundError:
+                pass  # deleted by an earlier attempt
+            with db_connection() as conn:
+                self._advance(conn, job, "data")
+        if job["step"] == "data":
+            if WRITE_JOURNAL is not None:
+                WRITE_JOURNAL.discard_user(user_id)
+            with db_connection() as conn:
+                # Without its summary row, a worker still reading under a cached id fails the stats rebuild
+                # (the account is detached) instead of reading tables that are about to be dropped
+                conn.cursor().execute("DELETE FROM user_stats WHERE user_id = %s", (user_id,))
+                conn.commit()
+                self._delete_data(conn, job)
+                self._advance(conn, job, "user")
+        if job["step"] == "user":
+            with db_connection() as conn:
+                cursor = conn.cursor()
+                summaries = ["user_stats", "user_stats_daily", "bill_archive_state"]
+                if WRITE_JOURNAL is not None:
+                    summaries.append("write_behind_applied")
+                for table in summaries:
+                    cursor.execute(f"DELETE FROM {table} WHERE user_id = %s", (user_id,))
+                cursor.execute("DELETE FROM users WHERE id = %s", (user_id,))
+                conn.commit()
+                self._advance(conn, job, "done", status="done")
+        if RESPONSE_CACHE is not None:
+            RESPONSE_CACHE.invalidate_user(user_id)
+        if REPORT_CACHE is not None:
+            REPORT_CACHE.invalidate_user(user_id)
+        self.completed += 1
+        print(f"✅ Deleted account {user_id} ({job['rows_deleted']} rows)")
+
+    def _delete_data(self, conn, job):
+        """Delete the user's rows in committed chunks, then drop their emptied per-user tables."""
+        user_id = job["user_id"]
+        cursor = conn.cursor()
+        own = [f"bills_archive_{user_id}", f"bills_{user_id}", f"customers_{user_id}"]
+        cursor.execute(f"""
+            SELECT TABLE_NAME FROM information_schema.TABLES
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME IN ({", ".join(["%s"] * (len(own) + 1))})
+        """, own + ["bills_archive"])
+        present = {name for (name,) in cursor.fetchall()}
+        # Children before parents, so the customers FK cascade has nothing left to do
+        targets = [(table, "1=1", ()) for table in own if table in present]
+        if SCHEMA_MODE == "tenant":
+            shared = ["bills_archive"] if "bills_archive" in present else []
+            targets += [(table, "user_id = %s", (user_id,)) for table in shared + ["bills", "customers"]]
+        targets.append(("bill_changes", "user_id = %s", (user_id,)))
+        for table, where, params in targets:
+            while True:
+                cursor.execute(f"DELETE FROM {table} WHERE {where} LIMIT %s", params + (self.chunk,))
+                deleted = cursor.rowcount
+                cursor.execute(
+                    "UPDATE account_deletions SET rows_deleted = rows_deleted + %s WHERE id = %s", (deleted, job["id"])
+                )
+                conn.commit()
+                job["rows_deleted"] += deleted
+                if deleted < self.chunk:
+                    break
+                if self.pause:
+                    time.sleep(self.pause)
+        for table in own:
+            cursor.execute(f"DROP TABLE IF EXISTS {table}")
+
+    def _record_failure(self, job, error):
+        self.errors += 1
+        failed = job["attempts"] + 1 >= DELETION_MAX_ATTEMPTS
+        print(f"⚠️ Account deletion {job['id']} failed at step {job['step']} (attempt {job['attempts'] + 1}): {error}")
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                UPDATE account_deletions
+                SET status = %s, last_error = %s, retry_at = DATE_ADD(NOW(), INTERVAL %s SECOND)
+                WHERE id = %s
+            """, ("failed" if failed else "queued", str(error)[:2000], min(3600, 10 * 2 ** job["attempts"]), job["id"]))
+            conn.commit()
+        if failed:
+            self.failed += 1
+
+    def ensure_running(self):
+        """Start this process's worker threads (again after fork)."""
+        if not self.workers or (self._threads_pid == os.getpid() and all(t.is_alive() for t in self._threads)):
+            return
+        with self._start_lock:
+            if self._threads_pid == os.getpid() and all(t.is_alive() for t in self._threads):
+                return
+            self._threads = [
+                threading.Thread(target=self._run, name=f"account-deletion-{n}", daemon=True)
+                for n in range(self.workers)
+            ]
+            self._threads_pid = os.getpid()
+            for thread in self._threads:
+                thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                while self.run_next():
+                    pass
+            except Exception as e:
+                self.errors += 1
+                print(f"⚠️ Account deletion worker failed, will retry: {e}")
+            self._wake.wait(DELETION_POLL)
+            self._wake.clear()
+
+    def stats(self):
+        return {"completed": self.completed, "failed": self.failed, "errors": self.errors}
+
+
+ACCOUNT_DELETIONS = AccountDeletions()
+
+
+@app.before_request
+def start_account_deletion_workers():
+    # Also picks up jobs left queued by a previous process
+    ACCOUNT_DELETIONS.ensure_running()
+
+
+@app.cli.command("run-deletions")
+@click.option("--retry-failed", is_flag=True, help="Requeue jobs that exhausted their attempts first.")
+def run_deletions_command(retry_failed):
+    """Run every due account deletion job now, in this process."""
+    if retry_failed:
+        conn = create_connection()
+        if not conn:
+            raise click.ClickException("Database connection failed")
+        try:
+            click.echo(f"Requeued {ACCOUNT_DELETIONS.requeue_failed(conn)} failed job(s)")
+        finally:
+            conn.close()
+    runs = 0
+    while ACCOUNT_DELETIONS.run_next():
+        runs += 1
+    stats = ACCOUNT_DELETIONS.stats()
+    click.echo(f"✅ Ran {runs} deletion job(s): {stats['completed']} completed, {stats['failed']} failed")
 
 
 @app.route("/delete-account", methods=["DELETE"])
 @require_firebase_auth
 def delete_account():
-    """Delete user from Firebase + MySQL (user table, bills, customers)."""
-    conn = create_connection()
-    if not conn:
-        return jsonify({"error": "Database connection failed"}), 500
+    """Queue deletion of the caller's Firebase user and all their data; answers 202 with the job.
 
-    try:
-        cursor = conn.cursor()
-        
-        # Use g instead of request.user
-        uid = g.firebase_uid
-        email = g.user_email
-
-        # 1️⃣ Delete user from Firebase
-        fb_auth.delete_user(uid)
-
-        # 2️⃣ Get user_id from MySQL users table (use firebase_uid for reliability)
-        cursor.execute("SELECT id FROM users WHERE firebase_uid = %s", (uid,))
-        user = cursor.fetchone()
-        if not user:
-            return jsonify({"error": "User not found in MySQL"}), 404
-        user_id = user[0]
-
-        # 3️⃣ Drop user-specific tables
-        cursor.execute(f"DROP TABLE IF EXISTS bills_{user_id}")
-        cursor.execute(f"DROP TABLE IF EXISTS customers_{user_id}")
-        
-
-        # 4️⃣ Delete user from MySQL users table
-        cursor.execute("DELETE FROM users WHERE id = %s", (user_id,))
-        conn.commit()
+    The account is detached from its uid before this returns, so later requests no longer see its data.
+    Repeating the call returns the same job (requeuing it if it had failed). Progress: GET /delete-account/status.
+    """
+    with db_connection() as conn:
+        try:
+            uid = g.firebase_uid
+            cursor = conn.cursor()
+            cursor.execute("SELECT id FROM users WHERE firebase_uid = %s", (uid,))
+            user = cursor.fetchone()
+            if user:
+                user_id = user[0]
+                ACCOUNT_DELETIONS.enqueue(conn, user_id, uid)
+                if TOKEN_CACHE is not None:
+                    TOKEN_CACHE.invalidate_uid(uid)
+                IDENTITY_CACHE.invalidate(uid)
+                # ETags embed user_id, so a re-created account never matches this one's; just free cached bodies
+                if RESPONSE_CACHE is not None:
+                    RESPONSE_CACHE.invalidate_user(user_id)
+                if REPORT_CACHE is not None:
+                    REPORT_CACHE.invalidate_user(user_id)
+            job = ACCOUNT_DELETIONS.find(conn, uid)
+            if job is None:
+                return jsonify({"error": "User not found in MySQL"}), 404
+            if job["status"] == "failed" and ACCOUNT_DELETIONS.requeue_failed(conn, job["id"]):
+                job = ACCOUNT_DELETIONS.find(conn, uid)
+            response = jsonify({"success": True, "message": "Account deletion started",
+                                **deletion_job_body(job)})
+            response.headers["Location"] = "/delete-account/status"
+            return response, 202
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
 
-        return jsonify({"success": True, "message": "Account deleted successfully"}), 200
 
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
+@app.route("/delete-account/status", methods=["GET"])
+@require_firebase_auth
+def delete_account_status():
+    """State of the caller's latest account deletion job."""
+    with db_connection() as conn:
+        try:
+            job = ACCOUNT_DELETIONS.find(conn, g.firebase_uid)
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+    if job is None:
+        return jsonify({"error": "No account deletion found"}), 404
+    return jsonify(deletion_job_body(job)), 200
+
+
+def metrics_authorized():
+    """Loopback scrapers only, unless METRICS_TOKEN is set and presented as a Bearer token."""
+    if METRICS_TOKEN:
+        presented = request.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+        return secrets.compare_digest(presented, METRICS_TOKEN)
+    return request.remote_addr in ("127.0.0.1", "::1")
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    if not metrics_authorized():
+        return jsonify({"error": "Forbidden"}), 403
+    pool = DB_POOL.stats()
+    extra = ["# HELP billing_db_pool_connections Pooled connections by state.",
+             "# TYPE billing_db_pool_connections gauge"]
+    extra += [f'billing_db_pool_connections{{state="{state}"}} {pool[state]}' for state in ("in_use", "idle", "waiting")]
+    extra += ["# TYPE billing_db_pool_checkouts_total counter", f"billing_db_pool_checkouts_total {pool['checkouts']}",
+              "# TYPE billing_db_pool_timeouts_total counter", f"billing_db_pool_timeouts_total {pool['timeouts']}",
+              "# TYPE billing_db_pool_rejected_total counter", f"billing_db_pool_rejected_total {pool['rejected']}",
+              "# TYPE billing_db_pool_checkout_failures_total counter",
+              f"billing_db_pool_checkout_failures_total {pool['checkout_failures']}",
+              "# HELP billing_db_pool_wait_seconds Time checkouts waited for a connection.",
+              "# TYPE billing_db_pool_wait_seconds histogram"]
+    waits = 0
+    for bound, count in pool["wait_histogram_ms"].items():
+        waits += count
+        le = bound if bound == "+Inf" else f"{int(bound) / 1000:g}"
+        extra.append(f'billing_db_pool_wait_seconds_bucket{{le="{le}"}} {waits}')
+    extra += [f"billing_db_pool_wait_seconds_sum {pool['wait_seconds_sum']:.6f}", f"billing_db_pool_wait_seconds_count {waits}"]
+    identities = IDENTITY_CACHE.stats()
+    extra += ["# TYPE billing_identity_cache_entries gauge", f"billing_identity_cache_entries {identities['size']}",
+              "# TYPE billing_identity_cache_requests_total counter",
+              f'billing_identity_cache_requests_total{{result="hit"}} {identities["hits"]}',
+              f'billing_identity_cache_requests_total{{result="shared_hit"}} {identities["shared_hits"]}',
+              f'billing_identity_cache_requests_total{{result="miss"}} {identities["misses"]}']
+    if RATE_LIMITER is not None:
+        limits = RATE_LIMITER.stats()
+        extra += ["# TYPE billing_rate_limit_requests_total counter",
+                  f'billing_rate_limit_requests_total{{result="allowed"}} {limits["allowed"]}',
+                  f'billing_rate_limit_requests_total{{result="limited"}} {limits["limited"]}']
+    if WRITE_JOURNAL is not None:
+        journal = WRITE_JOURNAL.stats()
+        extra += ["# TYPE billing_write_behind_pending gauge", f"billing_write_behind_pending {journal['pending']}",
+                  "# TYPE billing_write_behind_records_total counter",
+                  f'billing_write_behind_records_total{{result="applied"}} {journal["applied"]}',
+                  f'billing_write_behind_records_total{{result="rejected"}} {journal["rejected"]}',
+                  "# TYPE billing_write_behind_flush_errors_total counter",
+                  f"billing_write_behind_flush_errors_total {journal['flush_errors']}"]
+    deletions = ACCOUNT_DELETIONS.stats()
+    extra += ["# TYPE billing_account_deletions_total counter",
+              f'billing_account_deletions_total{{result="completed"}} {deletions["completed"]}',
+              f'billing_account_deletions_total{{result="failed"}} {deletions["failed"]}',
+              "# TYPE billing_account_deletion_errors_total counter",
+              f"billing_account_deletion_errors_total {deletions['errors']}"]
+    if RESPONSE_CACHE is not None:
+        cache = RESPONSE_CACHE.stats()
+        extra += ["# TYPE billing_response_cache_bytes gauge", f"billing_response_cache_bytes {cache['bytes']}",
+                  "# TYPE billing_response_cache_requests_total counter",
+                  f'billing_response_cache_requests_total{{result="hit"}} {cache["hits"]}',
+                  f'billing_response_cache_requests_total{{result="miss"}} {cache["misses"]}']
+    if REPORT_CACHE is not None:
+        cache = REPORT_CACHE.stats()
+        extra += ["# TYPE billing_report_cache_bytes gauge", f"billing_report_cache_bytes {cache['bytes']}",
+                  "# TYPE billing_report_cache_requests_total counter",
+                  f'billing_report_cache_requests_total{{result="hit"}} {cache["hits"]}',
+                  f'billing_report_cache_requests_total{{result="miss"}} {cache["misses"]}']
+    if TOKEN_CACHE is not None:
+        cache = TOKEN_CACHE.stats()
+        extra += ["# TYPE billing_token_cache_entries gauge", f"billing_token_cache_entries {cache['size']}",
+                  "# TYPE billing_token_cache_requests_total counter",
+                  f'billing_token_cache_requests_total{{result="hit"}} {cache["hits"]}',
+                  f'billing_token_cache_requests_total{{result="miss"}} {cache["misses"]}',
+                  "# TYPE billing_token_cache_evictions_total counter",
+                  f"billing_token_cache_evictions_total {cache['evictions']}"]
+    return Response(METRICS.render(extra), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/metrics/slow-queries", methods=["GET"])
+def slow_queries():
+    if not metrics_authorized():
+        return jsonify({"error": "Forbidden"}), 403
+    return jsonify({"threshold_ms": SLOW_QUERY_MS, "samples": METRICS.slow_query_samples()})
+
 
 @app.route("/ping", methods=["GET"])
 def ping():
     return jsonify({"message": "pong"}), 200
 
+
+# --- Schema migrations ---
+
+def migrate():
+    """Create or upgrade the shared tables: users (and firebase_uid), tenant tables, stats, write-behind, jobs."""
+    create_users_table()
+    create_account_deletions_table()
+    if WRITE_JOURNAL is not None:
+        create_write_behind_table()
+
+
+@app.cli.command("migrate")
+def migrate_command():
+    """Run the startup schema checks once, e.g. as a release step when LAZY_STARTUP=1."""
+    migrate()
+    click.echo("Schema is up to date")
+
+
+# Without LAZY_STARTUP every import checks the schema; under `gunicorn --preload` that is once, in the master
+if not LAZY_STARTUP:
+    migrate()
+
 if __name__ == "__main__":
     app.run(debug=True)